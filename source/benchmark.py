@@ -0,0 +1,279 @@
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+
+from settings import Settings
+from tokenstring import TokenString
+from multigram import MultiGram
+from nexttokenscorer import NextTokenScorer
+from sentencegenerator import SentenceGenerator
+from tokensourcememory import TokenSourceMemory
+
+
+class EagerTokenString:
+    """
+    A token laid out the way TokenString was before tokens were slotted:
+    an instance dictionary, and the per-distance lists TokenBase allocated
+    in every constructor, whether or not the token is kept.  The same
+    attributes, in the same order, as the original constructors set.
+    Used as the baseline.
+    """
+    def __init__(self, value: str):
+        self.token_type = 'TokenString'
+
+        self.start_of_sequence = False
+        self.IntrinsicToken = False
+        self.IntrinsicOperation = None
+        self.OrgnizeSeen = False
+        self.CurrentStrength = 0
+
+        self.Connections = [[] for i in range(Settings.max_token_strength)]
+        self.SoftmaxConnections = [[] for i in range(Settings.max_token_strength)]
+        self.NomalizedConnections = [[] for i in range(Settings.max_token_strength)]
+        self.ConnectionCount = [0 for i in range(Settings.max_token_strength)]
+        self.TotalConnectionStrength = [0 for i in range(Settings.max_token_strength)]
+        self.CurrentActivityFromPreviousTokens = [0.0 for i in range(Settings.max_token_strength)]
+
+        self.token_raw = value
+        self.end_of_line = False
+
+
+def MeasureTokens(make_token, count: int, insert: bool = False) -> dict:
+    """
+    Measure the time and memory taken to make count tokens.
+    make_token: Callable making a token from a string.
+    count: The number of tokens to make.
+    insert: Allocate the tokens as a MultiGram does when it inserts them.
+    returns: Seconds and bytes per token.
+    """
+    values = [f'token{i}' for i in range(count)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    tokens = [make_token(value) for value in values]
+    if insert:
+        for token in tokens:
+            if hasattr(token, 'AllocateActivity'):
+                token.AllocateActivity()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del tokens
+    return {'seconds_per_token': elapsed / count, 'bytes_per_token': size / count}
+
+
+def BenchmarkTokenAllocation(count: int = 100000) -> dict:
+    """
+    Compare slotted, lazily allocated tokens with the eager baseline.
+    Transient tokens are those a source makes for a lookup and drops,
+    inserted tokens are those kept in the vocabulary.
+    returns: The measurements by case.
+    """
+    return {
+        'eager': MeasureTokens(EagerTokenString, count),
+        'slotted_transient': MeasureTokens(TokenString, count),
+        'slotted_inserted': MeasureTokens(TokenString, count, insert=True),
+    }
+
+
+def ZipfCorpus(vocabulary_size: int, line_count: int, min_line_length: int = 4, max_line_length: int = 16,
+               exponent: float = 1.1, seed: int = 0) -> list[list[str]]:
+    """
+    A deterministic synthetic corpus: words drawn from a vocabulary with
+    Zipfian frequencies, word k having weight 1 / k^exponent, in lines of
+    uniformly random length.  The same arguments always give the same corpus.
+    returns: A list of lines, each a list of words.
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, vocabulary_size + 1) ** exponent
+    lengths = rng.integers(min_line_length, max_line_length + 1, size=line_count)
+    words = rng.choice(vocabulary_size, size=int(lengths.sum()), p=weights / weights.sum())
+
+    vocabulary = [f'w{k}' for k in range(vocabulary_size)]
+    bounds = np.concatenate(([0], np.cumsum(lengths))).tolist()
+    return [[vocabulary[k] for k in words[start:end].tolist()] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def Timed(function) -> tuple:
+    """
+    Call a function once.
+    returns: Its result and the seconds it took.
+    """
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def PeakMemory(function) -> tuple:
+    """
+    Call a function once, tracing allocations.
+    returns: Its result and the peak bytes allocated while it ran.
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def ReadAll(multigram: MultiGram) -> MultiGram:
+    """
+    Train a multigram on its whole token source, token by token.
+    """
+    while not multigram.input_source_complete:
+        multigram.ReadTokenBehavior()
+    return multigram
+
+
+def IngestAll(multigram: MultiGram) -> MultiGram:
+    """
+    Train a multigram on its whole token source, in batches of lines.
+    """
+    multigram.IngestSource()
+    return multigram
+
+
+def BenchmarkIngestion(corpus: list[list[str]], measure_memory: bool = True) -> tuple[MultiGram, dict]:
+    """
+    Measure training on a corpus, token by token with ReadTokenBehavior
+    and in batches with IngestSource, then the first full Softmax.
+    Memory is measured in separate runs, as tracing slows them down.
+    returns: The multigram trained token by token, and the measurements.
+    """
+    token_count = sum(len(line) + 1 for line in corpus)
+
+    multigram, read_seconds = Timed(lambda: ReadAll(MultiGram(TokenSourceMemory(corpus))))
+    _, ingest_seconds = Timed(lambda: IngestAll(MultiGram(TokenSourceMemory(corpus))))
+    _, softmax_seconds = Timed(multigram.Softmax)
+
+    results = {
+        'tokens': token_count,
+        'vocabulary_size': multigram.CountUsedTokens(),
+        'connections': multigram.connections.ConnectionCount(),
+        'read_tokens_per_second': token_count / read_seconds,
+        'ingest_tokens_per_second': token_count / ingest_seconds,
+        'softmax_seconds': softmax_seconds,
+    }
+    if measure_memory:
+        _, results['read_peak_bytes'] = PeakMemory(lambda: ReadAll(MultiGram(TokenSourceMemory(corpus))))
+        _, results['ingest_peak_bytes'] = PeakMemory(lambda: IngestAll(MultiGram(TokenSourceMemory(corpus))))
+
+    return multigram, results
+
+
+def BenchmarkQueries(multigram: MultiGram, corpus: list[list[str]], query_count: int = 200, seed: int = 0) -> dict:
+    """
+    Measure next-token scoring, as FindBestNextToken does it, one history
+    at a time and in one batch, and generation by sampling and beam search.
+    Histories are random prefixes of the corpus lines, scored without a cache.
+    returns: The measurements, latencies in seconds.
+    """
+    rng = np.random.default_rng(seed)
+    lines = [corpus[index] for index in rng.integers(0, len(corpus), size=query_count).tolist()]
+    histories = [[multigram.vocabulary[TokenString.Intern(word)].TokenId for word in line[:rng.integers(1, len(line) + 1)]]
+                 for line in lines]
+
+    scorer = NextTokenScorer(multigram, 'intersect', cache_size=0)
+    _, single_seconds = Timed(lambda: [scorer.BestNextToken(history) for history in histories])
+    _, batch_seconds = Timed(lambda: scorer.BestNextTokens(histories))
+
+    generator, tables_seconds = Timed(lambda: SentenceGenerator(multigram, seed=seed))
+    sequences, sample_seconds = Timed(lambda: generator.Sample(query_count, max_length=20))
+    beam_prompts = histories[:10]
+    _, beam_seconds = Timed(lambda: [generator.BeamSearch(history, beam_width=4, max_length=10) for history in beam_prompts])
+
+    return {
+        'best_next_token_seconds': single_seconds / len(histories),
+        'best_next_token_batch_seconds': batch_seconds / len(histories),
+        'generator_tables_seconds': tables_seconds,
+        'sample_sequence_seconds': sample_seconds / query_count,
+        'sample_tokens_per_second': sum(len(sequence) for sequence in sequences) / sample_seconds,
+        'beam_search_seconds': beam_seconds / len(beam_prompts),
+    }
+
+
+def Environment() -> dict:
+    """
+    What the benchmarks ran on, so results of different versions can be compared.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+    }
+
+
+def RunSuite(vocabulary_sizes=(1000, 10000, 50000), line_count: int = 20000, min_line_length: int = 4,
+             max_line_length: int = 16, exponent: float = 1.1, seed: int = 0, measure_memory: bool = True,
+             allocation_count: int = 100000) -> dict:
+    """
+    Run every benchmark on a Zipfian corpus of each vocabulary size.
+    returns: The environment, the parameters, and the measurements by case.
+    """
+    parameters = {
+        'vocabulary_sizes': list(vocabulary_sizes),
+        'line_count': line_count,
+        'min_line_length': min_line_length,
+        'max_line_length': max_line_length,
+        'exponent': exponent,
+        'seed': seed,
+        'allocation_count': allocation_count,
+    }
+
+    cases = {'token_allocation_' + case: measurements for case, measurements in BenchmarkTokenAllocation(allocation_count).items()}
+    for vocabulary_size in vocabulary_sizes:
+        corpus = ZipfCorpus(vocabulary_size, line_count, min_line_length, max_line_length, exponent, seed)
+        multigram, ingestion = BenchmarkIngestion(corpus, measure_memory)
+        cases[f'vocabulary_{vocabulary_size}'] = ingestion | BenchmarkQueries(multigram, corpus, seed=seed)
+
+    return {'environment': Environment(), 'parameters': parameters, 'cases': cases}
+
+
+def WriteResults(results: dict, filename: str) -> None:
+    """
+    Write benchmark results as JSON, to compare with other versions.
+    """
+    with open(filename, 'w') as file:
+        json.dump(results, file, indent=2)
+
+
+def PrintResults(results: dict) -> None:
+    """
+    Print benchmark results, one case per line.
+    """
+    for case, measurements in results.items():
+        values = ', '.join(f'{name}={value:.4g}' for name, value in measurements.items())
+        print(f'{case:24} {values}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark MultiGram ingestion, scoring and generation.')
+    parser.add_argument('--vocabulary-sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--min-line-length', type=int, default=4)
+    parser.add_argument('--max-line-length', type=int, default=16)
+    parser.add_argument('--exponent', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='Skip the traced runs measuring peak memory.')
+    parser.add_argument('--output', default='benchmark_results.json')
+    arguments = parser.parse_args()
+
+    results = RunSuite(arguments.vocabulary_sizes, arguments.lines, arguments.min_line_length, arguments.max_line_length,
+                       arguments.exponent, arguments.seed, not arguments.no_memory)
+    PrintResults(results['cases'])
+    WriteResults(results, arguments.output)
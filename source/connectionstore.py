@@ -0,0 +1,562 @@
+import math
+import numpy as np
+from settings import Settings
+from countminsketch import CountMinSketch
+
+
+class ConnectionStore:
+    """
+    Connection strengths between the tokens of one MultiGram, keyed by
+    integer (source token id, distance, target token id).
+    Bumps are kept as batches of sorted keys and counts per distance.
+    Reads work from per-distance CSR arrays: for distance d, the
+    connections of source s are the entries indptr[d][s]:indptr[d][s + 1]
+    of indices (target ids), strengths and softmax, with targets sorted
+    within each row.  Pending batches are merged into the CSR arrays by
+    Compact, which reads do on demand.
+    Softmax strengths are kept current incrementally: each row keeps
+    its maximum and log-sum-exp, and bumping a row only marks it dirty,
+    so a read recomputes just the rows touched since the last read.
+    Besides the target-sorted rows, which answer whether a token follows
+    another with a binary search, each distance keeps a strength-sorted
+    view of every row, built when first read after a compaction, so the
+    top k successors of a token are a slice of k entries.
+    The bumps of a whole window of recent tokens are staged as one array
+    write, and sorted into the per-distance batches when read.
+    Every change to the connections advances version, so results
+    derived from them can be cached and checked for staleness.
+    With top_k > 0, the store is bounded: compaction keeps only the top_k
+    strongest connections of each (source, distance) row exactly, and
+    adds the strength of the rest to a count-min sketch per distance.
+    A pruned connection that is bumped again comes back with its sketch
+    estimate as its strength, and is promoted if that beats the weakest
+    kept connection of its row.  Each kept connection remembers how much
+    of its strength the sketch already holds (sketch_base), so demoting
+    it again adds only the rest.  Softmax covers the kept connections.
+    Token ids are reused after eviction, so sketch keys are salted with
+    how often their source and target ids were removed, and a token
+    given a reused id starts without the tail of the token before it.
+    """
+    # The methods timed by MultiGram.EnableProfiling.
+    profiled_methods = ['BumpWindow', 'FlushWindow', 'BumpMany', 'CompactDistance', 'RefreshSoftmax', 'RemoveTokens']
+    target_bits = 32
+    target_mask = (1 << target_bits) - 1
+    min_compact_size = 1 << 16
+    window_capacity = 1 << 16
+    dirty_batch_limit = 64
+    # Odd multipliers mixing the removal counts of a connection's ids into its sketch key.
+    source_salt = np.uint64(0x9E3779B97F4A7C15)
+    target_salt = np.uint64(0xC2B2AE3D27D4EB4F)
+
+    def __init__(self, max_distance: int = Settings.max_token_strength, top_k: int = Settings.max_connections_per_row,
+                 sketch_width: int = Settings.sketch_width, sketch_depth: int = Settings.sketch_depth):
+        self.max_distance = max_distance
+        self.top_k = top_k
+        self.version = 0
+
+        self.pending_batches = [[] for _ in range(max_distance)]
+        self.pending_batch_size = [0 for _ in range(max_distance)]
+        self.indptr = [np.zeros(1, dtype=np.int64) for _ in range(max_distance)]
+        self.indices = [np.zeros(0, dtype=np.int32) for _ in range(max_distance)]
+        self.strengths = [np.zeros(0, dtype=np.int32) for _ in range(max_distance)]
+        self.softmax = [np.zeros(0, dtype=np.float32) for _ in range(max_distance)]
+
+        # Per-row maximum and log-sum-exp of the scaled strengths, and the rows bumped since they were computed.
+        self.row_max = [np.zeros(0) for _ in range(max_distance)]
+        self.row_log_sum_exp = [np.zeros(0) for _ in range(max_distance)]
+        self.dirty_row_batches = [[] for _ in range(max_distance)]
+
+        # Positions of each row's connections, strongest first, or None until needed.
+        self.successor_order = [None for _ in range(max_distance)]
+
+        # The pruned tail of a bounded store.
+        self.sketches = [CountMinSketch(sketch_width, sketch_depth) for _ in range(max_distance)] if top_k > 0 else None
+        self.sketch_base = [np.zeros(0, dtype=np.int64) for _ in range(max_distance)] if top_k > 0 else None
+        self.removal_counts = np.zeros(0, dtype=np.int64)
+
+        # Window bumps not yet sorted into the batches of their distance.
+        self.window_keys = np.zeros(ConnectionStore.window_capacity, dtype=np.int64)
+        self.window_distances = np.zeros(ConnectionStore.window_capacity, dtype=np.int64)
+        self.window_fill = 0
+        self.window_offsets = np.arange(1, max_distance + 1, dtype=np.int64)
+
+
+    def BumpWindow(self, sources: np.ndarray, target: int) -> None:
+        """
+        Strengthen the connections from a window of recent tokens to one
+        token, the token at index i of the window at distance i + 1.
+        sources: Array of preceding token ids, nearest first, at most max_distance of them
+        target: Id of the following token
+        """
+        count = len(sources)
+        if self.window_fill + count > ConnectionStore.window_capacity:
+            self.FlushWindow()
+
+        end = self.window_fill + count
+        self.window_keys[self.window_fill:end] = (sources << ConnectionStore.target_bits) | target
+        self.window_distances[self.window_fill:end] = self.window_offsets[:count]
+        self.window_fill = end
+        self.version += 1
+
+
+    def FlushWindow(self) -> None:
+        """
+        Sort the staged window bumps into the pending batches of their distances.
+        """
+        if self.window_fill == 0:
+            return
+
+        keys = self.window_keys[:self.window_fill]
+        distances = self.window_distances[:self.window_fill]
+        self.window_fill = 0
+
+        order = np.argsort(distances, kind='stable')
+        bounds = np.searchsorted(distances[order], np.arange(1, self.max_distance + 2))
+        for distance in range(1, self.max_distance + 1):
+            start, end = bounds[distance - 1], bounds[distance]
+            if start < end:
+                self.BumpKeys(distance, keys[order[start:end]])
+
+
+    def BumpMany(self, distance: int, sources: np.ndarray, targets: np.ndarray, counts: np.ndarray = None) -> None:
+        """
+        Strengthen many connections at one distance.
+        The same (source, target) pair may appear several times, and is
+        strengthened once for every appearance.
+        distance: How far each target token follows its source token, from 1
+        sources: Array of preceding token ids
+        targets: Array of following token ids, one per source
+        counts: How much to strengthen each connection, one each if None
+        """
+        if len(sources) == 0:
+            return
+
+        keys = (np.asarray(sources, dtype=np.int64) << ConnectionStore.target_bits) | np.asarray(targets, dtype=np.int64)
+        self.BumpKeys(distance, keys, counts)
+        self.version += 1
+
+
+    def BumpKeys(self, distance: int, keys: np.ndarray, counts: np.ndarray = None) -> None:
+        """
+        Strengthen many connections at one distance, given as (source << target_bits) | target keys.
+        This does not advance version, as it also sorts staged window bumps that already did.
+        """
+        d = distance - 1
+        if counts is None:
+            keys, counts = np.unique(keys, return_counts=True)
+        else:
+            keys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+        self.pending_batches[d].append((keys, counts))
+        self.pending_batch_size[d] += len(keys)
+        self.MarkRowsDirty(d, np.unique(keys >> ConnectionStore.target_bits))
+
+        if self.pending_batch_size[d] > ConnectionStore.min_compact_size and self.pending_batch_size[d] > len(self.indices[d]) // 4:
+            self.CompactDistance(distance)
+
+
+    def Compact(self) -> None:
+        """
+        Merge all pending bumps into the CSR arrays.
+        """
+        for distance in range(1, self.max_distance + 1):
+            self.CompactDistance(distance)
+
+
+    def CompactDistance(self, distance: int) -> None:
+        """
+        Merge the pending bumps at one distance into its CSR arrays.
+        Softmax values of existing connections are kept as they were,
+        every bumped row is recomputed by the next RefreshSoftmax.
+        distance: The distance to compact, from 1
+        """
+        self.FlushWindow()
+        d = distance - 1
+        if len(self.pending_batches[d]) == 0:
+            return
+
+        pending_keys = np.concatenate([keys for keys, _ in self.pending_batches[d]])
+        pending_counts = np.concatenate([counts for _, counts in self.pending_batches[d]])
+
+        self.pending_batches[d] = []
+        self.pending_batch_size[d] = 0
+        self.successor_order[d] = None
+
+        indptr = self.indptr[d]
+        rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+        existing_keys = (rows << ConnectionStore.target_bits) | self.indices[d]
+
+        keys, inverse = np.unique(np.concatenate((existing_keys, pending_keys)), return_inverse=True)
+        strengths = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(strengths, inverse, np.concatenate((self.strengths[d], pending_counts)))
+        softmax = np.zeros(len(keys), dtype=np.float32)
+        softmax[inverse[:len(existing_keys)]] = self.softmax[d]
+
+        if self.top_k > 0:
+            keys, strengths, softmax = self.PruneRows(distance, keys, strengths, softmax, inverse[:len(existing_keys)])
+
+        sources = keys >> ConnectionStore.target_bits
+        row_count = max(len(indptr) - 1, int(sources[-1]) + 1)
+        self.indptr[d] = np.zeros(row_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=row_count), out=self.indptr[d][1:])
+        self.indices[d] = (keys & ConnectionStore.target_mask).astype(np.int32)
+        self.strengths[d] = strengths.astype(np.int32)
+        self.softmax[d] = softmax
+
+        grown_rows = row_count - len(self.row_max[d])
+        if grown_rows > 0:
+            self.row_max[d] = np.concatenate((self.row_max[d], np.zeros(grown_rows)))
+            self.row_log_sum_exp[d] = np.concatenate((self.row_log_sum_exp[d], np.zeros(grown_rows)))
+
+
+    def PruneRows(self, distance: int, keys, strengths, softmax, existing_positions):
+        """
+        Bound the merged connections at one distance to top_k per row.
+        Connections new to the arrays take their sketch estimate, which
+        includes their earlier pruned strength, and every row keeps its
+        top_k strongest, existing connections first among equals.  The
+        strength of the rest not yet in the sketch is added to it.
+        distance: The distance being compacted, from 1
+        keys, strengths, softmax: The merged connections, sorted by key
+        existing_positions: Where the connections already in the arrays are among keys
+        returns: The kept keys, strengths and softmax
+        """
+        d = distance - 1
+        sketch = self.sketches[d]
+        existing = np.zeros(len(keys), dtype=bool)
+        existing[existing_positions] = True
+        base = np.zeros(len(keys), dtype=np.int64)
+        base[existing_positions] = self.sketch_base[d]
+
+        sketch_keys = self.SketchKeys(keys)
+        new = np.flatnonzero(~existing)
+        sketch.Add(sketch_keys[new], strengths[new])
+        strengths[new] = sketch.Estimate(sketch_keys[new])
+        base[new] = strengths[new]
+
+        # Rank the connections of each row, strongest first.
+        sources = keys >> ConnectionStore.target_bits
+        order = np.lexsort((keys, ~existing, -strengths, sources))
+        row_starts = np.searchsorted(sources[order], sources[order], side='left')
+        kept = np.zeros(len(keys), dtype=bool)
+        kept[order] = np.arange(len(keys)) - row_starts < self.top_k
+
+        demoted = np.flatnonzero(~kept)
+        sketch.Add(sketch_keys[demoted], strengths[demoted] - base[demoted])
+        self.MarkRowsDirty(d, np.unique(sources[demoted[existing[demoted]]]))
+
+        self.sketch_base[d] = base[kept]
+        return keys[kept], strengths[kept], softmax[kept]
+
+
+    def TailEstimate(self, source: int, distance: int, target: int) -> int:
+        """
+        The sketch estimate of the strength of a connection pruned from a bounded store.
+        """
+        if self.sketches is None:
+            return 0
+
+        key = (source << ConnectionStore.target_bits) | target
+        return int(self.sketches[distance - 1].Estimate(self.SketchKeys(np.array([key], dtype=np.int64)))[0])
+
+
+    def SketchKeys(self, keys: np.ndarray) -> np.ndarray:
+        """
+        The keys of connections in the sketches, salted with how often their source and target ids were removed.
+        keys: Connection keys, (source << target_bits) | target
+        returns: The sketch keys, the same as keys for ids never removed
+        """
+        removal_counts = self.removal_counts
+        if len(removal_counts) == 0:
+            return keys
+
+        def RemovalCounts(token_ids):
+            counts = np.zeros(len(token_ids), dtype=np.uint64)
+            known = token_ids < len(removal_counts)
+            counts[known] = removal_counts[token_ids[known]]
+            return counts
+
+        sources = keys >> ConnectionStore.target_bits
+        targets = keys & ConnectionStore.target_mask
+        with np.errstate(over='ignore'):
+            salt = RemovalCounts(sources) * ConnectionStore.source_salt + RemovalCounts(targets) * ConnectionStore.target_salt
+            return (keys.view(np.uint64) + salt).view(np.int64)
+
+
+    def TailErrorBound(self, distance: int) -> tuple[float, float]:
+        """
+        How far the estimated strength of a pruned connection at one distance
+        may exceed its true strength, and the probability that it does not.
+        returns: The error bound, and its confidence, both zero for an exact store
+        """
+        if self.sketches is None:
+            return 0.0, 0.0
+
+        self.CompactDistance(distance)
+        sketch = self.sketches[distance - 1]
+        return sketch.ErrorBound(), sketch.Confidence()
+
+
+    def RemoveTokens(self, token_ids: np.ndarray) -> None:
+        """
+        Remove every connection from or to any of the given tokens.
+        Rows that lose connections have their softmax recomputed on the next read.
+        In a bounded store, the ids count as removed once more, so their
+        pruned tail is not found again when the ids are reused.
+        token_ids: Array of ids of the tokens to remove
+        """
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        self.version += 1
+        for distance in range(1, self.max_distance + 1):
+            sources, targets, _ = self.GetCoo(distance)
+            removed = np.isin(sources, token_ids) | np.isin(targets, token_ids)
+            if not removed.any():
+                continue
+
+            d = distance - 1
+            kept = ~removed
+            self.successor_order[d] = None
+            row_count = len(self.indptr[d]) - 1
+            self.indptr[d] = np.zeros(row_count + 1, dtype=np.int64)
+            np.cumsum(np.bincount(sources[kept], minlength=row_count), out=self.indptr[d][1:])
+            self.indices[d] = self.indices[d][kept]
+            self.strengths[d] = self.strengths[d][kept]
+            self.softmax[d] = self.softmax[d][kept]
+            if self.sketch_base is not None:
+                self.sketch_base[d] = self.sketch_base[d][kept]
+            self.MarkRowsDirty(d, np.unique(sources[removed]))
+
+        if self.sketches is not None and len(token_ids) > 0:
+            if token_ids.max() >= len(self.removal_counts):
+                grown = np.zeros(max(1024, 2 * int(token_ids.max()) + 2), dtype=np.int64)
+                grown[:len(self.removal_counts)] = self.removal_counts
+                self.removal_counts = grown
+            np.add.at(self.removal_counts, token_ids, 1)
+
+
+    def MarkRowsDirty(self, d: int, rows: np.ndarray) -> None:
+        """
+        Remember rows whose softmax is recomputed on the next read.  Once
+        there are dirty_batch_limit batches, they are merged into one, so
+        rows bumped again and again while nothing reads the softmax take
+        no more room than the rows themselves.
+        """
+        batches = self.dirty_row_batches[d]
+        batches.append(rows)
+        if len(batches) >= ConnectionStore.dirty_batch_limit:
+            self.dirty_row_batches[d] = [np.unique(np.concatenate(batches))]
+
+
+    def SetArrays(self, distance: int, indptr, indices, strengths, softmax, row_max, row_log_sum_exp,
+                  sketch_base=None, sketch_table=None, sketch_total: int = 0) -> None:
+        """
+        Replace all connections at one distance with compacted arrays, as
+        loaded from a snapshot.  The arrays may be read-only memory maps;
+        they are copied only if they would have to be modified.
+        distance: The distance of the connections, from 1
+        sketch_base, sketch_table, sketch_total: The pruned tail, for a bounded store
+        """
+        self.FlushWindow()
+        self.version += 1
+        d = distance - 1
+        self.pending_batches[d] = []
+        self.pending_batch_size[d] = 0
+        self.dirty_row_batches[d] = []
+        self.successor_order[d] = None
+
+        self.indptr[d] = indptr
+        self.indices[d] = indices
+        self.strengths[d] = strengths
+        self.softmax[d] = softmax
+        self.row_max[d] = row_max
+        self.row_log_sum_exp[d] = row_log_sum_exp
+        if self.sketches is not None:
+            self.sketch_base[d] = sketch_base if sketch_base is not None else np.zeros(len(indices), dtype=np.int64)
+            if sketch_table is not None:
+                depth, width = sketch_table.shape
+                if (depth, width) != self.sketches[d].table.shape:
+                    self.sketches[d] = CountMinSketch(width, depth)
+                self.sketches[d].table = sketch_table
+                self.sketches[d].total = sketch_total
+
+
+    def Row(self, source: int, distance: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        All connections from one source token at one distance.
+        source: Id of the preceding token
+        distance: How far the following tokens follow the source token, from 1
+        returns: Arrays of target ids, strengths and softmax strengths
+        """
+        self.RefreshSoftmax(distance)
+
+        d = distance - 1
+        indptr = self.indptr[d]
+        if source < 0 or source >= len(indptr) - 1:
+            return self.indices[d][:0], self.strengths[d][:0], self.softmax[d][:0]
+
+        start, end = indptr[source], indptr[source + 1]
+        return self.indices[d][start:end], self.strengths[d][start:end], self.softmax[d][start:end]
+
+
+    def Find(self, source: int, distance: int, target: int) -> int:
+        """
+        Find the position of one connection in the compacted arrays.
+        source: Id of the preceding token
+        distance: How far the target token follows the source token, from 1
+        target: Id of the following token
+        returns: Index into the arrays at this distance, or -1 if not connected
+        """
+        self.CompactDistance(distance)
+
+        indptr = self.indptr[distance - 1]
+        if source < 0 or source >= len(indptr) - 1:
+            return -1
+
+        start, end = int(indptr[source]), int(indptr[source + 1])
+        position = start + int(np.searchsorted(self.indices[distance - 1][start:end], target))
+        if position < end and self.indices[distance - 1][position] == target:
+            return position
+
+        return -1
+
+
+    def IsSuccessor(self, source: int, distance: int, target: int) -> bool:
+        """
+        True if the target token follows the source token at the given distance.
+        """
+        return self.Find(source, distance, target) >= 0
+
+
+    def SuccessorOrder(self, distance: int) -> np.ndarray:
+        """
+        The strength-sorted view of the rows at one distance: for each row,
+        the positions of its connections, strongest first, ties by target.
+        Row s of the view is entries indptr[s]:indptr[s + 1], as in the arrays.
+        """
+        self.CompactDistance(distance)
+
+        d = distance - 1
+        if self.successor_order[d] is None:
+            rows = np.repeat(np.arange(len(self.indptr[d]) - 1, dtype=np.int64), np.diff(self.indptr[d]))
+            self.successor_order[d] = np.lexsort((self.indices[d], -self.strengths[d].astype(np.int64), rows))
+
+        return self.successor_order[d]
+
+
+    def TopSuccessors(self, source: int, distance: int, k: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The strongest connections from one source token at one distance, strongest first.
+        source: Id of the preceding token
+        distance: How far the following tokens follow the source token, from 1
+        k: How many connections at most, or 0 for all of them
+        returns: Arrays of target ids, strengths and softmax strengths
+        """
+        order = self.SuccessorOrder(distance)
+        self.RefreshSoftmax(distance)
+
+        d = distance - 1
+        indptr = self.indptr[d]
+        if source < 0 or source >= len(indptr) - 1:
+            return self.indices[d][:0], self.strengths[d][:0], self.softmax[d][:0]
+
+        start, end = int(indptr[source]), int(indptr[source + 1])
+        if k > 0:
+            end = min(end, start + k)
+
+        positions = order[start:end]
+        return self.indices[d][positions], self.strengths[d][positions], self.softmax[d][positions]
+
+
+    def GetCoo(self, distance: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        All connections at one distance in coordinate form.
+        distance: The distance of the connections, from 1
+        returns: Arrays of source ids, target ids and strengths
+        """
+        self.CompactDistance(distance)
+
+        d = distance - 1
+        sources = np.repeat(np.arange(len(self.indptr[d]) - 1, dtype=np.int64), np.diff(self.indptr[d]))
+        return sources, self.indices[d].astype(np.int64), self.strengths[d].astype(np.int64)
+
+
+    def Strength(self, source: int, distance: int, target: int) -> int:
+        """
+        The strength of one connection, zero if the tokens are not connected.
+        """
+        position = self.Find(source, distance, target)
+        return int(self.strengths[distance - 1][position]) if position >= 0 else 0
+
+
+    def SoftmaxStrength(self, source: int, distance: int, target: int) -> float:
+        """
+        The softmax strength of one connection, zero if the tokens are not connected.
+        """
+        self.RefreshSoftmax(distance)
+        position = self.Find(source, distance, target)
+        return float(self.softmax[distance - 1][position]) if position >= 0 else 0.0
+
+
+    def Softmax(self) -> None:
+        """
+        Bring the softmax strengths of every row at every distance up to date.
+        """
+        for distance in range(1, self.max_distance + 1):
+            self.RefreshSoftmax(distance)
+
+
+    def RefreshSoftmax(self, distance: int) -> None:
+        """
+        Recompute the softmax of the rows at one distance that were bumped
+        since they were last computed.  For each row, the maximum scaled
+        strength is subtracted before exponentiation, so large strengths
+        do not overflow, and the row's maximum and log-sum-exp are kept.
+        distance: The distance to refresh, from 1
+        """
+        self.FlushWindow()
+        d = distance - 1
+        if len(self.dirty_row_batches[d]) == 0:
+            return
+
+        self.CompactDistance(distance)
+        rows = np.unique(np.concatenate(self.dirty_row_batches[d]))
+        self.dirty_row_batches[d] = []
+
+        indptr = self.indptr[d]
+        lengths = indptr[rows + 1] - indptr[rows]
+        rows = rows[lengths > 0]
+        lengths = lengths[lengths > 0]
+        if len(rows) == 0:
+            return
+
+        # Positions of all connections of the dirty rows, and the offset of each row among them.
+        offsets = np.zeros(len(rows), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        row_of_position = np.repeat(np.arange(len(rows)), lengths)
+        positions = np.arange(lengths.sum()) - offsets[row_of_position] + indptr[rows][row_of_position]
+
+        scaled = self.strengths[d][positions] * math.log(Settings.softmax_base)
+        row_max = np.maximum.reduceat(scaled, offsets)
+        row_log_sum_exp = row_max + np.log(np.add.reduceat(np.exp(scaled - row_max[row_of_position]), offsets))
+
+        if not self.row_max[d].flags.writeable:
+            # Row statistics loaded from a memory-mapped snapshot are copied on first write.
+            self.row_max[d] = self.row_max[d].copy()
+            self.row_log_sum_exp[d] = self.row_log_sum_exp[d].copy()
+
+        self.softmax[d][positions] = np.exp(scaled - row_log_sum_exp[row_of_position])
+        self.row_max[d][rows] = row_max
+        self.row_log_sum_exp[d][rows] = row_log_sum_exp
+
+
+    def ConnectionCount(self, distance: int = 0) -> int:
+        """
+        Count connections, at one distance or, with distance 0, at all distances.
+        """
+        distances = [distance] if distance > 0 else range(1, self.max_distance + 1)
+        count = 0
+        for a_distance in distances:
+            self.CompactDistance(a_distance)
+            count += len(self.indices[a_distance - 1])
+
+        return count
@@ -0,0 +1,79 @@
+import math
+import numpy as np
+
+
+class CountMinSketch:
+    """
+    A count-min sketch of integer keys: depth rows of width counters,
+    each row indexed by its own multiply-shift hash of the key.  Adding
+    a count adds it to one counter per row, and the estimate of a key is
+    the smallest of its counters, so estimates never fall below the true
+    count, and exceed it by at most ErrorBound with probability
+    1 - exp(-depth).  Memory is fixed, whatever the number of keys.
+    """
+    def __init__(self, width: int = 1 << 14, depth: int = 4, seed: int = 0):
+        self.width_bits = max(1, int(width - 1).bit_length())
+        self.width = 1 << self.width_bits
+        self.depth = depth
+        self.table = np.zeros((depth, self.width), dtype=np.int64)
+        self.total = 0
+
+        # Odd multipliers for multiply-shift hashing, the same in every process for the same seed.
+        rng = np.random.default_rng(seed)
+        self.multipliers = rng.integers(1, 1 << 63, size=depth, dtype=np.uint64) | np.uint64(1)
+
+
+    def Columns(self, keys: np.ndarray) -> np.ndarray:
+        """
+        The counter of each key in each row.
+        returns: A (depth, len(keys)) array of column indices.
+        """
+        keys = np.asarray(keys, dtype=np.int64).view(np.uint64)
+        with np.errstate(over='ignore'):
+            hashed = keys[np.newaxis, :] * self.multipliers[:, np.newaxis]
+        return (hashed >> np.uint64(64 - self.width_bits)).astype(np.int64)
+
+
+    def Add(self, keys: np.ndarray, counts: np.ndarray) -> None:
+        """
+        Add counts to the keys.  Keys may repeat.
+        """
+        if len(keys) == 0:
+            return
+
+        if not self.table.flags.writeable:
+            # A sketch loaded from a memory-mapped snapshot is copied on first write.
+            self.table = self.table.copy()
+
+        counts = np.asarray(counts, dtype=np.int64)
+        columns = self.Columns(keys)
+        for row in range(self.depth):
+            np.add.at(self.table[row], columns[row], counts)
+        self.total += int(counts.sum())
+
+
+    def Estimate(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Estimate the total count of each key.
+        returns: An array of estimates, never below the true counts.
+        """
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        columns = self.Columns(keys)
+        return self.table[np.arange(self.depth)[:, np.newaxis], columns].min(axis=0)
+
+
+    def ErrorBound(self) -> float:
+        """
+        How far an estimate may exceed the true count, with probability
+        at least Confidence: e / width of the total count added.
+        """
+        return math.e / self.width * self.total
+
+
+    def Confidence(self) -> float:
+        """
+        The probability that an estimate is within ErrorBound of the true count.
+        """
+        return 1.0 - math.exp(-self.depth)
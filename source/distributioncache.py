@@ -0,0 +1,84 @@
+from collections import OrderedDict
+
+
+class DistributionCache:
+    """
+    A bounded least-recently-used cache of next-token distributions,
+    keyed by the part of a history a distribution depends on.  Every
+    entry was computed at one version of a ConnectionStore; when the
+    store's version moves on, the whole cache is dropped, so a hit never
+    returns a distribution of older connections.  Entries are shared by
+    every caller asking for the same key, so must not be modified.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+    def Validate(self, version: int) -> None:
+        """
+        Drop every entry if the connections have changed since they were cached.
+        version: The current version of the connections.
+        """
+        if version != self.version:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+                self.entries.clear()
+            self.version = version
+
+
+    def Get(self, key):
+        """
+        The cached distribution for a key, or None, counting the hit or miss.
+        """
+        distribution = self.entries.get(key)
+        if distribution is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return distribution
+
+
+    def Put(self, key, distribution) -> None:
+        """
+        Cache the distribution for a key, evicting the least recently used entries beyond capacity.
+        """
+        self.entries[key] = distribution
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def HitRate(self) -> float:
+        """
+        The fraction of lookups that were hits, 0 before any lookup.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+
+    def Statistics(self) -> dict:
+        """
+        The cache counters, for sizing the cache.
+        """
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.HitRate(),
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,194 @@
+import argparse
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+
+from settings import Settings
+from tokenstring import TokenString
+from nexttokenscorer import NextTokenScorer
+from multigramsnapshot import MultiGramSnapshot
+from shardedtrainer import DatasetShards, CSVStreamShards
+
+
+class Evaluator:
+    """
+    Evaluate a trained MultiGram on held-out input, without changing it.
+    Every token of every line is predicted from the tokens before it in
+    the line, after the start-of-sequence token, as in training.  The
+    scores of a NextTokenScorer, over the candidates it counts, are taken
+    as next-token probabilities, mixed with a uniform distribution over
+    the vocabulary and one unknown token, in proportion smoothing, so
+    that tokens the multigram never saw in that place, or at all, still
+    have a finite log-likelihood.  Predictions are scored in batches.
+    Held-out input can be split into shards, each evaluated in its own
+    worker process on the multigram loaded, memory-mapped, from a snapshot.
+    """
+    def __init__(self, mode: str = 'support', top_k=(1, 5, 10), smoothing: float = 0.01, batch_size: int = 64,
+                 workers: int = os.cpu_count()):
+        if not 0.0 < smoothing <= 1.0:
+            raise ValueError(f'The smoothing must be in (0, 1], not {smoothing}.')
+
+        self.mode = mode
+        self.top_k = tuple(top_k)
+        self.smoothing = smoothing
+        self.batch_size = batch_size
+        self.workers = workers
+
+
+    def Predictions(self, multigram, source):
+        """
+        The (history, next token) predictions of every line of a source.
+        Tokens the multigram does not know have id -1.
+        returns: A generator of (list of token ids, token id) pairs.
+        """
+        start_token = multigram.FindToken(TokenString(Settings.StartOfSequenceTokenValue), threshold_score = 1.0)
+        start = [start_token.TokenId] if start_token is not None else []
+
+        while True:
+            tokens = source.GetNextLine()
+            if len(tokens) == 0:
+                return
+
+            # Tokens are looked up without interning them, so unseen tokens do not grow the interning table.
+            found_tokens = [multigram.vocabulary.get(token.FindInternId()) for token in tokens]
+            line = start + [token.TokenId if token is not None else -1 for token in found_tokens]
+            for position in range(len(start), len(line)):
+                yield line[:position], line[position]
+
+
+    def Score(self, scorer: NextTokenScorer, histories, targets, totals: dict) -> None:
+        """
+        Add the log-likelihood and top-k hits of one batch of predictions to the totals.
+        """
+        scores = scorer.ScoreBatch(histories)
+        rows = np.arange(len(targets))
+        targets = np.asarray(targets, dtype=np.int64)
+        known = targets >= 0
+        candidates = np.isfinite(scores)
+
+        # The smoothed probability of each target.
+        sums = np.where(candidates, scores, 0.0).sum(axis=1)
+        target_scores = np.where(known, scores[rows, np.maximum(targets, 0)], -np.inf)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            model = np.where(np.isfinite(target_scores) & (sums > 0.0), target_scores / sums, 0.0)
+        probabilities = (1.0 - self.smoothing) * model + self.smoothing / (scores.shape[1] + 1)
+
+        # The rank of each target among the candidates, ties to the lowest id, as BestNextTokens breaks them.
+        higher = (scores > target_scores[:, np.newaxis]).sum(axis=1)
+        tied_before = ((scores == target_scores[:, np.newaxis]) & (np.arange(scores.shape[1]) < targets[:, np.newaxis])).sum(axis=1)
+        ranks = np.where(np.isfinite(target_scores), higher + tied_before, scores.shape[1])
+
+        totals['tokens'] += len(targets)
+        totals['unknown_tokens'] += int((~known).sum())
+        totals['log_likelihood'] += float(np.log(probabilities).sum())
+        for k in self.top_k:
+            totals['top_k_hits'][k] += int((ranks < k).sum())
+
+
+    def EvaluateSource(self, multigram, source) -> dict:
+        """
+        Evaluate a multigram on every line of a token source.
+        returns: The totals, to be combined with those of other sources by Summarize.
+        """
+        scorer = NextTokenScorer(multigram, self.mode, cache_size=0)
+        totals = {'tokens': 0, 'unknown_tokens': 0, 'log_likelihood': 0.0, 'top_k_hits': {k: 0 for k in self.top_k}}
+
+        histories, targets = [], []
+        for history, target in self.Predictions(multigram, source):
+            histories.append(history)
+            targets.append(target)
+            if len(histories) == self.batch_size:
+                self.Score(scorer, histories, targets, totals)
+                histories, targets = [], []
+
+        if len(histories) > 0:
+            self.Score(scorer, histories, targets, totals)
+        return totals
+
+
+    def Evaluate(self, multigram, source) -> dict:
+        """
+        Evaluate a multigram on a token source, in this process.
+        returns: The summary of the evaluation, see Summarize.
+        """
+        return Evaluator.Summarize([self.EvaluateSource(multigram, source)])
+
+
+    def EvaluateSnapshot(self, filename: str, shard_sources) -> dict:
+        """
+        Evaluate a multigram snapshot on shards of held-out input, using up to self.workers processes.
+        filename: The snapshot of the trained multigram.
+        shard_sources: Picklable callables making the token source of each shard, see DatasetShards and CSVStreamShards.
+        returns: The summary of the evaluation, see Summarize.
+        """
+        if self.workers <= 1 or len(shard_sources) <= 1:
+            return Evaluator.Summarize(list(map(EvaluateShard, repeat(self), repeat(filename), shard_sources)))
+
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(shard_sources))) as pool:
+            return Evaluator.Summarize(list(pool.map(EvaluateShard, repeat(self), repeat(filename), shard_sources)))
+
+
+    @staticmethod
+    def Summarize(results: list[dict]) -> dict:
+        """
+        Combine the totals of several sources.
+        returns: The number of tokens predicted, the fraction unknown to the multigram,
+                 the mean log-likelihood per token (natural log), the perplexity,
+                 and the top-k accuracy for each k.
+        """
+        tokens = sum(result['tokens'] for result in results)
+        log_likelihood = sum(result['log_likelihood'] for result in results)
+        hits = {}
+        for result in results:
+            for k, count in result['top_k_hits'].items():
+                hits[k] = hits.get(k, 0) + count
+
+        mean_log_likelihood = log_likelihood / tokens if tokens > 0 else 0.0
+        return {
+            'tokens': tokens,
+            'unknown_rate': sum(result['unknown_tokens'] for result in results) / tokens if tokens > 0 else 0.0,
+            'log_likelihood': log_likelihood,
+            'mean_log_likelihood': mean_log_likelihood,
+            'perplexity': math.exp(-mean_log_likelihood),
+            'top_k_accuracy': {k: count / tokens if tokens > 0 else 0.0 for k, count in hits.items()},
+        }
+
+
+def EvaluateShard(evaluator: Evaluator, filename: str, make_source) -> dict:
+    """
+    Evaluate a multigram snapshot on one shard of held-out input, in a worker process.
+    returns: The totals of the shard.
+    """
+    multigram = MultiGramSnapshot.Load(filename)
+    return evaluator.EvaluateSource(multigram, make_source())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate a MultiGram snapshot on held-out input.')
+    parser.add_argument('snapshot', help='The snapshot of the trained multigram.')
+    parser.add_argument('--log', help='Evaluate on the lines of a log file.')
+    parser.add_argument('--dataset', help='Evaluate on stories of a Hugging Face dataset.')
+    parser.add_argument('--split', default='validation')
+    parser.add_argument('--first-story', type=int, default=0)
+    parser.add_argument('--stories', type=int, default=1000)
+    parser.add_argument('--mode', default='support', choices=NextTokenScorer.modes)
+    parser.add_argument('--top-k', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--smoothing', type=float, default=0.01)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    arguments = parser.parse_args()
+
+    if arguments.log is not None:
+        shards = CSVStreamShards(arguments.log, arguments.workers)
+    elif arguments.dataset is not None:
+        shards = DatasetShards(arguments.dataset, arguments.stories, arguments.workers, arguments.first_story, arguments.split)
+    else:
+        parser.error('Give a --log file or a --dataset to evaluate on.')
+
+    evaluator = Evaluator(arguments.mode, arguments.top_k, arguments.smoothing, workers=arguments.workers)
+    summary = evaluator.EvaluateSnapshot(arguments.snapshot, shards)
+    print(f'{summary["tokens"]} tokens, {summary["unknown_rate"]:.2%} unknown')
+    print(f'Mean log-likelihood {summary["mean_log_likelihood"]:.4f}, perplexity {summary["perplexity"]:.2f}')
+    for k, accuracy in summary['top_k_accuracy'].items():
+        print(f'Top-{k} accuracy {accuracy:.2%}')
@@ -0,0 +1,147 @@
+import json
+import sys
+import time
+
+
+class MetricsSink:
+    """
+    Where MultiGrams, token sources and generators report progress:
+    counters (tokens, lines), gauges (vocabulary size) and messages.
+    This base sink ignores everything, so reporting costs one method
+    call, and is the default.
+    """
+    def Count(self, name: str, amount: int = 1) -> None:
+        """
+        Add to a counter, such as tokens or lines read.
+        """
+        pass
+
+    def Gauge(self, name: str, value: float) -> None:
+        """
+        Set a gauge, such as the vocabulary size.
+        """
+        pass
+
+    def Message(self, text: str) -> None:
+        """
+        Report a one-off event, such as the end of the input.
+        """
+        pass
+
+    def Flush(self) -> None:
+        """
+        Report everything not yet reported.
+        """
+        pass
+
+
+class RateLimitedSink(MetricsSink):
+    """
+    A sink that keeps counters and gauges, and reports them at most once
+    per interval, with the rate of every counter since the last report.
+    Subclasses say how a report is written, in Emit.  Reports are only
+    made when something is counted, so an idle sink costs nothing.
+    """
+    def __init__(self, interval_seconds: float = 5.0):
+        self.interval_seconds = interval_seconds
+        self.counters = {}
+        self.gauges = {}
+        self.start_time = time.monotonic()
+        self.last_report_time = self.start_time
+        self.last_report_counters = {}
+
+
+    def Count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+        if time.monotonic() - self.last_report_time >= self.interval_seconds:
+            self.Flush()
+
+    def Gauge(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+        if time.monotonic() - self.last_report_time >= self.interval_seconds:
+            self.Flush()
+
+    def Flush(self) -> None:
+        self.Emit(self.Report())
+
+
+    def Report(self) -> dict:
+        """
+        The counters, their rates per second since the last report, and the gauges, starting a new interval.
+        """
+        now = time.monotonic()
+        elapsed = max(now - self.last_report_time, 1e-9)
+        rates = {name: (count - self.last_report_counters.get(name, 0)) / elapsed for name, count in self.counters.items()}
+
+        self.last_report_time = now
+        self.last_report_counters = dict(self.counters)
+        return {
+            'elapsed_seconds': now - self.start_time,
+            'counters': dict(self.counters),
+            'rates': rates,
+            'gauges': dict(self.gauges),
+        }
+
+
+    def Emit(self, report: dict) -> None:
+        """
+        Write one report, must be overridden.
+        """
+        raise NotImplementedError
+
+
+class ConsoleSink(RateLimitedSink):
+    """
+    Print a one-line summary per interval, and messages as they come.
+    stream: Where to print, standard output if None.
+    """
+    def __init__(self, interval_seconds: float = 5.0, stream=None):
+        super().__init__(interval_seconds)
+        self.stream = stream
+
+    def Emit(self, report: dict) -> None:
+        counters = ', '.join(f'{name} {count} ({report["rates"][name]:.1f}/s)' for name, count in report['counters'].items())
+        gauges = ', '.join(f'{name} {value}' for name, value in report['gauges'].items())
+        print(f'[{report["elapsed_seconds"]:.1f}s] ' + '; '.join(part for part in (counters, gauges) if part),
+              file=self.stream or sys.stdout)
+
+    def Message(self, text: str) -> None:
+        print(text, file=self.stream or sys.stdout)
+
+
+class JsonLinesSink(RateLimitedSink):
+    """
+    Append each report and message to a file as one JSON object per line,
+    for dashboards and later analysis.  The file is opened for each write,
+    which the rate limit keeps rare, so the sink can be pickled with its owner.
+    """
+    def __init__(self, filename: str, interval_seconds: float = 5.0):
+        super().__init__(interval_seconds)
+        self.filename = filename
+
+    def Emit(self, report: dict) -> None:
+        self.Write(dict(type='metrics', time=time.time(), **report))
+
+    def Message(self, text: str) -> None:
+        self.Write({'type': 'message', 'time': time.time(), 'text': text})
+
+    def Write(self, record: dict) -> None:
+        with open(self.filename, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+
+class Metrics:
+    """
+    The process-wide metrics sink, which every component reports into.
+    """
+    sink = MetricsSink()
+
+    @staticmethod
+    def SetSink(sink: MetricsSink) -> MetricsSink:
+        """
+        Report into a new sink, or the null sink with None.
+        returns: The sink reported into before.
+        """
+        previous = Metrics.sink
+        Metrics.sink = sink if sink is not None else MetricsSink()
+        return previous
@@ -1,38 +1,129 @@
 """
 """
+import weakref
+import numpy as np
+
 from tokenbase import TokenBase
 from tokenstring import TokenString
 #from tokenstringembed import TokenStringEmbed
 from tokenreference import TokenReference
+from tokenclock import TokenClock
+from recentmemory import RecentMemory
+from tokeninterner import TokenInterner
+from tokensynapse import TokenSynapse
+from connectionstore import ConnectionStore
+from metrics import Metrics
+from profiler import PhaseProfiler
 from settings import Settings, MultigramState, TokenSourceFlags
 
 
 class MultiGram:
-    def __init__(self, source, threshold=0.95):
+    # The methods timed by EnableProfiling.
+    profiled_methods = ['ReadTokenBehavior', 'FollowTokenBehavior', 'IngestLines', 'ConnectToken', 'AddToken',
+                        'FindToken', 'FindSimilarToken', 'Tick', 'Settle', 'EnforceTokenBudget']
+
+    def __init__(self, source, threshold=0.95, max_tokens=Settings.max_tokens, settle_tick_by_tick=Settings.settle_tick_by_tick,
+                 max_connections=Settings.max_connections_per_row):
         self.state = MultigramState.IDLE
         self.current_line_estimated_count = 0
         self.current_token_estimated_count = 0
 
         self.token_source = source
         self.threshold_score = threshold
-        self.recent = []
+        self.settle_tick_by_tick = settle_tick_by_tick
+        self.recent = RecentMemory()
         self.eol_token_next = False
-
-        self.tokens = [None for i in range(Settings.max_tokens)]
+        self.clock = TokenClock()
+
+        # Token storage grows as tokens are added.  With a budget of max_tokens,
+        # the least frequently seen tokens are evicted to make room, and their ids reused.
+        self.tokens = []
+        # Tokens with an exact identity, by interned id, and the token id of each interned id (-1 if none).
+        # The vocabulary holds the interned keys of its tokens, until they are evicted or this multigram is collected.
+        self.vocabulary = {}
+        self.token_ids_by_intern = np.full(1024, -1, dtype=np.int64)
+        weakref.finalize(self, MultiGram.ReleaseVocabulary, self.vocabulary)
+        # Tokens with an exact identity are found by id, unless they should also match similar tokens.
+        self.match_similar_tokens = False
         self.intrinsic_tokens = []
         self.next_token_index = 0
+        self.max_tokens = max_tokens
+        self.token_count = 0
+        self.free_token_ids = []
+        self.token_frequency = np.zeros(1024)
+        # With max_connections, only the strongest connections per token and distance are kept exactly.
+        self.connections = ConnectionStore(Settings.max_token_strength, max_connections)
 
         # Support for following behavior.
         self.recently_followed_tokens = []
         self.most_recently_followed_token = None
         self.eol_token_next = False
 
+        # Opt-in timing of the phases of ingestion, see EnableProfiling.
+        self.profiler = None
+
         self.Reset()
 
 
+    def __getstate__(self):
+        # Interned ids belong to this process, the vocabulary is indexed again after unpickling.
+        state = dict(self.__dict__)
+        state['vocabulary'] = None
+        state['token_ids_by_intern'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.vocabulary = {}
+        self.token_ids_by_intern = np.full(1024, -1, dtype=np.int64)
+        weakref.finalize(self, MultiGram.ReleaseVocabulary, self.vocabulary)
+        for token in self.tokens:
+            if token is not None:
+                self.AddToVocabulary(token)
+
+
+    @staticmethod
+    def ReleaseVocabulary(vocabulary: dict) -> None:
+        """
+        Release the interned keys held by the vocabulary of a multigram that is gone.
+        """
+        for intern_id in vocabulary:
+            TokenInterner.Release(intern_id)
+        vocabulary.clear()
+
+
+    def EnableProfiling(self, profiler: PhaseProfiler = None) -> PhaseProfiler:
+        """
+        Time the phases of this multigram, its connections and its token source.
+        Until then, and after DisableProfiling, nothing is timed and nothing slows down.
+        profiler: The profiler to record into, a new one if None.
+        returns: The profiler.
+        """
+        self.DisableProfiling()
+        self.profiler = profiler if profiler is not None else PhaseProfiler()
+        self.profiler.Instrument(self, MultiGram.profiled_methods, 'MultiGram.')
+        self.profiler.Instrument(self.connections, ConnectionStore.profiled_methods, 'ConnectionStore.')
+        if self.token_source is not None:
+            self.profiler.Instrument(self.token_source, type(self.token_source).profiled_methods, 'Source.')
+        return self.profiler
+
+
+    def DisableProfiling(self) -> None:
+        """
+        Stop timing, restoring the untimed methods.  The profiler keeps what it recorded.
+        """
+        if self.profiler is not None:
+            self.profiler.Uninstrument(self)
+            self.profiler.Uninstrument(self.connections)
+            if self.token_source is not None:
+                self.profiler.Uninstrument(self.token_source)
+            self.profiler = None
+
+
     def InputLineCount(self):
         if self.token_source is not None:
-            return self.token_source.LineCount()
+            return self.token_source.GetLineCount()
         
         return 0
     
@@ -45,7 +136,7 @@ class MultiGram:
         self.settle_count = 0
         self.eol_token_next = False
         self.input_source_complete = False
-        self.recent = [None for i in range(Settings.max_token_strength)]
+        self.recent.Clear()
 
 
     def ReadTokenBehavior(self):
@@ -55,6 +146,10 @@ class MultiGram:
         established between the token currently being added and tokens recently
         added.  Connections between tokens added at widely separated times cannot
         be established.
+        After an end of line, the multigram settles for max_token_strength
+        ticks.  Settling normally jumps straight to the settled state in the
+        same call; with settle_tick_by_tick, each call lets one idle tick pass.
+        Either way, the connections made and the clock are the same.
         """
         # If we are currently settling, just allow an idle tick.
         if self.settle_count > 0:
@@ -62,9 +157,7 @@ class MultiGram:
 
             self.settle_count -= 1
             if self.settle_count <= 0:
-                self.ClearRecentMemory()
-                start_of_sequence_token = self.token_source.GetNext(TokenSourceFlags.Flag_StartOfSequence)
-                self.ConnectToken(start_of_sequence_token, 1.0)
+                self.ConnectStartOfSequence()
                 self.settle_count = 0
 
         if self.token_source is None or self.settle_count != 0:
@@ -80,21 +173,253 @@ class MultiGram:
             self.Tick()
 
             # Detect end of line, establish a settle period to separate lines.
-            if isinstance(token_bytes,  TokenString):
-                if token_bytes.end_of_line:
-                    # Allow all token strengths to settle to zero.
+            if self.IsEndOfLine(token_bytes):
+                Metrics.sink.Count('lines')
+                # Allow all token strengths to settle to zero.
+                if self.settle_tick_by_tick:
                     self.settle_count = Settings.max_token_strength
+                else:
+                    self.Settle()
         else:
             # We have no more input.
             if not self.input_source_complete:
-                print("Input source complete, settling.")
+                Metrics.sink.Message('Input source complete, settling.')
 
             self.input_source_complete = True
 
+    def IngestSource(self, lines_per_batch: int = 1000) -> None:
+        """
+        Read the whole token source a line at a time, and ingest the lines
+        in batches with IngestLines.  This makes the same connections as
+        calling ReadTokenBehavior until the input source is complete.
+        lines_per_batch: How many lines to count in one vectorized batch.
+        """
+        while self.token_source is not None and not self.input_source_complete:
+            lines = []
+            while len(lines) < lines_per_batch:
+                line = self.InternIds(self.token_source.GetNextLineIds())
+                if len(line) == 0:
+                    self.input_source_complete = True
+                    break
+
+                lines.append(line)
+                if self.IsEndOfLine(self.tokens[line[-1]]):
+                    # Give the start-of-sequence token the same id it gets when reading token by token.
+                    self.InsertToken(self.StartOfSequenceToken(), 1.0)
+
+            self.IngestLines(lines)
+
+
+    def IngestLines(self, lines) -> None:
+        """
+        Ingest whole lines of tokens at once.  Every line is a sequence of
+        ids of tokens already in this multigram (see InternTokens), and a
+        line that ends with an end-of-line token settles the multigram just
+        as ReadTokenBehavior does.  All (recent, current, distance) pairs of
+        the batch are built as arrays and counted in one pass per distance,
+        giving the same connection strengths, token trigger times and
+        strengths, token frequencies and recent memory as reading the same
+        tokens one at a time.
+        lines: A list of integer arrays of token ids, one per line.
+        """
+        if self.settle_count > 0:
+            # Finish a settle period left by ReadTokenBehavior.
+            self.Tick(self.settle_count)
+            self.settle_count = 0
+            self.ConnectStartOfSequence()
+
+        now = self.clock.now
+        window = self.recent.Ids()[::-1]
+        window_times = np.array([self.tokens[token_id].TriggerTime for token_id in window.tolist()], dtype=np.int64)
+
+        # Each line is preceded by the window of recent tokens it connects back to, which is not counted again.
+        sequences = []
+        counted = []
+        # Every token triggered in the batch, and when.
+        triggered = []
+        trigger_times = []
+        settles = 0
+        for line in lines:
+            line = np.asarray(line, dtype=np.int64)
+            if len(line) == 0:
+                continue
+
+            sequences.append(np.concatenate((window, line)))
+            counted.append(np.concatenate((np.zeros(len(window), dtype=bool), np.ones(len(line), dtype=bool))))
+
+            line_times = now + np.arange(len(line), dtype=np.int64)
+            triggered.append(line)
+            trigger_times.append(line_times)
+            now += len(line)
+            if self.IsEndOfLine(self.tokens[line[-1]]):
+                # Settle, then start the next line with the start-of-sequence token.
+                now += Settings.max_token_strength
+                settles += 1
+                window = np.array([self.InsertToken(self.StartOfSequenceToken(), 1.0).TokenId], dtype=np.int64)
+                window_times = np.array([now], dtype=np.int64)
+                triggered.append(window)
+                trigger_times.append(window_times)
+            else:
+                window = sequences[-1][-Settings.max_token_strength:]
+                window_times = np.concatenate((window_times, line_times))[-Settings.max_token_strength:]
+
+        if len(sequences) > 0:
+            sequence = np.concatenate(sequences)
+            segment = np.repeat(np.arange(len(sequences)), [len(a_sequence) for a_sequence in sequences])
+            counted = np.concatenate(counted)
+            # Reading token by token also counts the start-of-sequence token after each settle.
+            Metrics.sink.Count('tokens', int(counted.sum()) + settles)
+            Metrics.sink.Count('lines', settles)
+            for distance in range(1, min(Settings.max_token_strength, len(sequence) - 1) + 1):
+                pairs = (segment[distance:] == segment[:-distance]) & counted[distance:]
+                self.connections.BumpMany(distance, sequence[:-distance][pairs], sequence[distance:][pairs])
+
+        # Leave the clock, the triggered tokens, token frequencies and recent memory where reading token by token would.
+        if len(triggered) > 0:
+            last_times = np.full(self.next_token_index, -1, dtype=np.int64)
+            np.maximum.at(last_times, np.concatenate(triggered), np.concatenate(trigger_times))
+            for token_id in np.flatnonzero(last_times >= 0).tolist():
+                token = self.tokens[token_id]
+                token.TriggerTime = int(last_times[token_id])
+                token.TriggerStrength = Settings.max_token_strength
+        if len(sequences) > 0:
+            seen = np.bincount(sequence[counted], minlength=len(self.token_frequency))
+            self.token_frequency += seen[:len(self.token_frequency)]
+            if settles > 0:
+                self.token_frequency[self.InsertToken(self.StartOfSequenceToken(), 1.0).TokenId] += settles
+        self.clock.now = now
+        self.ClearRecentMemory()
+        for token_id, trigger_time in zip(window.tolist(), window_times.tolist()):
+            token = self.tokens[token_id]
+            token.TriggerTime = trigger_time
+            token.TriggerStrength = Settings.max_token_strength
+            self.AdvanceRecentMemory(token)
+
+        self.EnforceTokenBudget()
+
+
+    def PrimeRecentMemory(self, tokens, after_end_of_line: bool) -> None:
+        """
+        Put the multigram in the state it would be in after reading the
+        given tokens, without counting any connection between them.  This
+        lets a multigram start reading in the middle of an input, as a
+        shard of a larger training run.
+        tokens: The tokens read since the last end of line, oldest first.
+        after_end_of_line: True if the tokens follow an end of line, so the start-of-sequence token precedes them.
+        """
+        self.ClearRecentMemory()
+        self.settle_count = 0
+        if after_end_of_line:
+            tokens = [self.StartOfSequenceToken()] + list(tokens)
+
+        for token in tokens[-Settings.max_token_strength:]:
+            if token.start_of_sequence:
+                self.AdvanceRecentMemory(self.AddToken(token, 1.0))
+            else:
+                inserted_token = self.AddToken(token, self.threshold_score)
+                if inserted_token is not None:
+                    self.AdvanceRecentMemory(inserted_token)
+                self.Tick()
+
+
+    def InternTokens(self, tokens) -> np.ndarray:
+        """
+        Find or insert each token in this multigram, without triggering it.
+        Tokens that cannot be inserted (intrinsic tokens, or a full
+        multigram) are left out, just as ConnectToken ignores them.
+        tokens: A list of tokens, typically one line from the token source.
+        returns: An array of the ids of the tokens in this multigram.
+        """
+        token_ids = []
+        for token in tokens:
+            inserted_token = self.InsertToken(token, self.threshold_score)
+            if inserted_token is not None:
+                token_ids.append(inserted_token.TokenId)
+
+        return np.array(token_ids, dtype=np.int64)
+
+
+    def InternIds(self, intern_ids) -> np.ndarray:
+        """
+        Map interned token ids, as emitted by GetNextLineIds, to the ids of
+        tokens in this multigram, without triggering them.  Ids this
+        multigram has no token for yet get a new token made from the
+        interning table, so no token object is made for tokens already seen.
+        intern_ids: An integer array of interned ids.
+        returns: An array of the ids of the tokens in this multigram.
+        """
+        intern_ids = np.asarray(intern_ids, dtype=np.int64)
+        if len(intern_ids) == 0:
+            return intern_ids
+
+        self.GrowInternMap(int(intern_ids.max()) + 1)
+        token_ids = self.token_ids_by_intern[intern_ids]
+        for i in np.flatnonzero(token_ids < 0).tolist():
+            # Repeats of a new token in the same line find the one just inserted.
+            inserted_token = self.InsertToken(TokenInterner.MakeToken(int(intern_ids[i])), self.threshold_score)
+            token_ids[i] = inserted_token.TokenId
+
+        return token_ids
+
+
+    def GrowInternMap(self, size: int) -> None:
+        """
+        Make token_ids_by_intern hold at least size interned ids, doubling as needed.
+        """
+        if size > len(self.token_ids_by_intern):
+            grown = np.full(max(size, 2 * len(self.token_ids_by_intern)), -1, dtype=np.int64)
+            grown[:len(self.token_ids_by_intern)] = self.token_ids_by_intern
+            self.token_ids_by_intern = grown
+
+
+    def IsEndOfLine(self, token) -> bool:
+        """
+        True if the token ends a line, so the multigram settles after it.
+        """
+        return isinstance(token, TokenString) and token.end_of_line
+
+
+    def StartOfSequenceToken(self):
+        """
+        Make a token to mark the start of a sequence, from the token source if there is one.
+        """
+        if self.token_source is not None:
+            return self.token_source.GetNext(TokenSourceFlags.Flag_StartOfSequence)
+
+        token = TokenString(Settings.StartOfSequenceTokenValue)
+        token.start_of_sequence = True
+        return token
+
+
+    def Settle(self) -> None:
+        """
+        Fast-forward through a whole settle period in one step: let all
+        token strengths decay, clear recent memory, and connect the
+        start-of-sequence token, as the last tick of the period would.
+        """
+        self.Tick(Settings.max_token_strength)
+        self.settle_count = 0
+        self.ConnectStartOfSequence()
+
+
+    def ConnectStartOfSequence(self) -> None:
+        """
+        After a settle period, clear recent memory and start a new sequence.
+        """
+        self.ClearRecentMemory()
+        self.ConnectToken(self.StartOfSequenceToken(), 1.0)
+
+
     def FollowTokenBehavior(self, following_cutoff, next_layer):
         """
-        Follow the token behavior for the next layer.
-        This method is used to process tokens in a following context.
+        Follow the tokens of the input source through this trained multigram.
+        The followed tokens are collected into segments, and each segment is
+        inserted into the next layer as a single TokenReference.  A segment
+        ends where the connection to the following token is weaker than
+        expected (see ProcessFollowingTokens), at a token this multigram has
+        never seen, and at the end of a line, which the next layer sees too.
+        following_cutoff: The smallest softmax strength of an expected connection.
+        next_layer: Where segments go, anything with Insert and MarkAsDone, or None.
         """
         if self.token_source is None or self.input_source_complete:
             return
@@ -108,8 +433,7 @@ class MultiGram:
                 next_layer.Insert(eol_string)
 
             # Allow the map to settle.
-            for _ in range(Settings.max_token_strength):
-                self.Tick()
+            self.Tick(Settings.max_token_strength)
 
             # Return all accumulators to zero.
             self.SettleTokenActivity()
@@ -126,69 +450,121 @@ class MultiGram:
 
 
         # Read a token from the token source.
-        token_bytes = self.token_source.get_next()
+        token_bytes = self.token_source.GetNext()
+        if token_bytes is None:
+            if not self.input_source_complete:
+                Metrics.sink.Message(f'Input complete with {self.CountUsedTokens()} tokens in {self.InputLineCount()} lines.')
+                self.EndSegment(next_layer)
+                if next_layer is not None:
+                    next_layer.MarkAsDone()
+
+            self.input_source_complete = True
+            return
+
+        if self.IsEndOfLine(token_bytes):
+            # The line ends the segment, and the next layer sees the end of line after it.
+            self.EndSegment(next_layer)
+            self.most_recently_followed_token = None
+            self.eol_token_next = True
+            return
+
         multigram_token = self.FindTokenLike(token_bytes)
         if multigram_token is not None:
             # If we found a token that matches, we can use it.
             self.DoFollowForToken(multigram_token, following_cutoff, next_layer)
         else:
-            if not self.input_source_complete:
-                print(f'Input complete with {self.CountUsedTokens()} tokens in {self.InputLineCount()} lines.')
-                next_layer.MarkAsDone()
-
-            self.input_source_complete = True
-
+            # A token never seen in training cannot be followed, it ends the segment.
+            self.EndSegment(next_layer)
+            self.most_recently_followed_token = None
 
 
     def DoFollowForToken(self, token, following_cutoff, next_layer):
         # Most interesting cases happen only if we already have followed a token.
         if self.most_recently_followed_token is None:
             # First token in a line just starts a new collection.
-            self.recently_followed_tokens = []
-
-            if token is not None:
-                self.recently_followed_tokens.append(token)
-
-                # This token is now the recently seen one for next iteration.
-                self.most_recently_followed_token = token
+            self.recently_followed_tokens = [token]
         else:
             # Follow the connection between the most recently followed token and the following one.
             connection_to_following_token = self.FollowToken(token)
 
-            following_token = None
-            if connection_to_following_token is not None:
-                # We have a connection, follow it to the following token.
-                following_token = connection_to_following_token.following_token
+            # If we reached the end of a segment, build a new feature in the next layer, start a new segment.
+            expected_next_tokens = []
+            if connection_to_following_token is None or \
+                    self.ProcessFollowingTokens(connection_to_following_token, following_cutoff, expected_next_tokens):
+                self.EndSegment(next_layer)
+                self.recently_followed_tokens = [token]
+            else:
+                self.recently_followed_tokens.append(token)
 
-                # If we reached the end of a segment, build a new feature in the next layer, start a new segment.
-                expected_next_tokens = []
-                if self.ProcessFollowingTokens(connection_to_following_token, following_cutoff, expected_next_tokens):
-                    if self.recently_followed_tokens is not None:
-                        # Add _recentlyFollowedTokens as a single token to the next layer.
-                        if next_layer is not None:
-                            next_layer.insert(TokenReference(self.recently_followed_tokens) )
+        # This token is now the recently seen one for next iteration.
+        self.most_recently_followed_token = token
 
-                        # Assume there will be no recently followed token for the next iteration, unless there is a FollowingToken.
-                        self.recently_followed_tokens = None
 
-                    # If there is a following token (no end of line), start a new feature collection with it.
-                    if following_token is not None:
-                        self.recently_followed_tokens = []
-                        self.recently_followed_tokens.append(following_token)
+    def ProcessFollowingTokens(self, connection_to_following_token, following_cutoff, expected_next_tokens) -> bool:
+        """
+        Decide whether following a connection ends the current segment.
+        The tokens that follow the most recently followed token with a
+        softmax strength of at least following_cutoff are expected; a
+        following token that was not expected starts a new segment.
+        connection_to_following_token: The synapse from the most recently followed token to the following one.
+        following_cutoff: The smallest softmax strength of an expected connection.
+        expected_next_tokens: A list, filled with the expected tokens.
+        returns: True if the segment ends before the following token.
+        """
+        targets, _, softmax = self.connections.Row(self.most_recently_followed_token.TokenId, 1)
+        expected_next_tokens.extend(self.tokens[target] for target in targets[softmax >= following_cutoff].tolist())
 
-            # Remember the most recently followed token for next follow.  Null is ok, for start of new line.
-            self.most_recently_followed_token = following_token
+        return connection_to_following_token.SoftmaxStrength < following_cutoff
+
+
+    def EndSegment(self, next_layer) -> None:
+        """
+        Insert the tokens followed since the last segment ended into the next layer, as a single token.
+        """
+        if self.recently_followed_tokens and next_layer is not None:
+            next_layer.Insert(TokenReference.Canonical(self.recently_followed_tokens))
+
+        self.recently_followed_tokens = []
 
     def Softmax(self) -> None:
-        for token in self.tokens:
-            if token is not None:
-                token.Softmax()
+        """
+        Apply the softmax function to the connections of all tokens at every distance.
+        Softmax strengths are refreshed whenever they are read, so this is
+        only needed to pay for the refresh up front.
+        """
+        self.connections.Softmax()
+
+
+    def GetSynapses(self, token, distance):
+        """
+        Make synapses for all connections from a token at one distance, for
+        callers that want objects rather than the connection store arrays.
+        token: A token in this multigram.
+        distance: How far the following tokens follow the token, from 1.
+        returns: A list of TokenSynapse, one per connection.
+        """
+        targets, strengths, softmax = self.connections.Row(token.TokenId, distance)
+        return [TokenSynapse(self.tokens[target], strength, softmax_strength)
+                for target, strength, softmax_strength in zip(targets.tolist(), strengths.tolist(), softmax.tolist())]
+
+
+    def GetTopSynapses(self, token, distance, k=0):
+        """
+        Make synapses for the strongest connections from a token at one distance.
+        token: A token in this multigram.
+        distance: How far the following tokens follow the token, from 1.
+        k: How many synapses at most, or 0 for all of them.
+        returns: A list of TokenSynapse, strongest first.
+        """
+        targets, strengths, softmax = self.connections.TopSuccessors(token.TokenId, distance, k)
+        return [TokenSynapse(self.tokens[target], strength, softmax_strength)
+                for target, strength, softmax_strength in zip(targets.tolist(), strengths.tolist(), softmax.tolist())]
 
 
     def ExecuteIntrinsicOperation(self):
         for token in self.self.intrinsic_tokens:
             if token is not None and token.IntrinsicToken and token.IntrinsicOperation is not None:
-                token.IntrinsicOperation(self.tokens, self.recent)
+                token.IntrinsicOperation(self.tokens, self.RecentTokens())
 
     def ConnectToken(self, token, threshold_score):
         """
@@ -207,15 +583,17 @@ class MultiGram:
         inserted_token = self.AddToken(token, threshold_score)
 
         if inserted_token is not None:
-            # Examine all recently-seen tokens, bump the relationship of the new-or-found token with them all.
-            for i in range(len(self.recent)):
-                if self.recent[i] is not None:
-                    # Bump the relationship of the recent token with the inserted token, at the given strength.
-                    self.recent[i].BumpRelationship(inserted_token, i + 1)
+            Metrics.sink.Count('tokens')
 
-            # Recent memory is a shift register, with the oldes falling off the end, while the new one is inserted.
+            # Bump the relationship of every recently-seen token with the new-or-found token, each at its distance.
+            if len(self.recent) > 0:
+                self.connections.BumpWindow(self.recent.Ids(), inserted_token.TokenId)
+
+            # Recent memory is a ring buffer, with the oldest falling off the end, while the new one is inserted.
             self.AdvanceRecentMemory(inserted_token)
 
+            self.EnforceTokenBudget()
+
         return inserted_token
 
 
@@ -227,29 +605,155 @@ class MultiGram:
         thresholdScore: How similar tokens must be to be considered the same.
         returns: The added token or one found in the Multigram already, identical with the added token.
         """
+        inserted_token = self.InsertToken(token, threshold_score)
+
+        # Trigger this new token.
+        if inserted_token is not None:
+            inserted_token.TriggerToken()
+            self.token_frequency[inserted_token.TokenId] += 1
+        return inserted_token
+
+
+    def InsertToken(self, token, threshold_score):
+        """
+        Find a token that recognizes this reference token, or make a new one.
+        token: A token to insert in the Multigram.
+        thresholdScore: How similar tokens must be to be considered the same.
+        returns: The inserted token or one found in the Multigram already, or None if it cannot be inserted.
+        """
         if token.IntrinsicToken:
             # Intrinsic tokens are added to a separate list, and are not subject to the same limit as regular tokens.
             self.intrinsic_tokens.append(token)
             return None
         
-        inserted_token = token.FindTokenIfSeen(self.tokens, threshold_score)
+        inserted_token = self.FindToken(token, threshold_score)
         if inserted_token is None:
             # print(f"Adding new token: {token.token_raw} at index {self.next_token_index}")
-            if self.next_token_index < Settings.max_tokens:
-                self.tokens[self.next_token_index] = token
-                inserted_token = token
+            if token.TokenId >= 0:
+                # Shared tokens, such as canonical references, may already belong to another multigram.
+                token = token.Detached()
+
+            if len(self.free_token_ids) > 0:
+                token_id = self.free_token_ids.pop()
+            else:
+                token_id = self.next_token_index
+                self.tokens.append(None)
                 self.next_token_index += 1
+                if token_id >= len(self.token_frequency):
+                    self.token_frequency = np.concatenate((self.token_frequency, np.zeros(len(self.token_frequency))))
+
+            self.tokens[token_id] = token
+            self.token_count += 1
+            self.token_frequency[token_id] = 0
+            token.TokenId = token_id
+            token.AttachClock(self.clock)
+            token.AllocateActivity()
+            inserted_token = token
+
+            self.AddToVocabulary(token)
+            Metrics.sink.Gauge('vocabulary_size', self.token_count)
         else:
             # print(f"Found existing token: {inserted_token.token_raw} at index {self.tokens.index(inserted_token)}")
             pass
 
-
-        # Trigger this new token.
-        if inserted_token is not None:
-            inserted_token.TriggerToken()
         return inserted_token
 
 
+    def AddToVocabulary(self, token) -> None:
+        """
+        Index a token just given its token id by its interned id, unless an equal token is indexed already.
+        The vocabulary holds the interned key until the token is evicted.
+        """
+        intern_id = token.InternId
+        if intern_id >= 0 and intern_id not in self.vocabulary:
+            TokenInterner.Acquire(intern_id)
+            self.vocabulary[intern_id] = token
+            self.GrowInternMap(intern_id + 1)
+            self.token_ids_by_intern[intern_id] = token.TokenId
+
+
+    def EnforceTokenBudget(self) -> None:
+        """
+        If there is a token budget and it is exceeded, evict tokens.
+        Called only where no token ids are held outside recent memory.
+        """
+        if self.max_tokens > 0 and self.token_count > self.max_tokens:
+            self.EvictTokens(self.token_count - self.max_tokens + max(1, self.max_tokens // Settings.token_eviction_fraction))
+
+
+    def EvictTokens(self, count: int) -> None:
+        """
+        Evict the least frequently seen tokens and all their connections,
+        freeing their ids for reuse, and releasing their interned keys,
+        which are freed unless another multigram still holds them.  Tokens in recent memory, the token
+        being followed and the start-of-sequence token are protected.
+        After evicting, all frequencies are halved, so tokens that were
+        popular long ago do not stay protected forever.
+        count: The number of tokens to evict.
+        """
+        protected = set(self.recent.Ids().tolist())
+        if self.most_recently_followed_token is not None:
+            protected.add(self.most_recently_followed_token.TokenId)
+
+        candidates = np.array([token_id for token_id, token in enumerate(self.tokens)
+                               if token is not None and not token.start_of_sequence and token_id not in protected], dtype=np.int64)
+        if len(candidates) == 0:
+            return
+
+        # Least frequent first, and among equally frequent tokens the one triggered longest ago.
+        trigger_times = np.array([self.tokens[token_id].TriggerTime for token_id in candidates.tolist()], dtype=np.int64)
+        evicted = candidates[np.lexsort((trigger_times, self.token_frequency[candidates]))[:count]]
+
+        for token_id in evicted.tolist():
+            token = self.tokens[token_id]
+            intern_id = token.InternId
+            if intern_id >= 0 and self.vocabulary.get(intern_id) is token:
+                del self.vocabulary[intern_id]
+                self.token_ids_by_intern[intern_id] = -1
+                TokenInterner.Release(intern_id)
+
+            token.TokenId = -1
+            self.tokens[token_id] = None
+            self.free_token_ids.append(token_id)
+
+        self.token_count -= len(evicted)
+        Metrics.sink.Count('evicted_tokens', len(evicted))
+        Metrics.sink.Gauge('vocabulary_size', self.token_count)
+        self.token_frequency[evicted] = 0
+        self.token_frequency *= 0.5
+        self.connections.RemoveTokens(evicted)
+
+
+    def FindToken(self, token, threshold_score):
+        """
+        Find the token in this multigram that recognizes the reference token.
+        Tokens with an exact identity are found with one vocabulary lookup.
+        Only tokens without one, or tokens with a fuzzy similarity when
+        match_similar_tokens is set, fall back to FindSimilarToken.
+        token: A reference token to search for.
+        threshold_score: How similar tokens must be to be considered the same.
+        returns: The token in the multigram that recognizes the reference, or None.
+        """
+        intern_id = token.FindInternId()
+        if intern_id != -1:
+            found_token = self.vocabulary.get(intern_id)
+            if found_token is not None or token.IsSimilarityExact(threshold_score) or not self.match_similar_tokens:
+                return found_token
+
+        return self.FindSimilarToken(token, threshold_score)
+
+
+    def FindSimilarToken(self, token, threshold_score):
+        """
+        The slow path of FindToken: scan every token in this multigram for
+        the first that is similar enough to the reference token.
+        token: A reference token to search for.
+        threshold_score: How similar tokens must be to be considered the same.
+        returns: The first token in the multigram that recognizes the reference, or None.
+        """
+        return token.FindTokenIfSeen(self.tokens, threshold_score)
+
+
     def FindTokenLike(self, token):
         """
         Given a token, examine all tokens in this multigram, and find the
@@ -257,6 +761,10 @@ class MultiGram:
         token: A target token to search for.
         returns: The token in the multigram like the target token, or null if none exits.
         """
+        intern_id = token.FindInternId()
+        if intern_id != -1:
+            return self.vocabulary.get(intern_id)
+
         found_token = None
 
         for a_token in self.tokens:
@@ -272,14 +780,13 @@ class MultiGram:
         if self.most_recently_followed_token is None or next_token is None:
             return None
         
-        connection_to_following_tokan = None
-
-        for connection in self.most_recently_followed_token.connections[0]:  # Assuming distance 1 connections are at index 0
-            if connection.following_token.IsEqualTo(next_token):
-                connection_to_following_tokan = connection
-                break
+        source = self.most_recently_followed_token.TokenId
+        self.connections.RefreshSoftmax(1)
+        position = self.connections.Find(source, 1, next_token.TokenId)
+        if position < 0:
+            return None
 
-        return connection_to_following_tokan
+        return TokenSynapse(next_token, int(self.connections.strengths[0][position]), float(self.connections.softmax[0][position]))
     
         
     def SettleTokenActivity(self):
@@ -293,44 +800,45 @@ class MultiGram:
 
 
 
-    def Tick(self):
+    def Tick(self, ticks: int = 1):
         """
         Perform a tick operation on the Multigram.
-        Advance the clock one tick for all tokens in the map simultaneously.
+        Advance the clock for all tokens in the map simultaneously.
+        Token strengths are derived from the shared clock when read, so
+        this does not visit any token.
+        ticks: The number of ticks to advance, all at once.
         """
-        # Process recent tokens and update their strengths.
-        for token in self.tokens:
-            if token is not None:
-                token.Tick()
+        self.clock.Tick(ticks)
 
     def ClearRecentMemory(self):
         """
         Clear the recent memory of tokens.
         This is used to reset the Multigram's state after a settle period.
         """
-        self.recent = [None for i in range(Settings.max_token_strength)]
+        self.recent.Clear()
 
     
     def AdvanceRecentMemory(self, token):
         """
-        The recent memory array is used as a shift register.  Advancing
-        the recent memory means shifting out the oldest token, and adding
-        the specified token in at the front.
+        The recent memory is used as a shift register, kept in a ring
+        buffer of token ids.  Advancing the recent memory means shifting
+        out the oldest token, and adding the specified token in at the front.
         token: The new token to add at the front of the shift register.
         """
-        self.recent.pop()
-        self.recent.insert(0, token)
+        self.recent.Advance(token.TokenId)
 
-    def CountUsedTokens(self):
+
+    def RecentTokens(self) -> list:
         """
-        All tokens are stored in an array of fixed size, with nulls
-        indicating unused token storage.  Count used tokens in the Multigram.
-        returns: The count of non-null tokens in the array.
+        The tokens in recent memory, newest first.
         """
-        count = 0
-        for token in self.tokens:
-            if token is not None:
-                count += 1
+        return [self.tokens[token_id] for token_id in self.recent.Ids().tolist()]
 
-        return count
+    def CountUsedTokens(self):
+        """
+        Tokens are stored in a list indexed by token id, with nulls
+        marking the ids of evicted tokens.  Count used tokens in the Multigram.
+        returns: The count of non-null tokens in the list.
+        """
+        return self.token_count
     
@@ -0,0 +1,128 @@
+import multiprocessing
+import queue
+import threading
+import traceback
+from functools import partial
+
+from settings import Settings
+from tokensourcequeue import TokenSourceQueue, PipelineAborted
+
+
+class PipelineStage:
+    """
+    One layer of a MultiGramPipeline.
+    make_multigram: A callable taking the stage's token source and returning the MultiGram to run on it,
+                    for example partial(MultiGramSnapshot.Load, filename) for a trained layer.
+    following_cutoff: Follow the input with FollowTokenBehavior, passing segments to the next stage,
+                      or None to train on the input with ReadTokenBehavior.  Only the last stage may train.
+    """
+    def __init__(self, make_multigram, following_cutoff: float = None):
+        self.make_multigram = make_multigram
+        self.following_cutoff = following_cutoff
+
+
+def RunStage(index: int, stage: PipelineStage, make_source, next_layer, abort_event, results) -> None:
+    """
+    Run one stage until its input ends, then end its output.
+    The MultiGram is put on the results queue, without its token source,
+    or the error if the stage failed, which also aborts the other stages.
+    """
+    try:
+        multigram = stage.make_multigram(make_source())
+        multigram.input_source_complete = False
+        while not multigram.input_source_complete:
+            if stage.following_cutoff is None:
+                multigram.ReadTokenBehavior()
+            else:
+                multigram.FollowTokenBehavior(stage.following_cutoff, next_layer)
+
+        if next_layer is not None:
+            next_layer.MarkAsDone()
+        multigram.token_source = None
+        results.put((index, multigram, None))
+    except PipelineAborted:
+        results.put((index, None, None))
+    except BaseException:
+        abort_event.set()
+        results.put((index, None, traceback.format_exc()))
+
+
+class MultiGramPipeline:
+    """
+    Run a hierarchy of MultiGram layers as a pipeline, each layer in its
+    own thread or process.  Every layer but the last follows its input
+    and passes the segments it finds, as TokenReference tokens, through a
+    bounded queue to the next layer.  A full queue blocks the layer
+    before it, so memory stays bounded however fast the input is read,
+    and the end of the input is passed on through every queue in turn.
+    If any layer fails, every other layer stops, and Run raises.
+    In process mode, stage callables and tokens must be picklable, and
+    each layer's MultiGram is returned to the caller by pickling.
+    """
+    def __init__(self, stages: list[PipelineStage], use_processes: bool = False, queue_size: int = Settings.pipeline_queue_size):
+        if len(stages) == 0:
+            raise ValueError('A pipeline needs at least one stage.')
+        if any(stage.following_cutoff is None for stage in stages[:-1]):
+            raise ValueError('Every stage but the last must follow its input to feed the next stage.')
+
+        self.stages = stages
+        self.use_processes = use_processes
+        self.queue_size = queue_size
+
+
+    def Run(self, make_source) -> list:
+        """
+        Run every stage until the input is exhausted.
+        make_source: A callable making the token source of the first stage.
+        returns: The MultiGram of each stage, after running.
+        """
+        context = multiprocessing.get_context() if self.use_processes else None
+        make_queue = context.Queue if self.use_processes else queue.Queue
+        abort_event = context.Event() if self.use_processes else threading.Event()
+        results = make_queue()
+
+        workers = []
+        for index, stage in enumerate(self.stages):
+            next_layer = None
+            if index < len(self.stages) - 1:
+                next_layer = TokenSourceQueue(make_queue(self.queue_size), abort_event)
+
+            args = (index, stage, make_source, next_layer, abort_event, results)
+            if self.use_processes:
+                worker = context.Process(target=RunStage, args=args, daemon=True)
+            else:
+                worker = threading.Thread(target=RunStage, args=args, daemon=True)
+            workers.append(worker)
+
+            if next_layer is not None:
+                make_source = partial(TokenSourceQueue, next_layer.token_queue, abort_event)
+
+        for worker in workers:
+            worker.start()
+
+        # Collect results before joining, so processes can flush them through the queue.
+        multigrams = [None] * len(workers)
+        errors = []
+        reported = 0
+        while reported < len(workers):
+            try:
+                index, multigram, error = results.get(timeout=TokenSourceQueue.poll_seconds)
+            except queue.Empty:
+                if self.use_processes and any(worker.exitcode not in (None, 0) for worker in workers):
+                    abort_event.set()
+                    errors.append('A pipeline process exited without reporting.')
+                    break
+                continue
+
+            reported += 1
+            multigrams[index] = multigram
+            if error is not None:
+                errors.append(f'Stage {index} failed:\n{error}')
+
+        for worker in workers:
+            worker.join()
+
+        if errors:
+            raise RuntimeError('\n'.join(errors))
+
+        return multigrams
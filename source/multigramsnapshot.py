@@ -0,0 +1,238 @@
+import datetime
+import json
+import numpy as np
+
+from multigram import MultiGram
+from tokenstring import TokenString
+from tokentimestamp import TokenTimestamp
+from tokenreference import TokenReference
+
+
+class MultiGramSnapshot:
+    """
+    Save and load a trained MultiGram in a versioned, columnar binary file.
+    The file starts with a magic number, the format version and the
+    length of a JSON header.  The header describes every array in the
+    file by name, dtype, shape and offset.  The arrays follow, each
+    aligned to 64 bytes:
+      token_types, token_flags       One entry per token id
+      string_offsets, string_bytes   The string table, one string per token id
+      reference_offsets, reference_children
+                                     Child token ids of TokenReference tokens
+      token_frequency                Frequencies used by token eviction
+      removal_counts                 How often each token id was removed, salting the sketch keys of a bounded store
+      indptr_<d>, indices_<d>, strengths_<d>, softmax_<d>, row_max_<d>, row_log_sum_exp_<d>
+                                     The compacted connections at each distance d
+    Loading can memory-map the file read-only, so the connection arrays
+    are used in place, start-up costs only the vocabulary, and several
+    processes loading the same file share its physical pages.
+    A bounded store adds sketch_base_<d> and sketch_<d>, its pruned tail.
+    """
+    magic = b'MGSNAP\0\0'
+    version = 1
+    alignment = 64
+
+    type_none = 0
+    type_string = 1
+    type_timestamp = 2
+    type_reference = 3
+
+    flag_end_of_line = 1
+    flag_start_of_sequence = 2
+    flag_datetime = 4
+
+
+    @staticmethod
+    def Save(multigram: MultiGram, filename: str) -> None:
+        """
+        Write the vocabulary and connections of a multigram to a snapshot file.
+        multigram: The multigram to save.
+        filename: The snapshot file to write.
+        """
+        connections = multigram.connections
+        connections.Softmax()
+
+        token_count = len(multigram.tokens)
+        token_types = np.zeros(token_count, dtype=np.uint8)
+        token_flags = np.zeros(token_count, dtype=np.uint8)
+        strings = []
+        references = []
+        for token_id, token in enumerate(multigram.tokens):
+            text = ''
+            children = []
+            if isinstance(token, TokenString):
+                token_types[token_id] = MultiGramSnapshot.type_string
+                text = token.token_raw
+                if token.end_of_line:
+                    token_flags[token_id] |= MultiGramSnapshot.flag_end_of_line
+            elif isinstance(token, TokenTimestamp):
+                token_types[token_id] = MultiGramSnapshot.type_timestamp
+                if isinstance(token.token_raw, datetime.datetime):
+                    token_flags[token_id] |= MultiGramSnapshot.flag_datetime
+                    text = token.token_raw.isoformat()
+                else:
+                    text = str(token.token_raw)
+            elif isinstance(token, TokenReference):
+                token_types[token_id] = MultiGramSnapshot.type_reference
+                children = [child.TokenId for child in token.token_raw]
+            elif token is not None:
+                raise ValueError(f'Cannot save tokens of type {token.token_type} in a snapshot.')
+
+            if token is not None and token.start_of_sequence:
+                token_flags[token_id] |= MultiGramSnapshot.flag_start_of_sequence
+            strings.append(text.encode())
+            references.append(children)
+
+        arrays = {
+            'token_types': token_types,
+            'token_flags': token_flags,
+            'string_offsets': np.cumsum([0] + [len(string) for string in strings], dtype=np.int64),
+            'string_bytes': np.frombuffer(b''.join(strings), dtype=np.uint8),
+            'reference_offsets': np.cumsum([0] + [len(children) for children in references], dtype=np.int64),
+            'reference_children': np.array([child for children in references for child in children], dtype=np.int32),
+            'token_frequency': multigram.token_frequency[:token_count],
+        }
+        connections.Compact()
+        for distance in range(1, connections.max_distance + 1):
+            d = distance - 1
+            arrays[f'indptr_{distance}'] = connections.indptr[d]
+            arrays[f'indices_{distance}'] = connections.indices[d]
+            arrays[f'strengths_{distance}'] = connections.strengths[d]
+            arrays[f'softmax_{distance}'] = connections.softmax[d]
+            arrays[f'row_max_{distance}'] = connections.row_max[d]
+            arrays[f'row_log_sum_exp_{distance}'] = connections.row_log_sum_exp[d]
+            if connections.top_k > 0:
+                arrays[f'sketch_base_{distance}'] = connections.sketch_base[d]
+                arrays[f'sketch_{distance}'] = connections.sketches[d].table
+        if connections.top_k > 0:
+            arrays['removal_counts'] = connections.removal_counts
+
+        header = {
+            'version': MultiGramSnapshot.version,
+            'max_distance': connections.max_distance,
+            'threshold_score': multigram.threshold_score,
+            'max_tokens': multigram.max_tokens,
+            'clock': multigram.clock.now,
+            'max_connections': connections.top_k,
+            'arrays': {},
+        }
+        if connections.top_k > 0:
+            header['sketch_totals'] = [sketch.total for sketch in connections.sketches]
+
+        # Lay the arrays out after the header, each aligned.
+        offset = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            arrays[name] = array
+            header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset += MultiGramSnapshot.Aligned(array.nbytes)
+
+        header_bytes = json.dumps(header).encode()
+        data_start = MultiGramSnapshot.Aligned(len(MultiGramSnapshot.magic) + 8 + len(header_bytes))
+
+        with open(filename, 'wb') as snapshot_file:
+            snapshot_file.write(MultiGramSnapshot.magic)
+            snapshot_file.write(np.array([MultiGramSnapshot.version, len(header_bytes)], dtype='<u4').tobytes())
+            snapshot_file.write(header_bytes)
+            for name, array in arrays.items():
+                snapshot_file.seek(data_start + header['arrays'][name]['offset'])
+                snapshot_file.write(array.tobytes())
+            snapshot_file.truncate(data_start + offset)
+
+
+    @staticmethod
+    def Load(filename: str, source=None, memory_map: bool = True, lower_layer: MultiGram = None) -> MultiGram:
+        """
+        Read a multigram from a snapshot file.
+        filename: The snapshot file to read.
+        source: The token source for the loaded multigram, if it is to read more input.
+        memory_map: Map the file read-only rather than reading it into memory.
+        lower_layer: The multigram whose tokens TokenReference tokens refer to, if there are any.
+        returns: The loaded multigram.
+        """
+        if memory_map:
+            data = np.memmap(filename, dtype=np.uint8, mode='r')
+        else:
+            data = np.fromfile(filename, dtype=np.uint8)
+
+        if bytes(data[:len(MultiGramSnapshot.magic)]) != MultiGramSnapshot.magic:
+            raise ValueError(f'{filename} is not a multigram snapshot.')
+        version, header_length = np.frombuffer(data, dtype='<u4', count=2, offset=len(MultiGramSnapshot.magic)).tolist()
+        if version > MultiGramSnapshot.version:
+            raise ValueError(f'{filename} has snapshot version {version}, only up to {MultiGramSnapshot.version} can be read.')
+
+        header_start = len(MultiGramSnapshot.magic) + 8
+        header = json.loads(bytes(data[header_start:header_start + header_length]))
+        data_start = MultiGramSnapshot.Aligned(header_start + header_length)
+
+        def array(name):
+            layout = header['arrays'][name]
+            dtype = np.dtype(layout['dtype'])
+            count = int(np.prod(layout['shape']))
+            return np.frombuffer(data, dtype=dtype, count=count, offset=data_start + layout['offset']).reshape(layout['shape'])
+
+        multigram = MultiGram(source, header['threshold_score'], header['max_tokens'], max_connections=header.get('max_connections', 0))
+        multigram.clock.now = header['clock']
+
+        token_types = array('token_types')
+        token_flags = array('token_flags')
+        string_offsets = array('string_offsets').tolist()
+        string_bytes = array('string_bytes').tobytes()
+        reference_offsets = array('reference_offsets').tolist()
+        reference_children = array('reference_children').tolist()
+
+        tokens = []
+        for token_id, (token_type, flags) in enumerate(zip(token_types.tolist(), token_flags.tolist())):
+            text = string_bytes[string_offsets[token_id]:string_offsets[token_id + 1]].decode()
+            token = None
+            if token_type == MultiGramSnapshot.type_string:
+                token = TokenString(text)
+                token.end_of_line = bool(flags & MultiGramSnapshot.flag_end_of_line)
+            elif token_type == MultiGramSnapshot.type_timestamp:
+                token = TokenTimestamp(datetime.datetime.fromisoformat(text) if flags & MultiGramSnapshot.flag_datetime else text)
+            elif token_type == MultiGramSnapshot.type_reference:
+                if lower_layer is None:
+                    raise ValueError(f'{filename} holds references to a lower layer, which must be given to load it.')
+                children = reference_children[reference_offsets[token_id]:reference_offsets[token_id + 1]]
+                token = TokenReference([lower_layer.tokens[child] for child in children])
+
+            if token is not None:
+                token.start_of_sequence = bool(flags & MultiGramSnapshot.flag_start_of_sequence)
+                token.TokenId = token_id
+                token.AttachClock(multigram.clock)
+                token.AllocateActivity()
+            tokens.append(token)
+
+        multigram.tokens = tokens
+        for token in tokens:
+            if token is not None:
+                multigram.AddToVocabulary(token)
+        multigram.next_token_index = len(tokens)
+        multigram.token_count = len(tokens) - tokens.count(None)
+        multigram.free_token_ids = [token_id for token_id, token in enumerate(tokens) if token is None]
+        multigram.token_frequency = np.zeros(max(1024, 2 * len(tokens)))
+        multigram.token_frequency[:len(tokens)] = array('token_frequency')
+
+        for distance in range(1, header['max_distance'] + 1):
+            tail = {}
+            if multigram.connections.top_k > 0:
+                tail = {'sketch_base': array(f'sketch_base_{distance}'), 'sketch_table': array(f'sketch_{distance}'),
+                        'sketch_total': header['sketch_totals'][distance - 1]}
+            multigram.connections.SetArrays(distance,
+                array(f'indptr_{distance}'), array(f'indices_{distance}'), array(f'strengths_{distance}'),
+                array(f'softmax_{distance}'), array(f'row_max_{distance}'), array(f'row_log_sum_exp_{distance}'), **tail)
+
+        if 'removal_counts' in header['arrays']:
+            multigram.connections.removal_counts = array('removal_counts').copy()
+
+        multigram.input_source_complete = source is None
+        return multigram
+
+
+    @staticmethod
+    def Aligned(size: int) -> int:
+        """
+        Round a size up to the snapshot alignment.
+        """
+        alignment = MultiGramSnapshot.alignment
+        return (size + alignment - 1) // alignment * alignment
@@ -0,0 +1,198 @@
+import numpy as np
+from settings import Settings
+from distributioncache import DistributionCache
+
+
+class NextTokenScorer:
+    """
+    Score every token of a MultiGram as the next token after a history,
+    for one history or a batch of them, with array kernels over the
+    per-distance softmax connections.  The token history[-d] contributes
+    its row at distance d, weighted by a distance multiplier, so the
+    scores of a batch are one weighted sum of gathered sparse rows,
+    summed with a single bincount.
+    Two modes mirror the scoring of tokentests.py:
+      'intersect'  FindBestNextToken: weights (n - d + 1) / n over the last n
+                   tokens, and only tokens following every one of them count.
+      'support'    FindMostLikelyNextToken: weights len(history) - d + 1, and
+                   only tokens following the last token count.
+    Tokens that do not count score -inf.
+    With cache_size > 0, the scores of the last cache_size distinct
+    history suffixes are kept, sparse, in a DistributionCache, and
+    recomputed only after the connections change.
+    """
+    modes = ('intersect', 'support')
+
+    def __init__(self, multigram, mode: str = 'intersect', history_length: int = Settings.max_token_strength,
+                 cache_size: int = Settings.next_token_cache_size):
+        if mode not in NextTokenScorer.modes:
+            raise ValueError(f'Unknown scoring mode {mode}, expected one of {NextTokenScorer.modes}.')
+
+        self.multigram = multigram
+        self.mode = mode
+        self.history_length = min(history_length, multigram.connections.max_distance)
+        self.cache = DistributionCache(cache_size) if cache_size > 0 else None
+
+
+    def Weights(self, history_size: int) -> np.ndarray:
+        """
+        The distance multipliers of a history, for distances 1 to n.
+        """
+        count = min(history_size, self.history_length)
+        distances = np.arange(1, count + 1)
+        if self.mode == 'intersect':
+            return (count - distances + 1) / count
+
+        return (history_size - distances + 1).astype(np.float64)
+
+
+    def CacheKey(self, history) -> tuple:
+        """
+        The part of a history its scores depend on: the ids of its last
+        history_length tokens, and in 'support' mode, whose weights grow
+        with the whole history, its length.
+        """
+        suffix = tuple(np.asarray(history, dtype=np.int64)[-self.history_length:].tolist())
+        if self.mode == 'support' and len(history) > self.history_length:
+            return suffix, len(history)
+
+        return suffix
+
+
+    def ScoreBatch(self, histories) -> np.ndarray:
+        """
+        Score the next token after each of a batch of histories.
+        Histories found in the cache are not scored again.
+        histories: A list of histories, each a sequence of token ids, oldest first.
+        returns: A (len(histories), token count) array of scores, -inf where a token does not count.
+        """
+        if self.cache is None:
+            return self.ComputeScores(histories)
+
+        self.cache.Validate(self.multigram.connections.version)
+        scores = np.full((len(histories), len(self.multigram.tokens)), -np.inf)
+        missing_rows, missing_keys = [], []
+        for row, history in enumerate(histories):
+            key = self.CacheKey(history)
+            cached = self.cache.Get(key)
+            if cached is None:
+                missing_rows.append(row)
+                missing_keys.append(key)
+            else:
+                targets, values = cached
+                scores[row, targets] = values
+
+        if len(missing_rows) > 0:
+            computed = self.ComputeScores([histories[row] for row in missing_rows])
+            for row, key, row_scores in zip(missing_rows, missing_keys, computed):
+                targets = np.flatnonzero(np.isfinite(row_scores))
+                self.cache.Put(key, (targets, row_scores[targets]))
+                scores[row] = row_scores
+
+        return scores
+
+
+    def ComputeScores(self, histories) -> np.ndarray:
+        """
+        Score the next token after each of a batch of histories, without the cache.
+        """
+        connections = self.multigram.connections
+        token_count = len(self.multigram.tokens)
+        batch_size = len(histories)
+
+        # One (history, distance, source, weight) entry per contributing row.
+        rows, distances, sources, weights = [], [], [], []
+        for row, history in enumerate(histories):
+            history = np.asarray(history, dtype=np.int64)
+            if len(history) == 0:
+                continue
+            count = min(len(history), self.history_length)
+            rows.append(np.full(count, row, dtype=np.int64))
+            distances.append(np.arange(1, count + 1))
+            sources.append(history[::-1][:count])
+            weights.append(self.Weights(len(history)))
+
+        if len(rows) == 0:
+            return np.full((batch_size, token_count), -np.inf)
+
+        rows, distances = np.concatenate(rows), np.concatenate(distances)
+        sources, weights = np.concatenate(sources), np.concatenate(weights)
+
+        # The (history, token) cell and weighted softmax strength of every gathered connection.
+        all_cells, all_values, first_cells = [], [], []
+        for distance in np.unique(distances).tolist():
+            connections.RefreshSoftmax(distance)
+            d = distance - 1
+            indptr = connections.indptr[d]
+
+            at_distance = distances == distance
+            entry_rows, entry_sources, entry_weights = rows[at_distance], sources[at_distance], weights[at_distance]
+            # Tokens the multigram does not know, as id -1, have no connections.
+            in_range = (entry_sources >= 0) & (entry_sources < len(indptr) - 1)
+            entry_rows, entry_sources, entry_weights = entry_rows[in_range], entry_sources[in_range], entry_weights[in_range]
+
+            starts = indptr[entry_sources]
+            lengths = indptr[entry_sources + 1] - starts
+            if lengths.sum() == 0:
+                continue
+
+            # Gather the positions of every row's connections, and the entry each belongs to.
+            entry_of_position = np.repeat(np.arange(len(lengths)), lengths)
+            offsets = np.zeros(len(lengths), dtype=np.int64)
+            np.cumsum(lengths[:-1], out=offsets[1:])
+            positions = np.arange(lengths.sum()) - offsets[entry_of_position] + starts[entry_of_position]
+
+            cells = entry_rows[entry_of_position] * token_count + connections.indices[d][positions]
+            all_cells.append(cells)
+            all_values.append(connections.softmax[d][positions] * entry_weights[entry_of_position])
+            if distance == 1:
+                first_cells.append(cells)
+
+        if len(all_cells) == 0:
+            return np.full((batch_size, token_count), -np.inf)
+
+        # Sum the weighted rows, and count how many of a history's rows each token is in.
+        cells = np.concatenate(all_cells)
+        sums = np.bincount(cells, weights=np.concatenate(all_values), minlength=batch_size * token_count)
+        if self.mode == 'intersect':
+            hits = np.bincount(cells, minlength=batch_size * token_count).reshape(batch_size, token_count)
+            counts = (hits == np.bincount(rows, minlength=batch_size)[:, np.newaxis]) & (hits > 0)
+        else:
+            counts = np.zeros(batch_size * token_count, dtype=bool)
+            counts[np.concatenate(first_cells) if first_cells else []] = True
+            counts = counts.reshape(batch_size, token_count)
+
+        return np.where(counts, sums.reshape(batch_size, token_count), -np.inf)
+
+
+    def Scores(self, history) -> np.ndarray:
+        """
+        Score the next token after one history.
+        history: A sequence of token ids, oldest first.
+        returns: An array of scores, one per token id, -inf where a token does not count.
+        """
+        return self.ScoreBatch([history])[0]
+
+
+    def BestNextTokens(self, histories) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The best next token after each of a batch of histories.
+        Among equal scores, the lowest token id wins.
+        returns: Arrays of token ids, -1 where no token counts, and their scores.
+        """
+        scores = self.ScoreBatch(histories)
+        if scores.shape[1] == 0:
+            return np.full(len(histories), -1, dtype=np.int64), np.full(len(histories), -np.inf)
+
+        best = np.argmax(scores, axis=1)
+        best_scores = scores[np.arange(len(histories)), best]
+        return np.where(np.isfinite(best_scores), best, -1), best_scores
+
+
+    def BestNextToken(self, history):
+        """
+        The best next token after one history.
+        returns: The token id, -1 if no token counts, and its score.
+        """
+        best, best_scores = self.BestNextTokens([history])
+        return int(best[0]), float(best_scores[0])
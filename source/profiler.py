@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+class PhaseStatistics:
+    """
+    The calls and cumulative wall time of one phase, and a histogram of
+    sampled call latencies in power-of-two buckets: bucket b counts
+    calls taking from 2^(b-1) up to 2^b nanoseconds.
+    """
+    bucket_count = 64
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.total_ns = 0
+        self.histogram = np.zeros(PhaseStatistics.bucket_count, dtype=np.int64)
+
+
+    def Percentile(self, fraction: float) -> float:
+        """
+        An upper bound of the latency below which a fraction of the sampled calls fall.
+        returns: The latency in seconds, 0 if no call was sampled.
+        """
+        sampled = self.histogram.sum()
+        if sampled == 0:
+            return 0.0
+
+        bucket = int(np.searchsorted(np.cumsum(self.histogram), fraction * sampled))
+        return (1 << bucket) / 1e9
+
+
+    def Summary(self) -> dict:
+        return {
+            'calls': self.calls,
+            'total_seconds': self.total_ns / 1e9,
+            'mean_seconds': self.total_ns / 1e9 / self.calls if self.calls > 0 else 0.0,
+            'p50_seconds': self.Percentile(0.5),
+            'p99_seconds': self.Percentile(0.99),
+        }
+
+
+class PhaseProfiler:
+    """
+    Opt-in timing of the phases of ingestion: reading the source, finding
+    and adding tokens, bumping connections, ticking and softmax.
+    Instrument replaces chosen methods of an object with timed wrappers,
+    set on the instance, and Uninstrument removes them again, so code
+    that is not instrumented runs exactly as before, with no overhead.
+    Every call of a wrapped method adds to the calls and wall time of its
+    phase, which include the phases it calls.  Every sample_every-th call
+    of a phase is also put in its latency histogram, and in a trace of
+    the last trace_capacity sampled calls, which can be written in the
+    Chrome trace format, for chrome://tracing or Perfetto.
+    Uninstrument an object before pickling it.
+    """
+    def __init__(self, sample_every: int = 16, trace_capacity: int = 100000):
+        self.sample_every = sample_every
+        self.phases = {}
+        self.trace = deque(maxlen=trace_capacity)
+        self.instrumented = []
+        self.origin_ns = time.perf_counter_ns()
+
+
+    def Instrument(self, instance, method_names, prefix: str = '') -> None:
+        """
+        Time the given methods of an object, each as the phase prefix + method name.
+        Methods the object does not have are skipped.
+        """
+        for method_name in method_names:
+            method = getattr(instance, method_name, None)
+            if method is None or method_name in vars(instance):
+                continue
+
+            setattr(instance, method_name, self.Wrap(prefix + method_name, method))
+            self.instrumented.append((instance, method_name))
+
+
+    def Uninstrument(self, instance=None) -> None:
+        """
+        Restore the methods of one instrumented object, or of every object with None.
+        """
+        kept = []
+        for instrumented, method_name in self.instrumented:
+            if instance is None or instrumented is instance:
+                delattr(instrumented, method_name)
+            else:
+                kept.append((instrumented, method_name))
+        self.instrumented = kept
+
+
+    def Wrap(self, name: str, function):
+        """
+        A function timing each call of another as one phase.
+        """
+        statistics = self.phases.setdefault(name, PhaseStatistics(name))
+        histogram = statistics.histogram
+        trace = self.trace
+        sample_every = self.sample_every
+        origin_ns = self.origin_ns
+        perf_counter_ns = time.perf_counter_ns
+
+        def Timed(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = perf_counter_ns() - start
+                statistics.calls += 1
+                statistics.total_ns += elapsed
+                if statistics.calls % sample_every == 0:
+                    histogram[min(elapsed.bit_length(), PhaseStatistics.bucket_count - 1)] += 1
+                    trace.append((name, start - origin_ns, elapsed, threading.get_ident()))
+
+        return Timed
+
+
+    def Reset(self) -> None:
+        """
+        Forget all timings, keeping the instrumentation.
+        """
+        for statistics in self.phases.values():
+            statistics.calls = 0
+            statistics.total_ns = 0
+            statistics.histogram[:] = 0
+        self.trace.clear()
+
+
+    def Summary(self) -> dict:
+        """
+        The calls, wall time and sampled latency percentiles of every phase that was called.
+        """
+        return {name: statistics.Summary() for name, statistics in self.phases.items() if statistics.calls > 0}
+
+
+    def Report(self) -> str:
+        """
+        The summary as a table, the most time-consuming phase first.
+        """
+        lines = [f'{"phase":<32}{"calls":>12}{"total s":>12}{"mean us":>12}{"p50 us":>12}{"p99 us":>12}']
+        for name, summary in sorted(self.Summary().items(), key=lambda item: -item[1]['total_seconds']):
+            lines.append(f'{name:<32}{summary["calls"]:>12}{summary["total_seconds"]:>12.3f}{summary["mean_seconds"] * 1e6:>12.2f}'
+                         f'{summary["p50_seconds"] * 1e6:>12.2f}{summary["p99_seconds"] * 1e6:>12.2f}')
+        return '\n'.join(lines)
+
+
+    def ChromeTrace(self) -> dict:
+        """
+        The traced calls as Chrome trace complete events, in microseconds.
+        """
+        events = [{'name': name, 'ph': 'X', 'ts': start / 1000.0, 'dur': elapsed / 1000.0, 'pid': 0, 'tid': thread}
+                  for name, start, elapsed, thread in self.trace]
+        return {'traceEvents': events, 'displayTimeUnit': 'ns', 'otherData': {'phases': self.Summary()}}
+
+
+    def WriteChromeTrace(self, filename: str) -> None:
+        """
+        Write the traced calls to a file in the Chrome trace format.
+        """
+        with open(filename, 'w') as file:
+            json.dump(self.ChromeTrace(), file)
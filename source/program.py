@@ -1,22 +1,28 @@
 #from websockets.sync.client import connect
+import os
 
 from multigram import MultiGram
+from multigramsnapshot import MultiGramSnapshot
 from tokenstring import TokenString
 from tokenstringembed import TokenStringEmbed
 from tokensourcecsvstream import TokenSourceCSVStream
 from tokensourcedataset import TokenSourceDataset
 from settings import Settings, MultigramState
+from metrics import Metrics, ConsoleSink
 from tokentests import GenerateLikelyString, GenerateBestFitString, GenerateRandomSentence
 
+# A trained multigram is saved here, and loaded instead of training again when the program restarts.
+SNAPSHOT_FILENAME = 'tinystories_200.mgsnap'
+
 def DisplayRelationships(multigram: MultiGram, token: TokenString):
     """
     Display the relationships of tokens in the multigram.
     This function iterates through the tokens and prints their relationships.
     """
     print(f"Token: '{token.token_raw}'")
-    for distance in range(1, len(token.Connections) + 1):
+    for distance in range(1, multigram.connections.max_distance + 1):
         print(f"  Token: '{token.token_raw}' at distance {distance}:")
-        for connection in token.Connections[distance - 1]:
+        for connection in multigram.GetSynapses(token, distance):
             if connection.Strength > 1:
                 print(f"    Connected to: {connection.FollowingToken.token_raw} with strength {connection.Strength}, softmax {connection.SoftmaxStrength} at distance {distance}")
     print()
@@ -26,17 +32,26 @@ def DisplayRelationships(multigram: MultiGram, token: TokenString):
 
 def main():
     print("Starting Multigram processing...")
+    # Report training progress to the console every few seconds.
+    Metrics.SetSink(ConsoleSink(interval_seconds=5.0))
     # Use the Multigram to process tokens
-    #with TokenSourceCSVStream('/log/syslog', 500) as token_source:
-    with TokenSourceDataset("roneneldan/TinyStories", 200) as token_source:
-        # Initialize the Multigram with a CSV token source
-        multigram = MultiGram(token_source)
+    if os.path.exists(SNAPSHOT_FILENAME):
+        multigram = MultiGramSnapshot.Load(SNAPSHOT_FILENAME)
+        print(f'Loaded {multigram.CountUsedTokens()} tokens from {SNAPSHOT_FILENAME}.')
+    else:
+        #with TokenSourceCSVStream('/log/syslog', 500) as token_source:
+        with TokenSourceDataset("roneneldan/TinyStories", 200) as token_source:
+            # Initialize the Multigram with a CSV token source
+            multigram = MultiGram(token_source)
+
+            #while multigram.next_token_index < 1000:
+            while not multigram.input_source_complete:
+                multigram.ReadTokenBehavior()
+            Metrics.sink.Flush()
 
-        #while multigram.next_token_index < 1000:
-        while not multigram.input_source_complete:
-            multigram.ReadTokenBehavior()
+        print(f'Processed {multigram.CountUsedTokens()} tokens from the source.')
+        MultiGramSnapshot.Save(multigram, SNAPSHOT_FILENAME)
 
-    print(f'Processed {multigram.CountUsedTokens()} tokens from the source.')
     multigram.Softmax()  # Apply softmax to all token connections after processing
 
     exampleToken = TokenString("Once")
@@ -54,7 +69,7 @@ def main():
         print(f'Best fit response: {response}')
 
     starting_token = TokenString(Settings.StartOfSequenceTokenValue)
-    root_token = starting_token.FindTokenIfSeen(tokens = multigram.tokens, threshold_score = 1.0)
+    root_token = multigram.FindToken(starting_token, threshold_score = 1.0)
     DisplayRelationships(multigram, root_token)
 
     random_sentence = GenerateRandomSentence(multigram)
@@ -0,0 +1,50 @@
+import numpy as np
+from settings import Settings
+
+
+class RecentMemory:
+    """
+    The ids of the most recently added tokens of a MultiGram, newest
+    first, in a fixed ring buffer.  Advancing writes one slot and moves
+    the head, clearing only forgets the fill count, and the filled slots
+    are read as one array, so the cost of a token's window is
+    proportional to the number of tokens actually in it.
+    """
+    def __init__(self, size: int = Settings.max_token_strength):
+        self.size = size
+        self.token_ids = np.full(size, -1, dtype=np.int64)
+        self.head = 0
+        self.count = 0
+
+
+    def __len__(self) -> int:
+        return self.count
+
+
+    def Advance(self, token_id: int) -> None:
+        """
+        Add a token id in front of the others, forgetting the oldest if the memory is full.
+        """
+        self.head = (self.head - 1) % self.size
+        self.token_ids[self.head] = token_id
+        if self.count < self.size:
+            self.count += 1
+
+
+    def Clear(self) -> None:
+        """
+        Forget all token ids.
+        """
+        self.count = 0
+
+
+    def Ids(self) -> np.ndarray:
+        """
+        The filled slots, newest first, so the id at index i was added i + 1 tokens before the next one.
+        returns: A new array of token ids.
+        """
+        end = self.head + self.count
+        if end <= self.size:
+            return self.token_ids[self.head:end].copy()
+
+        return np.concatenate((self.token_ids[self.head:], self.token_ids[:end - self.size]))
@@ -0,0 +1,207 @@
+import math
+import numpy as np
+from settings import Settings
+from tokenstring import TokenString
+from nexttokenscorer import NextTokenScorer
+from metrics import Metrics
+
+
+class SentenceGenerator:
+    """
+    Generate token sequences from a trained MultiGram, by sampling or by
+    beam search.  Sampling follows the distance 1 connections: each row's
+    top_k strongest successors are given weights softmax(strength / temperature),
+    and their cumulative weights are laid out in one array, row s in the
+    interval (s, s + 1], so the next token of a whole batch of sequences is
+    found with one searchsorted, O(log n) per token.  Beam search scores whole
+    histories with a NextTokenScorer.
+    The tables are built from the connections when the generator is made,
+    so make a new generator after training further.
+    """
+    def __init__(self, multigram, top_k: int = 0, temperature: float = 1.0, seed: int = None):
+        if temperature <= 0.0:
+            raise ValueError(f'The temperature must be positive, not {temperature}.')
+
+        self.multigram = multigram
+        self.top_k = top_k
+        self.temperature = temperature
+        self.rng = np.random.default_rng(seed)
+        self.scorers = {}
+        self.is_end_of_line = np.array([multigram.IsEndOfLine(token) for token in multigram.tokens], dtype=bool)
+        self.BuildTables()
+
+
+    def BuildTables(self) -> None:
+        """
+        Build the cumulative weights of the top_k successors of every token, strongest first.
+        """
+        connections = self.multigram.connections
+        order = connections.SuccessorOrder(1)
+        indptr = connections.indptr[0]
+
+        lengths = np.diff(indptr)
+        if self.top_k > 0:
+            lengths = np.minimum(lengths, self.top_k)
+        self.table_indptr = np.zeros(len(indptr), dtype=np.int64)
+        np.cumsum(lengths, out=self.table_indptr[1:])
+
+        # The positions of the kept connections of every row, and the row of each.
+        rows = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+        positions = order[np.arange(len(rows)) - self.table_indptr[rows] + indptr[rows]]
+        self.targets = connections.indices[0][positions].astype(np.int64)
+
+        # Rows are strongest first, so the first logit of each row is its largest.
+        logits = connections.strengths[0][positions] * (math.log(Settings.softmax_base) / self.temperature)
+        weights = np.exp(logits - logits[self.table_indptr[rows]])
+        cumulative = np.cumsum(weights)
+        before_row = np.concatenate(([0.0], cumulative))[self.table_indptr[:-1]]
+        row_totals = cumulative[np.maximum(self.table_indptr[1:] - 1, 0)] - before_row if len(cumulative) > 0 else np.zeros(len(lengths))
+
+        self.cumulative = (cumulative - before_row[rows]) / row_totals[rows] + rows
+        # The last weight of a row closes its interval exactly.
+        self.cumulative[self.table_indptr[1:][lengths > 0] - 1] = rows[self.table_indptr[1:][lengths > 0] - 1] + 1.0
+
+
+    def SampleNext(self, token_ids) -> np.ndarray:
+        """
+        Sample the next token after each of a batch of tokens.
+        token_ids: Array of the ids of the current tokens.
+        returns: Array of the ids of the next tokens, -1 where a token has no successors.
+        """
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        next_ids = np.full(len(token_ids), -1, dtype=np.int64)
+
+        in_table = (token_ids >= 0) & (token_ids < len(self.table_indptr) - 1)
+        rows = token_ids[in_table]
+        starts, ends = self.table_indptr[rows], self.table_indptr[rows + 1]
+        has_successors = ends > starts
+
+        rows, starts, ends = rows[has_successors], starts[has_successors], ends[has_successors]
+        positions = np.searchsorted(self.cumulative, rows + self.rng.random(len(rows)), side='right')
+        positions = np.clip(positions, starts, ends - 1)
+
+        sampled = np.full(len(has_successors), -1, dtype=np.int64)
+        sampled[has_successors] = self.targets[positions]
+        next_ids[in_table] = sampled
+        return next_ids
+
+
+    def StartToken(self):
+        """
+        The start-of-sequence token of the multigram, or None if it has none.
+        """
+        return self.multigram.FindToken(TokenString(Settings.StartOfSequenceTokenValue), threshold_score = 1.0)
+
+
+    def Sample(self, count: int, max_length: int = 50, start_ids=None) -> list[list[int]]:
+        """
+        Sample a batch of token sequences, all advanced together one token at a time.
+        A sequence ends after an end-of-line token, a token with no successors, or max_length tokens.
+        count: How many sequences to sample.
+        start_ids: The token each sequence follows, by default the start-of-sequence token.
+        returns: A list of sequences of token ids, not including the tokens they follow.
+        """
+        if start_ids is None:
+            start_token = self.StartToken()
+            if start_token is None:
+                return [[] for _ in range(count)]
+            start_ids = np.full(count, start_token.TokenId, dtype=np.int64)
+
+        current = np.array(start_ids, dtype=np.int64)
+        sampled = np.full((max_length, len(current)), -1, dtype=np.int64)
+        active = np.flatnonzero(current >= 0)
+        for step in range(max_length):
+            if len(active) == 0:
+                break
+
+            next_ids = self.SampleNext(current[active])
+            sampled[step, active] = next_ids
+            current[active] = next_ids
+            active = active[(next_ids >= 0) & ~self.is_end_of_line[np.maximum(next_ids, 0)]]
+
+        Metrics.sink.Count('generated_sequences', len(current))
+        Metrics.sink.Count('generated_tokens', int((sampled >= 0).sum()))
+        return [column[column >= 0].tolist() for column in sampled.T]
+
+
+    def SampleStrings(self, count: int, max_length: int = 50) -> list[str]:
+        """
+        Sample a batch of sentences, for example to augment training data.
+        returns: A list of strings, the tokens of each separated by spaces.
+        """
+        return [self.AsString(sequence) for sequence in self.Sample(count, max_length)]
+
+
+    def BeamSearch(self, prompt_ids, beam_width: int = 4, max_length: int = 50, mode: str = 'support') -> list[tuple[list[int], float]]:
+        """
+        Find the most likely continuations of a prompt by beam search.
+        Every step scores the histories of all beams in one batch, each
+        score taken as a probability in proportion to the beam's total,
+        and keeps the beam_width continuations of highest log probability.
+        A beam is finished by an end-of-line token, a history with no
+        scored successors, or max_length tokens.
+        prompt_ids: The token ids the continuations follow, oldest first.
+        mode: The NextTokenScorer mode scoring the histories.
+        returns: Up to beam_width (token ids, log probability) pairs, most likely first.
+        """
+        scorer = self.Scorer(mode)
+        prompt_ids = list(prompt_ids)
+        beams = [([], 0.0)]
+        finished = []
+
+        for step in range(max_length):
+            Metrics.sink.Count('beam_search_steps')
+            scores = scorer.ScoreBatch([prompt_ids + beam for beam, _ in beams])
+            finite = np.isfinite(scores)
+            totals = np.where(finite, scores, 0.0).sum(axis=1, keepdims=True)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log_probabilities = np.where(finite & (scores > 0.0), np.log(scores / totals), -np.inf)
+
+            # Beams with nothing to follow them are finished as they are.
+            has_successors = np.isfinite(log_probabilities).any(axis=1)
+            finished.extend(beam for beam, extends in zip(beams, has_successors.tolist()) if not extends and len(beam[0]) > 0)
+
+            # The best continuations of all beams, as (beam, token) cells, best first.
+            candidates = (log_probabilities + np.array([log_probability for _, log_probability in beams])[:, np.newaxis]).ravel()
+            count = min(beam_width, int(np.isfinite(candidates).sum()))
+            if count == 0:
+                beams = []
+                break
+            best = np.argpartition(-candidates, count - 1)[:count]
+            best = best[np.lexsort((best, -candidates[best]))]
+
+            extended = []
+            for cell in best.tolist():
+                index, token_id = divmod(cell, scores.shape[1])
+                beam = (beams[index][0] + [token_id], float(candidates[cell]))
+                if self.is_end_of_line[token_id]:
+                    finished.append(beam)
+                else:
+                    extended.append(beam)
+            beams = extended
+
+            if len(beams) == 0:
+                break
+            # Log probabilities only fall as beams grow, so stop once no beam can overtake the finished ones.
+            if len(finished) >= beam_width and sorted(-beam[1] for beam in finished)[beam_width - 1] <= -beams[0][1]:
+                break
+
+        finished.extend(beam for beam in beams if len(beam[0]) > 0)
+        finished.sort(key=lambda beam: -beam[1])
+        return finished[:beam_width]
+
+
+    def Scorer(self, mode: str) -> NextTokenScorer:
+        """
+        The generator's scorer for a mode, made on first use, so its cache is kept between searches.
+        """
+        if mode not in self.scorers:
+            self.scorers[mode] = NextTokenScorer(self.multigram, mode)
+        return self.scorers[mode]
+
+
+    def AsString(self, token_ids) -> str:
+        """
+        The tokens of a sequence of ids as a string, separated by spaces.
+        """
+        return ' '.join(self.multigram.tokens[token_id].GetAsString() for token_id in token_ids)
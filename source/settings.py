@@ -7,7 +7,15 @@ class Settings:
     max_token_size = 20
     max_connected_tokens = 100
     decay_from_previous_activity = 2.0
-    max_tokens = 5000
+    max_tokens = 0                      # Token budget of a MultiGram, 0 for no limit.
+    token_eviction_fraction = 10        # Evict 1/10 of the budget at a time once it is exceeded.
+    softmax_base = 2.71828
+    max_connections_per_row = 0         # Exact connections kept per (token, distance), 0 to keep all.
+    sketch_width = 1 << 14              # Counters per row of the count-min sketch of pruned connections.
+    sketch_depth = 4                    # Rows of the count-min sketch of pruned connections.
+    pipeline_queue_size = 1024          # Tokens queued between the layers of a MultiGramPipeline.
+    next_token_cache_size = 1024        # Next-token distributions cached per NextTokenScorer, 0 for none.
+    settle_tick_by_tick = False         # Settle one tick per ReadTokenBehavior call, for animation or debugging.
     StartOfSequenceTokenValue = "**StartOfSequence**"
     null_distance = 0.5
     null_distance_dead = 0.2
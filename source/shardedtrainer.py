@@ -0,0 +1,138 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+import numpy as np
+
+from multigram import MultiGram
+from settings import Settings
+from tokensourcecsvstream import TokenSourceCSVStream
+
+
+def TrainShard(make_source, threshold_score: float = 0.95):
+    """
+    Train an independent MultiGram on one shard of the input.
+    The shard source provides the lead-in a single reader would still
+    remember when reaching the start of the shard, so connections that
+    cross into the shard are counted exactly once, by this shard.
+    Token frequencies, trigger times and the clock count only the shard's
+    own tokens, from the clock time the lead-in was primed at, so they add
+    up across shards as the connections do.
+    make_source: A picklable callable that makes the token source for the shard.
+    threshold_score: How similar tokens must be to be considered the same.
+    returns: The shard's tokens in id order, their frequencies, the ticks the shard took,
+             and (sources, targets, strengths) arrays per distance.
+    """
+    token_source = make_source()
+    multigram = MultiGram(token_source, threshold_score)
+
+    lead_in, after_end_of_line = token_source.GetLeadIn()
+    multigram.PrimeRecentMemory(lead_in, after_end_of_line)
+    # The lead-in was read, and counted, by the shard before.
+    multigram.token_frequency[:] = 0
+    start = multigram.clock.now
+    multigram.IngestSource()
+
+    tokens = multigram.tokens[:multigram.next_token_index]
+    for token in tokens:
+        if token is not None:
+            token.TriggerTime -= start
+    frequencies = multigram.token_frequency[:multigram.next_token_index]
+    connections = [multigram.connections.GetCoo(distance) for distance in range(1, Settings.max_token_strength + 1)]
+    return tokens, frequencies, multigram.clock.now - start, connections
+
+
+def DatasetShards(datasetname, story_count: int, shard_count: int, first_story: int = 0, split: str = 'train') -> list:
+    """
+    Split story_count stories of a dataset split, from first_story on, into shards of consecutive stories.
+    returns: A list of picklable callables, each making the token source for one shard.
+    """
+    # Imported here, so training from log files does not need the datasets package.
+    from tokensourcedataset import TokenSourceDataset
+
+    bounds = np.linspace(first_story, first_story + story_count, shard_count + 1).astype(int).tolist()
+    return [partial(TokenSourceDataset, datasetname, bounds[i + 1], bounds[i], split)
+            for i in range(shard_count) if bounds[i] < bounds[i + 1]]
+
+
+def CSVStreamShards(filename, shard_count: int) -> list:
+    """
+    Split a log file into shards of consecutive lines by byte range.
+    returns: A list of picklable callables, each making the token source for one shard.
+    """
+    bounds = np.linspace(0, os.path.getsize(filename), shard_count + 1).astype(int).tolist()
+    return [partial(TokenSourceCSVStream, filename, 0, bounds[i], bounds[i + 1])
+            for i in range(shard_count) if bounds[i] < bounds[i + 1]]
+
+
+class ShardedTrainer:
+    """
+    Train one MultiGram from shards of the input in parallel.
+    Connection strengths are sums of counts, so every shard is read by
+    its own MultiGram in a worker process, and the results are merged
+    into one MultiGram.  The merge gives the same vocabulary and the
+    same connection strengths as reading all shards in order, in one
+    process.
+    """
+    def __init__(self, workers: int = os.cpu_count(), threshold_score: float = 0.95):
+        self.workers = workers
+        self.threshold_score = threshold_score
+
+
+    def Train(self, shard_sources) -> MultiGram:
+        """
+        Train on all shards, using up to self.workers processes.
+        shard_sources: Picklable callables making the token source of each shard, in input order.
+        returns: A MultiGram holding the merged vocabulary and connections.
+        """
+        if self.workers <= 1 or len(shard_sources) <= 1:
+            results = map(TrainShard, shard_sources, repeat(self.threshold_score))
+            return self.Merge(results)
+
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(shard_sources))) as pool:
+            results = pool.map(TrainShard, shard_sources, repeat(self.threshold_score))
+            return self.Merge(results)
+
+
+    def Merge(self, results) -> MultiGram:
+        """
+        Merge the results of TrainShard, in input order, into one MultiGram.
+        Tokens of each shard are found or inserted in the merged vocabulary,
+        and the shard's connections and token frequencies are remapped to the
+        merged ids and added.  The shards' clocks run one after another, so a
+        token was last triggered in the last shard that triggered it, and the
+        merged multigram keeps evicting and decaying tokens where a single
+        reader would.
+        results: An iterable of TrainShard results.
+        returns: The merged MultiGram.
+        """
+        multigram = MultiGram(None, self.threshold_score)
+
+        for tokens, frequencies, ticks, connections in results:
+            start = multigram.clock.now
+            token_ids = []
+            for token in tokens:
+                merged_token = None
+                if token is not None:
+                    merged_token = multigram.InsertToken(token, 1.0 if token.start_of_sequence else self.threshold_score)
+                    if start + token.TriggerTime >= merged_token.TriggerTime:
+                        merged_token.TriggerTime = start + token.TriggerTime
+                        merged_token.TriggerStrength = token.TriggerStrength
+                token_ids.append(merged_token.TokenId if merged_token is not None else -1)
+            token_ids = np.array(token_ids, dtype=np.int64)
+
+            inserted = token_ids >= 0
+            np.add.at(multigram.token_frequency, token_ids[inserted], frequencies[inserted])
+            multigram.clock.now = start + ticks
+
+            for distance, (sources, targets, strengths) in enumerate(connections, 1):
+                if len(sources) == 0:
+                    continue
+
+                sources = token_ids[sources]
+                targets = token_ids[targets]
+                kept = (sources >= 0) & (targets >= 0)
+                multigram.connections.BumpMany(distance, sources[kept], targets[kept], strengths[kept])
+
+        multigram.input_source_complete = True
+        return multigram
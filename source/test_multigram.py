@@ -0,0 +1,1312 @@
+import gc
+import json
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+import pytest
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from multigram import MultiGram
+from shardedtrainer import ShardedTrainer, CSVStreamShards
+from multigramsnapshot import MultiGramSnapshot
+from nexttokenscorer import NextTokenScorer
+from distributioncache import DistributionCache
+from metrics import Metrics, MetricsSink, ConsoleSink, JsonLinesSink
+from profiler import PhaseProfiler
+import benchmark
+from evaluator import Evaluator
+from sentencegenerator import SentenceGenerator
+from multigrampipeline import MultiGramPipeline, PipelineStage
+from tokensourcecsvstream import TokenSourceCSVStream
+from settings import Settings, TokenSourceFlags
+from tokenbase import TokenBase
+from tokeninterner import TokenInterner
+from recentmemory import RecentMemory
+from connectionstore import ConnectionStore
+from countminsketch import CountMinSketch
+from tokenreference import TokenReference
+from tokensourcebase import TokenSourceBase
+from tokensourcequeue import TokenSourceQueue
+from tokensourcememory import TokenSourceMemory
+from tokenstring import TokenString
+
+
+class TokenSourceLines(TokenSourceBase):
+    """
+    Token source over a fixed list of lines, each a list of words.
+    A line ending with '.' ends with an end-of-line token.
+    """
+    def __init__(self, lines, first_line=0, end_line=None):
+        super().__init__()
+        self.lines = lines
+        self.first_line = first_line
+        self.end_line = len(lines) if end_line is None else end_line
+        self.Reset()
+
+    def IsInputAvailable(self) -> bool:
+        return len(self.pending) > 0 or self.line_index < self.end_line
+
+    def GetLineCount(self) -> int:
+        return self.line_index
+
+    def Reset(self) -> None:
+        self.line_index = self.first_line
+        self.pending = []
+
+    def GetLeadIn(self):
+        lead_in = []
+        for line in reversed(self.lines[:self.first_line]):
+            if line[-1] == '.':
+                return lead_in, True
+            lead_in = [TokenString(word) for word in line] + lead_in
+        return lead_in, False
+
+    def GetNext(self, flags: int = 0) -> TokenBase:
+        if flags & TokenSourceFlags.Flag_StartOfSequence:
+            token = TokenString(Settings.StartOfSequenceTokenValue)
+            token.start_of_sequence = True
+            return token
+
+        if len(self.pending) == 0:
+            if self.line_index >= self.end_line:
+                return None
+            self.pending = [TokenString(word) for word in self.lines[self.line_index]]
+            self.pending[-1].end_of_line = self.pending[-1].token_raw == '.'
+            self.line_index += 1
+
+        return self.pending.pop(0)
+
+
+test_lines = [
+    ['once', 'upon', 'a', 'time', '.'],
+    ['a', 'cat', 'sat', 'on', 'a', 'mat', '.'],
+    ['once', 'a', 'cat', 'ran', '.'],
+]
+
+
+def train(lines):
+    multigram = MultiGram(TokenSourceLines(lines))
+    while not multigram.input_source_complete:
+        multigram.ReadTokenBehavior()
+    return multigram
+
+
+def expected_counts(lines):
+    """
+    Count (preceding, distance, following) word triples the slow way.
+    Every line after the first starts with the start-of-sequence token.
+    """
+    counts = {}
+    for line_number, line in enumerate(lines):
+        words = line[:-1] + ['<eol>']
+        if line_number > 0:
+            words = [Settings.StartOfSequenceTokenValue] + words
+        for i in range(len(words)):
+            for distance in range(1, Settings.max_token_strength + 1):
+                if i + distance < len(words):
+                    key = (words[i], distance, words[i + distance])
+                    counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def connection_counts(multigram):
+    counts = {}
+    for token in multigram.tokens:
+        if token is not None:
+            for distance in range(1, Settings.max_token_strength + 1):
+                for synapse in multigram.GetSynapses(token, distance):
+                    counts[(token.GetAsString(), distance, synapse.FollowingToken.GetAsString())] = synapse.Strength
+    return counts
+
+
+class TestVocabulary:
+    def test_vocabulary_finds_inserted_tokens(self):
+        multigram = train(test_lines)
+
+        for word in ['once', 'upon', 'cat', Settings.StartOfSequenceTokenValue]:
+            token = multigram.FindToken(TokenString(word), threshold_score = 1.0)
+            assert token is not None
+            assert token.GetAsString() == word
+            assert multigram.FindTokenLike(TokenString(word)) is token
+
+        assert multigram.FindToken(TokenString('dog'), threshold_score = 1.0) is None
+
+    def test_vocabulary_matches_similarity_scan(self):
+        multigram = train(test_lines)
+
+        for token in multigram.tokens:
+            if token is not None:
+                reference = TokenString(token.token_raw)
+                reference.end_of_line = token.end_of_line
+                assert multigram.FindToken(reference, 1.0) is reference.FindTokenIfSeen(multigram.tokens, 1.0)
+
+    def test_references_keep_fuzzy_matching(self):
+        words = [TokenString(word) for word in ['a', 'cat', 'sat']]
+        multigram = MultiGram(None)
+        inserted = multigram.AddToken(TokenReference(words), 0.95)
+
+        similar = TokenReference([TokenString('a'), TokenString('cat'), TokenString('ran')])
+        assert multigram.FindToken(similar, 0.95) is None
+        assert multigram.FindSimilarToken(similar, 0.95) is inserted
+        multigram.match_similar_tokens = True
+        assert multigram.FindToken(similar, 0.95) is inserted
+        assert multigram.FindTokenLike(similar) is None
+        assert multigram.FindTokenLike(TokenReference(list(words))) is inserted
+
+    def test_tokens_allocate_activity_only_when_inserted(self):
+        token = TokenString('cat')
+        assert not hasattr(token, '__dict__')
+        assert token.CurrentActivityFromPreviousTokens is None
+
+        inserted = MultiGram(None).AddToken(token, 1.0)
+        assert len(inserted.CurrentActivityFromPreviousTokens) == Settings.max_token_strength
+
+
+class TestInterning:
+    def test_equal_tokens_share_an_id(self):
+        cat = TokenString('cat')
+        assert cat.InternId == TokenString('cat').InternId == TokenString.Intern('cat')
+        assert cat == TokenString('cat') and hash(cat) == hash(TokenString('cat'))
+        assert cat != TokenString('dog')
+        assert TokenInterner.MakeToken(cat.InternId) == cat
+
+    def test_end_of_line_is_its_own_token(self):
+        end_of_line = TokenString('.')
+        end_of_line.end_of_line = True
+        assert end_of_line.InternId == TokenString.Intern('', end_of_line=True)
+        assert end_of_line != TokenString('.')
+        assert not end_of_line.IsEqualTo(TokenString('<eol>'))
+
+    def test_references_compose_child_ids(self):
+        words = [TokenString(word) for word in ['a', 'cat']]
+        reference = TokenReference(words)
+        assert reference.GetVocabularyKey() == ('TokenReference', (words[0].InternId, words[1].InternId))
+        assert reference == TokenReference([TokenString('a'), TokenString('cat')])
+        assert TokenInterner.MakeToken(reference.InternId).GetAsString() == 'a cat'
+
+    def test_pickled_tokens_intern_again(self):
+        cat = TokenString('cat')
+        cat.InternId
+        copy = pickle.loads(pickle.dumps(cat))
+        assert copy.intern_id is None
+        assert copy == cat and copy.token_raw == 'cat'
+
+    def test_source_ids_match_tokens(self):
+        source = TokenSourceLines(test_lines)
+        intern_ids = source.GetNextLineIds()
+        assert intern_ids.tolist() == [TokenString(word).InternId for word in test_lines[0][:-1]] + [TokenString.Intern('', True)]
+
+    def test_released_keys_are_freed_and_their_ids_reused(self):
+        intern_id = TokenString.Intern('ephemeral')
+        TokenInterner.Acquire(intern_id)
+        ephemeral = TokenString('ephemeral')
+        assert ephemeral.InternId == intern_id
+
+        TokenInterner.Release(intern_id)
+        assert TokenInterner.Key(intern_id) is None
+        assert TokenString.Intern('reused') == intern_id
+        # A token given the freed id interns again, so it is not mistaken for the key that reused it.
+        assert ephemeral != TokenString('reused')
+        assert TokenInterner.Key(ephemeral.InternId) == ('TokenString', 'ephemeral')
+
+    def test_references_hold_their_children(self):
+        words = [TokenString('held-a'), TokenString('held-b')]
+        reference = TokenReference.Canonical(words)
+        child_ids = [word.InternId for word in words]
+
+        multigram = MultiGram(None)
+        for word in words:
+            multigram.InsertToken(word, 1.0)
+        multigram.EvictTokens(2)
+        assert [TokenInterner.Key(child_id) for child_id in child_ids] == [word.GetVocabularyKey() for word in words]
+
+        reference_id = reference.InternId
+        del reference
+        gc.collect()
+        assert TokenInterner.Key(reference_id) is None
+        assert all(TokenInterner.Key(child_id) is None for child_id in child_ids)
+
+    def test_evicted_tokens_release_their_keys(self):
+        gc.collect()
+        interned, id_space = TokenInterner.Count(), len(TokenInterner.keys)
+        lines = [[f'unique-{i}-{j}' for j in range(4)] + ['.'] for i in range(500)]
+        multigram = MultiGram(TokenSourceLines(lines), max_tokens=50)
+        multigram.IngestSource(lines_per_batch=10)
+
+        assert multigram.token_count <= 50
+        assert TokenInterner.Count() - interned <= 100
+        assert len(TokenInterner.keys) - id_space <= 100
+        assert len(multigram.token_ids_by_intern) <= max(1024, 2 * len(TokenInterner.keys))
+
+        # A multigram that is gone releases the rest.
+        del multigram
+        gc.collect()
+        assert TokenInterner.Count() <= interned + 1
+
+    def test_threads_share_the_table(self):
+        def InternAndRelease(thread):
+            for round in range(50):
+                intern_ids = [TokenString.Intern(f'threaded-{thread}-{i}') for i in range(20)]
+                for intern_id in intern_ids:
+                    TokenInterner.Acquire(intern_id)
+                assert [TokenInterner.Key(intern_id) for intern_id in intern_ids] == [('TokenString', f'threaded-{thread}-{i}') for i in range(20)]
+                for intern_id in intern_ids:
+                    TokenInterner.Release(intern_id)
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(InternAndRelease, range(8)))
+        finally:
+            sys.setswitchinterval(switch_interval)
+        assert not any(isinstance(key, tuple) and str(key[1]).startswith('threaded-') for key in TokenInterner.ids)
+        assert len(set(TokenInterner.free_ids)) == len(TokenInterner.free_ids)
+
+    def test_lookups_do_not_intern_unseen_keys(self):
+        multigram = train(test_lines)
+        unseen = [[f'unseen-{i}', 'cat', '.'] for i in range(50)]
+        gc.collect()
+        interned = TokenInterner.Count()
+
+        assert multigram.FindTokenLike(TokenString('unseen')) is None
+        assert multigram.FindToken(TokenReference([TokenString('unseen-a'), TokenString('cat')]), 1.0) is None
+        predictions = list(Evaluator().Predictions(multigram, TokenSourceLines(unseen)))
+        assert [target for _, target in predictions[::3]] == [-1] * len(unseen)
+
+        multigram.token_source = TokenSourceLines(unseen)
+        multigram.input_source_complete = False
+        while not multigram.input_source_complete:
+            multigram.FollowTokenBehavior(0.3, None)
+        assert TokenInterner.Count() == interned
+
+    def test_unpickled_multigram_indexes_its_vocabulary_again(self):
+        multigram = train(test_lines)
+        copy = pickle.loads(pickle.dumps(multigram))
+        for word in ['a', 'cat', 'sat']:
+            found = copy.FindToken(TokenString(word), 1.0)
+            assert found is not None and found.TokenId == multigram.FindToken(TokenString(word), 1.0).TokenId
+            assert copy.token_ids_by_intern[found.InternId] == found.TokenId
+
+
+class TestCanonicalReferences:
+    def test_identical_references_are_one_object(self):
+        reference = TokenReference.Canonical([TokenString('a'), TokenString('cat')])
+        assert TokenReference.Canonical([TokenString('a'), TokenString('cat')]) is reference
+        assert TokenReference.Canonical([TokenString('a'), TokenString('dog')]) is not reference
+        assert reference.InternId == TokenReference([TokenString('a'), TokenString('cat')]).InternId
+
+    def test_shared_reference_in_two_multigrams(self):
+        reference = TokenReference.Canonical([TokenString('a'), TokenString('cat')])
+        first = MultiGram(None)
+        second = MultiGram(None)
+        second.AddToken(TokenString('the'), 1.0)
+
+        assert first.AddToken(reference, 0.95) is reference
+        copy = second.AddToken(reference, 0.95)
+        assert copy is not reference and copy == reference
+        assert (reference.TokenId, copy.TokenId) == (0, 1)
+        assert second.FindToken(TokenReference.Canonical([TokenString('a'), TokenString('cat')]), 0.95) is copy
+
+
+class TestRecentMemory:
+    def test_ring_buffer_keeps_newest_first(self):
+        recent = RecentMemory(4)
+        assert recent.Ids().tolist() == []
+
+        for token_id in range(6):
+            recent.Advance(token_id)
+        assert recent.Ids().tolist() == [5, 4, 3, 2]
+
+        recent.Clear()
+        recent.Advance(7)
+        assert len(recent) == 1 and recent.Ids().tolist() == [7]
+
+
+class TestDecay:
+    def test_strength_decays_with_the_clock(self):
+        multigram = MultiGram(None)
+        token = multigram.AddToken(TokenString('cat'), 1.0)
+        assert token.CurrentStrength == Settings.max_token_strength
+
+        multigram.Tick()
+        assert token.CurrentStrength == Settings.max_token_strength - 1
+
+        multigram.Tick(5)
+        assert token.CurrentStrength == Settings.max_token_strength - 6
+
+        token.TriggerToken()
+        assert token.CurrentStrength == Settings.max_token_strength
+
+        multigram.Tick(Settings.max_token_strength + 3)
+        assert token.CurrentStrength == 0
+
+    def test_tokens_without_clock_tick_themselves(self):
+        token = TokenString('cat')
+        token.TriggerToken()
+        token.Tick()
+        assert token.CurrentStrength == Settings.max_token_strength - 1
+
+
+class TestConnections:
+    def test_connection_counts(self):
+        multigram = train(test_lines)
+        assert connection_counts(multigram) == expected_counts(test_lines)
+
+    def test_softmax_rows_sum_to_one(self):
+        multigram = train(test_lines)
+        multigram.Softmax()
+
+        once = multigram.FindTokenLike(TokenString('once'))
+        targets, strengths, softmax = multigram.connections.Row(once.TokenId, 1)
+        assert len(targets) == 2
+        assert softmax.sum() == pytest.approx(1.0)
+
+    def test_softmax_does_not_overflow(self):
+        multigram = MultiGram(None)
+        upon = multigram.AddToken(TokenString('upon'), 1.0)
+        a = multigram.AddToken(TokenString('a'), 1.0)
+        the = multigram.AddToken(TokenString('the'), 1.0)
+        multigram.connections.BumpMany(1, np.array([upon.TokenId, upon.TokenId]), np.array([a.TokenId, the.TokenId]), np.array([5000, 1]))
+        multigram.Softmax()
+
+        assert multigram.connections.SoftmaxStrength(upon.TokenId, 1, a.TokenId) == pytest.approx(1.0)
+        assert multigram.connections.SoftmaxStrength(upon.TokenId, 1, the.TokenId) == pytest.approx(0.0)
+
+    def test_softmax_is_current_during_training(self):
+        multigram = MultiGram(TokenSourceLines(test_lines * 4))
+        once = None
+        while not multigram.input_source_complete:
+            multigram.ReadTokenBehavior()
+            once = once or multigram.FindTokenLike(TokenString('once'))
+            if once is not None:
+                for distance in [1, 2, 5]:
+                    targets, strengths, softmax = multigram.connections.Row(once.TokenId, distance)
+                    expected = [Settings.softmax_base ** strength for strength in strengths.tolist()]
+                    assert softmax.tolist() == pytest.approx([value / sum(expected) for value in expected])
+
+    def test_unread_dirty_rows_stay_bounded(self):
+        store = ConnectionStore(2)
+        for i in range(10 * ConnectionStore.dirty_batch_limit):
+            store.BumpMany(1, np.array([i % 3, 1]), np.array([i % 5, 2]))
+        assert len(store.dirty_row_batches[0]) < ConnectionStore.dirty_batch_limit
+        assert sum(len(rows) for rows in store.dirty_row_batches[0]) < 2 * ConnectionStore.dirty_batch_limit
+
+        store.RefreshSoftmax(1)
+        for source in range(3):
+            targets, strengths, softmax = store.Row(source, 1)
+            expected = [Settings.softmax_base ** strength for strength in strengths.tolist()]
+            assert softmax.tolist() == pytest.approx([value / sum(expected) for value in expected])
+
+    def test_follow_token(self):
+        multigram = train(test_lines)
+        multigram.most_recently_followed_token = multigram.FindTokenLike(TokenString('once'))
+
+        synapse = multigram.FollowToken(multigram.FindTokenLike(TokenString('upon')))
+        assert synapse.FollowingToken.GetAsString() == 'upon'
+        assert synapse.Strength == 1
+        assert multigram.FollowToken(multigram.FindTokenLike(TokenString('time'))) is None
+
+
+class TestSettle:
+    def test_fast_settle_matches_tick_by_tick(self):
+        expected = MultiGram(TokenSourceLines(test_lines), settle_tick_by_tick=True)
+        expected_calls = 0
+        while not expected.input_source_complete:
+            expected.ReadTokenBehavior()
+            expected_calls += 1
+
+        multigram = MultiGram(TokenSourceLines(test_lines))
+        calls = 0
+        while not multigram.input_source_complete:
+            multigram.ReadTokenBehavior()
+            calls += 1
+
+        assert calls == expected_calls - len(test_lines) * (Settings.max_token_strength - 1)
+        assert connection_counts(multigram) == connection_counts(expected)
+        assert multigram.clock.now == expected.clock.now
+        assert [token.CurrentStrength for token in multigram.tokens] == [token.CurrentStrength for token in expected.tokens]
+        assert multigram.recent.Ids().tolist() == expected.recent.Ids().tolist()
+
+
+class TestSuccessors:
+    def test_top_successors_are_strongest_first(self):
+        store = ConnectionStore(1)
+        store.BumpMany(1, np.array([0, 0, 0, 0, 0, 0, 1]), np.array([5, 3, 3, 9, 9, 9, 3]))
+        assert store.TopSuccessors(0, 1)[0].tolist() == [9, 3, 5]
+        assert store.TopSuccessors(0, 1, 2)[1].tolist() == [3, 2]
+        assert store.TopSuccessors(7, 1)[0].tolist() == []
+        assert store.IsSuccessor(0, 1, 5) and not store.IsSuccessor(1, 1, 5)
+
+        store.BumpMany(1, np.array([0, 0, 0]), np.array([5, 5, 5]))
+        assert store.TopSuccessors(0, 1, 1)[0].tolist() == [5]
+
+    def test_top_synapses_match_synapses(self):
+        multigram = train(TestIngestLines.lines)
+        for token in multigram.tokens:
+            synapses = multigram.GetSynapses(token, 2)
+            top = multigram.GetTopSynapses(token, 2)
+            assert sorted((synapse.Strength, synapse.FollowingToken.TokenId) for synapse in synapses) == \
+                sorted((synapse.Strength, synapse.FollowingToken.TokenId) for synapse in top)
+            assert [synapse.Strength for synapse in top] == sorted((synapse.Strength for synapse in top), reverse=True)
+
+
+def dict_scores(multigram, history, mode):
+    """
+    The next-token scores of tokentests.py, computed with its dict loops.
+    """
+    likely_tokens = {}
+    history_length = min(len(history), Settings.max_token_strength)
+    for distance in range(1, history_length + 1):
+        if mode == 'intersect':
+            distance_multiplier = (history_length - distance + 1) / history_length
+        else:
+            distance_multiplier = len(history) - distance + 1
+
+        pruned_tokens = {}
+        targets, _, softmax = multigram.connections.Row(history[-distance], distance)
+        for target, softmax_strength in zip(targets.tolist(), softmax.tolist()):
+            if distance == 1:
+                likely_tokens[target] = softmax_strength * distance_multiplier
+            elif target in likely_tokens:
+                pruned_tokens[target] = likely_tokens[target] + softmax_strength * distance_multiplier
+                if mode == 'support':
+                    likely_tokens[target] = pruned_tokens[target]
+
+        if distance > 1 and mode == 'intersect':
+            likely_tokens = pruned_tokens
+
+    return likely_tokens
+
+
+class TestNextTokenScorer:
+    lines = test_lines + [
+        ['the', 'quick', 'brown', 'fox', 'sleeps'],
+        ['a', 'quick', 'brown', 'dog', 'sleeps'],
+    ]
+
+    def histories(self, multigram):
+        rng = np.random.default_rng(3)
+        histories = [rng.integers(0, len(multigram.tokens), size=length).tolist() for length in (1, 2, 3, 5, 8, 25)]
+        histories += [[multigram.FindToken(TokenString(word), 1.0).TokenId for word in line if word != '.'] for line in self.lines]
+        return histories
+
+    @pytest.mark.parametrize('mode', NextTokenScorer.modes)
+    def test_scores_match_dict_loops(self, mode):
+        multigram = train(self.lines)
+        histories = self.histories(multigram)
+        scores = NextTokenScorer(multigram, mode).ScoreBatch(histories + [[]])
+        assert scores.shape == (len(histories) + 1, len(multigram.tokens))
+        assert np.isneginf(scores[-1]).all()
+
+        for history, row in zip(histories, scores):
+            expected = dict_scores(multigram, history, mode)
+            assert np.flatnonzero(np.isfinite(row)).tolist() == sorted(expected)
+            for target, score in expected.items():
+                assert row[target] == pytest.approx(score)
+
+    @pytest.mark.parametrize('mode', NextTokenScorer.modes)
+    def test_best_next_tokens(self, mode):
+        multigram = train(self.lines)
+        histories = self.histories(multigram)
+        scorer = NextTokenScorer(multigram, mode)
+        best, best_scores = scorer.BestNextTokens(histories)
+        for history, token_id, score in zip(histories, best.tolist(), best_scores.tolist()):
+            expected = dict_scores(multigram, history, mode)
+            if len(expected) == 0:
+                assert token_id == -1 and score == -np.inf
+            else:
+                assert score == pytest.approx(max(expected.values()))
+                assert scorer.BestNextToken(history) == (token_id, score)
+
+        quick = multigram.FindToken(TokenString('quick'), 1.0).TokenId
+        brown = multigram.FindToken(TokenString('brown'), 1.0).TokenId
+        assert scorer.BestNextToken([quick])[0] == brown
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            NextTokenScorer(train(self.lines), 'average')
+
+
+class TestDistributionCache:
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = DistributionCache(2)
+        cache.Validate(0)
+        cache.Put('a', 1)
+        cache.Put('b', 2)
+        assert cache.Get('a') == 1
+        cache.Put('c', 3)
+        assert cache.Get('b') is None and cache.Get('a') == 1 and cache.Get('c') == 3
+        assert (cache.hits, cache.misses, cache.evictions) == (3, 1, 1)
+        assert cache.HitRate() == 0.75
+
+        cache.Validate(1)
+        assert len(cache) == 0 and cache.invalidations == 1
+        assert cache.Statistics()['size'] == 0
+
+    @pytest.mark.parametrize('mode', NextTokenScorer.modes)
+    def test_cached_scores_match_computed(self, mode):
+        multigram = train(TestNextTokenScorer.lines)
+        histories = TestNextTokenScorer().histories(multigram)
+        cached = NextTokenScorer(multigram, mode, cache_size=len(histories))
+        uncached = NextTokenScorer(multigram, mode, cache_size=0)
+
+        expected = uncached.ScoreBatch(histories)
+        assert np.array_equal(cached.ScoreBatch(histories), expected)
+        assert cached.cache.hits == 0
+        assert np.array_equal(cached.ScoreBatch(histories), expected)
+        assert cached.cache.hits == len(histories)
+        assert np.array_equal(cached.Scores(histories[0]), expected[0])
+
+    def test_changed_connections_invalidate(self):
+        multigram = train(TestNextTokenScorer.lines)
+        scorer = NextTokenScorer(multigram, 'support', cache_size=4)
+        quick = multigram.FindToken(TokenString('quick'), 1.0).TokenId
+        a = multigram.FindToken(TokenString('a'), 1.0).TokenId
+        before = scorer.Scores([quick])
+        assert np.isneginf(before[a])
+
+        multigram.connections.BumpMany(1, np.array([quick]), np.array([a]), np.array([5]))
+        after = scorer.Scores([quick])
+        assert np.isfinite(after[a]) and scorer.cache.invalidations == 1
+        assert np.array_equal(after, NextTokenScorer(multigram, 'support', cache_size=0).Scores([quick]))
+
+    def test_support_keys_include_long_history_lengths(self):
+        multigram = train(TestNextTokenScorer.lines)
+        scorer = NextTokenScorer(multigram, 'support', history_length=2)
+        assert scorer.CacheKey([1, 2]) == (1, 2)
+        assert scorer.CacheKey([0, 1, 2]) != scorer.CacheKey([5, 0, 1, 2])
+        assert NextTokenScorer(multigram, 'intersect', history_length=2).CacheKey([5, 0, 1, 2]) == (1, 2)
+
+
+class TestMetrics:
+    def collect(self, read):
+        sink = ConsoleSink(interval_seconds=3600.0)
+        previous = Metrics.SetSink(sink)
+        try:
+            multigram = MultiGram(TokenSourceLines(test_lines))
+            read(multigram)
+        finally:
+            Metrics.SetSink(previous)
+        return sink, multigram
+
+    def test_null_sink_by_default(self):
+        assert type(Metrics.sink) is MetricsSink
+        assert type(Metrics.SetSink(None)) is MetricsSink
+
+    def test_token_and_line_counts(self):
+        def read(multigram):
+            while not multigram.input_source_complete:
+                multigram.ReadTokenBehavior()
+
+        sink, multigram = self.collect(read)
+        assert sink.counters['lines'] == len(test_lines)
+        assert sink.counters['tokens'] == sum(len(line) for line in test_lines) + len(test_lines)
+        assert sink.gauges['vocabulary_size'] == multigram.CountUsedTokens()
+
+        ingested, _ = self.collect(lambda multigram: multigram.IngestSource())
+        assert ingested.counters == sink.counters
+
+    def test_reports_are_rate_limited(self, capsys):
+        sink = ConsoleSink(interval_seconds=3600.0)
+        for _ in range(1000):
+            sink.Count('tokens')
+        assert capsys.readouterr().out == ''
+
+        sink.Gauge('vocabulary_size', 7)
+        sink.Flush()
+        sink.Message('done')
+        out = capsys.readouterr().out
+        assert 'tokens 1000' in out and 'vocabulary_size 7' in out and out.endswith('done\n')
+
+        sink.interval_seconds = 0.0
+        sink.Count('tokens')
+        assert 'tokens 1001' in capsys.readouterr().out
+
+    def test_json_lines(self, tmp_path):
+        filename = tmp_path / 'metrics.jsonl'
+        sink = JsonLinesSink(str(filename), interval_seconds=3600.0)
+        sink.Count('lines', 3)
+        sink.Message('halfway')
+        sink.Flush()
+        pickle.loads(pickle.dumps(sink)).Message('copied')
+
+        records = [json.loads(line) for line in filename.read_text().splitlines()]
+        assert [record['type'] for record in records] == ['message', 'metrics', 'message']
+        assert records[1]['counters'] == {'lines': 3} and records[1]['rates']['lines'] > 0
+        assert records[2]['text'] == 'copied'
+
+
+class TestProfiler:
+    def test_profiled_training_is_unchanged(self):
+        multigram = MultiGram(TokenSourceLines(test_lines))
+        profiler = multigram.EnableProfiling(PhaseProfiler(sample_every=2, trace_capacity=10))
+        while not multigram.input_source_complete:
+            multigram.ReadTokenBehavior()
+
+        assert connection_counts(multigram) == connection_counts(train(test_lines))
+        summary = profiler.Summary()
+        token_count = sum(len(line) for line in test_lines)
+        # Every token, the start-of-sequence token after each line, and the end of the input.
+        assert summary['Source.GetNext']['calls'] == token_count + len(test_lines) + 1
+        assert summary['MultiGram.AddToken']['calls'] == token_count + len(test_lines)
+        assert summary['MultiGram.ReadTokenBehavior']['total_seconds'] >= summary['MultiGram.AddToken']['total_seconds']
+        assert 'ConnectionStore.BumpWindow' in summary
+        statistics = profiler.phases['MultiGram.AddToken']
+        assert statistics.histogram.sum() == statistics.calls // 2
+        assert 0 < statistics.Percentile(0.5) <= statistics.Percentile(0.99)
+        assert len(profiler.trace) == 10
+        assert 'MultiGram.AddToken' in profiler.Report()
+
+    def test_disabling_restores_methods(self):
+        multigram = MultiGram(TokenSourceLines(test_lines))
+        profiler = multigram.EnableProfiling()
+        assert 'AddToken' in vars(multigram) and 'GetNext' in vars(multigram.token_source)
+
+        multigram.DisableProfiling()
+        assert 'AddToken' not in vars(multigram) and 'BumpWindow' not in vars(multigram.connections)
+        assert 'GetNext' not in vars(multigram.token_source) and multigram.profiler is None
+        multigram.ReadTokenBehavior()
+        assert profiler.Summary() == {}
+
+    def test_chrome_trace(self, tmp_path):
+        multigram = MultiGram(TokenSourceLines(test_lines))
+        profiler = multigram.EnableProfiling(PhaseProfiler(sample_every=1))
+        multigram.IngestSource()
+        filename = tmp_path / 'trace.json'
+        profiler.WriteChromeTrace(str(filename))
+
+        trace = json.loads(filename.read_text())
+        names = {event['name'] for event in trace['traceEvents']}
+        assert {'MultiGram.IngestLines', 'Source.GetNextLineIds', 'ConnectionStore.BumpMany'} <= names
+        assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in trace['traceEvents'])
+
+        profiler.Reset()
+        assert len(profiler.trace) == 0 and profiler.Summary() == {}
+
+
+class TestBenchmark:
+    def test_zipf_corpus_is_deterministic(self):
+        corpus = benchmark.ZipfCorpus(50, 200, 3, 6, seed=4)
+        assert corpus == benchmark.ZipfCorpus(50, 200, 3, 6, seed=4)
+        assert corpus != benchmark.ZipfCorpus(50, 200, 3, 6, seed=5)
+        assert len(corpus) == 200 and all(3 <= len(line) <= 6 for line in corpus)
+
+        counts = {}
+        for word in (word for line in corpus for word in line):
+            counts[word] = counts.get(word, 0) + 1
+        assert max(counts, key=counts.get) == 'w0'
+
+    def test_memory_source_reads_like_ingestion(self):
+        corpus = benchmark.ZipfCorpus(30, 50, seed=1)
+        read = benchmark.ReadAll(MultiGram(TokenSourceMemory(corpus)))
+        ingested = benchmark.IngestAll(MultiGram(TokenSourceMemory(corpus)))
+        assert connection_counts(read) == connection_counts(ingested)
+        assert read.InputLineCount() == len(corpus)
+
+    def test_eager_baseline_allocates_every_distance_list(self):
+        token = benchmark.EagerTokenString('cat')
+        per_distance = [value for value in vars(token).values() if isinstance(value, list)]
+        assert len(per_distance) == 6 and all(len(value) == Settings.max_token_strength for value in per_distance)
+
+        allocation = benchmark.BenchmarkTokenAllocation(1000)
+        assert allocation['eager']['bytes_per_token'] > allocation['slotted_inserted']['bytes_per_token'] > allocation['slotted_transient']['bytes_per_token']
+
+    def test_suite_writes_results(self, tmp_path):
+        results = benchmark.RunSuite(vocabulary_sizes=(20,), line_count=30, measure_memory=False, allocation_count=100)
+        filename = tmp_path / 'results.json'
+        benchmark.WriteResults(results, str(filename))
+
+        loaded = json.loads(filename.read_text())
+        case = loaded['cases']['vocabulary_20']
+        assert loaded['parameters']['line_count'] == 30
+        assert case['read_tokens_per_second'] > 0 and case['best_next_token_seconds'] > 0
+        assert 'python' in loaded['environment']
+
+
+class TestSentenceGenerator:
+    lines = TestNextTokenScorer.lines
+
+    def test_sampling_follows_softmax(self):
+        multigram = train(self.lines)
+        a = multigram.FindToken(TokenString('a'), 1.0).TokenId
+        targets, _, softmax = multigram.connections.Row(a, 1)
+
+        sampled = SentenceGenerator(multigram, seed=1).SampleNext(np.full(20000, a))
+        frequencies = np.bincount(sampled, minlength=len(multigram.tokens))[targets] / len(sampled)
+        assert np.abs(frequencies - softmax).max() < 0.02
+        assert SentenceGenerator(multigram).SampleNext([len(multigram.tokens) + 5, -1]).tolist() == [-1, -1]
+
+    def test_top_k_and_temperature(self):
+        multigram = train(self.lines)
+        a = multigram.FindToken(TokenString('a'), 1.0).TokenId
+        strongest = multigram.connections.TopSuccessors(a, 1, 2)[0].tolist()
+
+        assert set(SentenceGenerator(multigram, top_k=1).SampleNext(np.full(100, a)).tolist()) == {strongest[0]}
+        assert set(SentenceGenerator(multigram, top_k=2, seed=1).SampleNext(np.full(1000, a)).tolist()) == set(strongest)
+        cold = SentenceGenerator(multigram, temperature=0.05, seed=1).SampleNext(np.full(1000, a))
+        assert (cold == strongest[0]).mean() > 0.99
+        with pytest.raises(ValueError):
+            SentenceGenerator(multigram, temperature=0.0)
+
+    def test_batch_samples_follow_connections(self):
+        multigram = train(self.lines)
+        generator = SentenceGenerator(multigram, seed=2)
+        start = generator.StartToken().TokenId
+
+        sequences = generator.Sample(200, max_length=6)
+        assert len(sequences) == 200
+        for sequence in sequences:
+            assert 0 < len(sequence) <= 6
+            for before, after in zip([start] + sequence, sequence):
+                assert multigram.connections.IsSuccessor(before, 1, after)
+            assert all(not generator.is_end_of_line[token_id] for token_id in sequence[:-1])
+            assert generator.is_end_of_line[sequence[-1]] or len(sequence) == 6
+
+        assert len(generator.SampleStrings(3)) == 3
+
+    def test_beam_search(self):
+        multigram = train(self.lines)
+        generator = SentenceGenerator(multigram)
+        quick = multigram.FindToken(TokenString('quick'), 1.0).TokenId
+
+        beams = generator.BeamSearch([quick], beam_width=3, max_length=4)
+        assert 0 < len(beams) <= 3
+        assert [log_probability for _, log_probability in beams] == sorted((log_probability for _, log_probability in beams), reverse=True)
+        for sequence, log_probability in beams:
+            assert log_probability <= 0.0
+            for before, after in zip([quick] + sequence, sequence):
+                assert multigram.connections.IsSuccessor(before, 1, after)
+
+        # A beam of width one is greedy.
+        scorer = NextTokenScorer(multigram, 'support')
+        greedy = [quick]
+        for _ in range(4):
+            token_id, _ = scorer.BestNextToken(greedy)
+            if token_id < 0:
+                break
+            greedy.append(token_id)
+            if generator.is_end_of_line[token_id]:
+                break
+        assert generator.BeamSearch([quick], beam_width=1, max_length=4)[0][0] == greedy[1:]
+
+
+class TestBoundedConnections:
+    def skewed_bumps(self):
+        rng = np.random.default_rng(3)
+        targets = rng.zipf(1.5, 20000) % 500
+        return np.zeros(len(targets), dtype=np.int64), targets.astype(np.int64)
+
+    def test_rows_keep_the_strongest_connections(self):
+        sources, targets = self.skewed_bumps()
+        exact = ConnectionStore(1)
+        bounded = ConnectionStore(1, top_k=8)
+        for start in range(0, len(sources), 1000):
+            for store in (exact, bounded):
+                store.BumpMany(1, sources[start:start + 1000], targets[start:start + 1000])
+                store.Compact()
+
+        exact_targets, exact_strengths, _ = exact.Row(0, 1)
+        bounded_targets, bounded_strengths, softmax = bounded.Row(0, 1)
+        assert len(bounded_targets) == 8
+        assert sorted(bounded_targets.tolist()) == sorted(exact_targets[np.argsort(-exact_strengths)[:8]].tolist())
+        assert softmax.sum() == pytest.approx(1.0, abs=1e-5)
+
+        error_bound, confidence = bounded.TailErrorBound(1)
+        assert 0 < confidence < 1
+        for target, strength in zip(bounded_targets.tolist(), bounded_strengths.tolist()):
+            assert exact.Strength(0, 1, target) <= strength <= exact.Strength(0, 1, target) + error_bound
+
+        pruned = np.setdiff1d(exact_targets, bounded_targets)
+        for target in pruned.tolist():
+            assert exact.Strength(0, 1, target) <= bounded.TailEstimate(0, 1, target) <= exact.Strength(0, 1, target) + error_bound
+
+    def test_pruned_connections_are_promoted(self):
+        store = ConnectionStore(1, top_k=2)
+        store.BumpMany(1, np.zeros(5, dtype=np.int64), np.array([1, 1, 1, 2, 2]))
+        store.BumpMany(1, np.zeros(1, dtype=np.int64), np.array([3]))
+        store.Compact()
+        assert store.Row(0, 1)[0].tolist() == [1, 2]
+        assert store.TailEstimate(0, 1, 3) >= 1
+
+        store.BumpMany(1, np.zeros(3, dtype=np.int64), np.array([3, 3, 3]))
+        targets, strengths, _ = store.Row(0, 1)
+        assert targets.tolist() == [1, 3]
+        assert strengths.tolist()[1] >= 4
+
+    def test_reused_ids_start_without_a_tail(self):
+        store = ConnectionStore(1, top_k=1)
+        store.BumpMany(1, np.zeros(10, dtype=np.int64), np.ones(10, dtype=np.int64))
+        store.BumpMany(1, np.zeros(9, dtype=np.int64), np.full(9, 2))
+        store.Compact()
+        assert store.TailEstimate(0, 1, 2) == 9
+
+        store.RemoveTokens(np.array([2]))
+        store.BumpMany(1, np.zeros(1, dtype=np.int64), np.array([2]))
+        store.Compact()
+        assert store.TailEstimate(0, 1, 2) == 1
+        assert store.Row(0, 1)[0].tolist() == [1]
+
+    def test_evicted_tokens_leave_no_tail(self):
+        multigram = MultiGram(TokenSourceLines(TestTokenBudget.lines), max_tokens=20, max_connections=2)
+        multigram.IngestSource(lines_per_batch=3)
+        assert len(multigram.tokens) < 30
+
+        connections = multigram.connections
+        words = multigram.FindTokenLike(TokenString('words')).TokenId
+        rare = multigram.FindTokenLike(TokenString('rare199')).TokenId
+        assert max(connections.Strength(words, 1, rare), connections.TailEstimate(words, 1, rare)) == 1
+
+    def test_sketch_never_underestimates(self):
+        sketch = CountMinSketch(64, 3)
+        keys = np.arange(1000, dtype=np.int64) << 32
+        sketch.Add(keys, np.ones(1000, dtype=np.int64))
+        estimates = sketch.Estimate(keys)
+        assert (estimates >= 1).all()
+        assert sketch.ErrorBound() == pytest.approx(np.e / 64 * 1000)
+
+
+class TestIngestLines:
+    lines = test_lines + [
+        ['the', 'cat', 'said', 'hi', '!'],
+        ['and', 'the', 'dog', 'said'] + ['very'] * 20 + ['loudly', '.'],
+        ['once', 'more'],
+    ]
+
+    def test_ingest_matches_token_by_token(self):
+        expected = train(self.lines)
+
+        for lines_per_batch in [1, 2, 1000]:
+            multigram = MultiGram(TokenSourceLines(self.lines))
+            multigram.IngestSource(lines_per_batch)
+
+            assert multigram.input_source_complete
+            assert [token.GetAsString() for token in multigram.tokens if token is not None] == \
+                [token.GetAsString() for token in expected.tokens if token is not None]
+            assert connection_counts(multigram) == connection_counts(expected)
+            assert multigram.clock.now == expected.clock.now
+            assert [token.CurrentStrength for token in multigram.tokens if token is not None] == \
+                [token.CurrentStrength for token in expected.tokens if token is not None]
+            assert multigram.recent.Ids().tolist() == expected.recent.Ids().tolist()
+            assert multigram.token_frequency.tolist() == expected.token_frequency.tolist()
+            assert [token.TriggerTime for token in multigram.tokens if token is not None] == \
+                [token.TriggerTime for token in expected.tokens if token is not None]
+
+    def test_ingest_continues_token_by_token_state(self):
+        expected = train(self.lines)
+
+        multigram = MultiGram(TokenSourceLines(self.lines), settle_tick_by_tick=True)
+        for _ in range(9):
+            multigram.ReadTokenBehavior()
+        assert multigram.settle_count > 0
+        multigram.IngestSource()
+
+        assert connection_counts(multigram) == connection_counts(expected)
+        # The start-of-sequence token gets a different id, so tokens are matched by string.
+        assert {token.GetAsString(): token.TriggerTime for token in multigram.tokens if token is not None} == \
+            {token.GetAsString(): token.TriggerTime for token in expected.tokens if token is not None}
+
+
+class TestCSVStream:
+    content = ('2024-05-01T12:00:00.000001+00:00 host kernel: started\n'
+               'a  b\n'
+               '\n'
+               'caf\u00e9 \u00fcber 2024-05-01 x\r\n'
+               '2024-05-01T12:00:01.000002-02:00\n'
+               'no newline at the end').encode()
+
+    def read(self, filename, *args):
+        source = TokenSourceCSVStream(filename, *args)
+        tokens = []
+        while (token := source.GetNext()) is not None:
+            tokens.append((type(token).__name__, token.GetAsString() if isinstance(token, TokenString) else None, getattr(token, 'end_of_line', False)))
+        return tokens
+
+    def read_ids(self, filename, *args):
+        source = TokenSourceCSVStream(filename, *args)
+        lines = []
+        while len(ids := source.GetNextLineIds()) > 0:
+            lines.append([TokenInterner.Key(intern_id) for intern_id in ids.tolist()])
+        return lines
+
+    def test_fields_and_timestamps(self, tmp_path):
+        filename = tmp_path / 'syslog'
+        filename.write_bytes(self.content)
+
+        lines = self.read_ids(str(filename))
+        assert len(lines) == 6
+        assert lines[0][0] == ('TokenTimestamp',) and lines[4][0] == ('TokenTimestamp',)
+        assert lines[1] == [('TokenString', 'a'), ('TokenString', ''), ('TokenString', 'b'), ('TokenString', None)]
+        assert lines[3][:3] == [('TokenString', 'caf\u00e9'), ('TokenString', '\u00fcber'), ('TokenString', '2024-05-01')]
+        assert lines[5][-2] == ('TokenString', 'end')
+
+        tokens = self.read(str(filename))
+        assert tokens[0][0] == 'TokenTimestamp'
+        assert sum(end_of_line for _, _, end_of_line in tokens) == 6
+
+    @pytest.mark.parametrize('block_size', [1, 5, 64])
+    def test_block_boundaries(self, tmp_path, monkeypatch, block_size):
+        filename = tmp_path / 'syslog'
+        filename.write_bytes(self.content * 3)
+        expected_tokens, expected_ids = self.read(str(filename)), self.read_ids(str(filename))
+
+        monkeypatch.setattr(TokenSourceCSVStream, 'block_size', block_size)
+        assert self.read(str(filename)) == expected_tokens
+        assert self.read_ids(str(filename)) == expected_ids
+
+    def test_byte_ranges_read_every_line_once(self, tmp_path, monkeypatch):
+        filename = tmp_path / 'syslog'
+        filename.write_bytes(self.content.replace(b'at the end', b'\n') * 5)
+        monkeypatch.setattr(TokenSourceCSVStream, 'block_size', 16)
+
+        size = len(filename.read_bytes())
+        bounds = [0, 7, 40, 41, 100, size]
+        sharded = [line for start, end in zip(bounds[:-1], bounds[1:]) for line in self.read_ids(str(filename), 0, start, end)]
+        assert sharded == self.read_ids(str(filename))
+
+    def test_max_lines(self, tmp_path):
+        filename = tmp_path / 'syslog'
+        filename.write_bytes(self.content)
+        source = TokenSourceCSVStream(str(filename), 3)
+        while len(source.GetNextLineIds()) > 0:
+            pass
+        assert source.GetLineCount() == 2
+
+
+class TestCSVStreamFollow:
+    @pytest.fixture(autouse=True)
+    def fast_polling(self, monkeypatch):
+        monkeypatch.setattr(TokenSourceCSVStream, 'poll_seconds', 0.005)
+        monkeypatch.setattr(TokenSourceCSVStream, 'max_poll_seconds', 0.02)
+
+    def lines(self, source):
+        lines = []
+        while len(ids := source.GetNextLineIds()) > 0:
+            lines.append(' '.join(TokenInterner.Key(intern_id)[1] for intern_id in ids.tolist()[:-1]))
+        return lines
+
+    def test_follows_appended_lines(self, tmp_path):
+        filename = tmp_path / 'syslog'
+        filename.write_text('one\ntwo\nhalf')
+
+        def append():
+            time.sleep(0.05)
+            with open(filename, 'a') as file:
+                file.write(' a line\nthree\n')
+
+        writer = threading.Thread(target=append)
+        writer.start()
+        source = TokenSourceCSVStream(str(filename), follow=True, idle_seconds=0.3)
+        assert self.lines(source) == ['one', 'two', 'half a line', 'three']
+        writer.join()
+
+    def test_stop_event_ends_the_stream(self, tmp_path):
+        filename = tmp_path / 'syslog'
+        filename.write_text('one\n')
+        stop_event = threading.Event()
+        stop_event.set()
+        source = TokenSourceCSVStream(str(filename), follow=True, stop_event=stop_event)
+        assert self.lines(source) == ['one']
+
+    def test_follow_has_no_end_offset(self, tmp_path):
+        filename = tmp_path / 'syslog'
+        filename.write_text('one\n')
+        with pytest.raises(ValueError):
+            TokenSourceCSVStream(str(filename), 0, 0, 4, follow=True)
+
+    def test_rotation_and_truncation(self, tmp_path):
+        filename = tmp_path / 'syslog'
+        filename.write_text('one\n')
+        source = TokenSourceCSVStream(str(filename), follow=True, idle_seconds=0.1)
+        assert self.lines(source) == ['one']
+
+        # Rotated: the rest of the old file, then the new file.
+        with open(filename, 'a') as file:
+            file.write('two\nend of old')
+        os.rename(filename, tmp_path / 'syslog.1')
+        filename.write_text('new\n')
+        source.end_of_stream = False
+        assert self.lines(source) == ['two', 'end of old', 'new']
+
+        # Truncated and written again.
+        filename.write_text('x\n')
+        source.end_of_stream = False
+        assert self.lines(source) == ['x']
+
+    def test_resumes_at_saved_offset(self, tmp_path):
+        filename = tmp_path / 'syslog'
+        offset_filename = str(tmp_path / 'syslog.offset')
+        filename.write_text('one two\nthree\npartial')
+
+        with TokenSourceCSVStream(str(filename), follow=True, offset_filename=offset_filename, idle_seconds=0.05) as source:
+            assert self.lines(source) == ['one two', 'three']
+        assert json.load(open(offset_filename))['offset'] == len('one two\nthree\n')
+
+        with open(filename, 'a') as file:
+            file.write(' line\nfour\n')
+        with TokenSourceCSVStream(str(filename), offset_filename=offset_filename) as source:
+            assert source.GetLeadIn() == ([], True)
+            assert self.lines(source) == ['partial line', 'four']
+
+        # Stopped part way through a line, it is read again from its start.
+        filename.write_text('five six\n' * 3)
+        with TokenSourceCSVStream(str(filename), offset_filename=offset_filename) as source:
+            assert source.GetNext().GetAsString() == 'five'
+        with TokenSourceCSVStream(str(filename), offset_filename=offset_filename) as source:
+            assert self.lines(source) == ['five six'] * 3
+        assert json.load(open(offset_filename))['offset'] == filename.stat().st_size
+
+    def test_live_ingestion(self, tmp_path):
+        filename = tmp_path / 'syslog'
+        filename.write_text('the cat sat .\n')
+        multigram = MultiGram(TokenSourceCSVStream(str(filename), follow=True, idle_seconds=0.2))
+
+        def append():
+            time.sleep(0.05)
+            with open(filename, 'a') as file:
+                file.write('the dog sat .\n')
+
+        writer = threading.Thread(target=append)
+        writer.start()
+        while not multigram.input_source_complete:
+            multigram.ReadTokenBehavior()
+        writer.join()
+        assert multigram.FindToken(TokenString('dog'), 1.0) is not None
+
+
+class TestShardedTrainer:
+    lines = TestIngestLines.lines + [['and', 'then'], ['it', 'slept', '!'], ['the', 'end', '.']] + test_lines
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_sharded_training_matches_single_process(self, workers):
+        expected = train(self.lines)
+
+        bounds = [0, 2, 5, 7, 8, 9, len(self.lines)]
+        shards = [partial(TokenSourceLines, self.lines, bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+        multigram = ShardedTrainer(workers).Train(shards)
+
+        assert [token.GetAsString() for token in multigram.tokens if token is not None] == \
+            [token.GetAsString() for token in expected.tokens if token is not None]
+        assert connection_counts(multigram) == connection_counts(expected)
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_merge_keeps_token_state_and_clock(self, workers):
+        expected = train(self.lines)
+
+        bounds = [0, 2, 5, 7, 8, 9, len(self.lines)]
+        shards = [partial(TokenSourceLines, self.lines, bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+        multigram = ShardedTrainer(workers).Train(shards)
+
+        def token_state(a_multigram):
+            return {token.GetAsString(): (a_multigram.token_frequency[token.TokenId], token.TriggerTime, token.TriggerStrength)
+                    for token in a_multigram.tokens if token is not None}
+
+        assert token_state(multigram) == token_state(expected)
+        assert min(frequency for frequency, _, _ in token_state(multigram).values()) > 0
+        assert multigram.clock.now == expected.clock.now
+
+    def test_sharded_log_file_matches_single_process(self, tmp_path):
+        log_filename = tmp_path / 'syslog'
+        log_filename.write_text(''.join(' '.join(line) + '\n' for line in self.lines * 3))
+
+        expected = MultiGram(TokenSourceCSVStream(str(log_filename)))
+        while not expected.input_source_complete:
+            expected.ReadTokenBehavior()
+
+        multigram = ShardedTrainer(1).Train(CSVStreamShards(str(log_filename), 7))
+        assert connection_counts(multigram) == connection_counts(expected)
+
+
+class TestTokenBudget:
+    lines = [['common', 'words', 'rare%d' % i, 'and', 'common', '.'] for i in range(200)]
+
+    def check_budget(self, multigram, budget):
+        assert multigram.CountUsedTokens() <= budget
+        assert multigram.CountUsedTokens() == len([token for token in multigram.tokens if token is not None])
+        assert multigram.FindTokenLike(TokenString('common')) is not None
+        assert multigram.FindTokenLike(TokenString(Settings.StartOfSequenceTokenValue)) is not None
+        assert multigram.FindTokenLike(TokenString('rare199')) is not None
+        assert multigram.FindTokenLike(TokenString('rare0')) is None
+        for distance in range(1, Settings.max_token_strength + 1):
+            sources, targets, _ = multigram.connections.GetCoo(distance)
+            for token_id in sources.tolist() + targets.tolist():
+                assert multigram.tokens[token_id] is not None
+
+    def test_budget_evicts_rare_tokens(self):
+        multigram = MultiGram(TokenSourceLines(self.lines), max_tokens=20)
+        while not multigram.input_source_complete:
+            multigram.ReadTokenBehavior()
+
+        self.check_budget(multigram, 20)
+        assert len(multigram.tokens) < 30
+
+    def test_budget_with_bulk_ingestion(self):
+        multigram = MultiGram(TokenSourceLines(self.lines), max_tokens=20)
+        multigram.IngestSource(lines_per_batch=3)
+        self.check_budget(multigram, 20)
+
+    def test_no_budget_keeps_all_tokens(self):
+        multigram = train(self.lines)
+        assert multigram.CountUsedTokens() == 205
+
+
+def trained_layer(lines, source):
+    multigram = train(lines)
+    multigram.token_source = source
+    multigram.input_source_complete = False
+    return multigram
+
+
+def failing_layer(source):
+    raise ValueError('no such layer')
+
+
+class TestPipeline:
+    lines = TestIngestLines.lines + test_lines
+    following_cutoff = 0.3
+
+    def follow_in_lockstep(self):
+        lower_layer = trained_layer(self.lines, TokenSourceLines(self.lines))
+        segments = TokenSourceQueue(queue.Queue())
+        while not lower_layer.input_source_complete:
+            lower_layer.FollowTokenBehavior(self.following_cutoff, segments)
+
+        upper_layer = MultiGram(segments)
+        while not upper_layer.input_source_complete:
+            upper_layer.ReadTokenBehavior()
+        return upper_layer
+
+    def test_segments_end_at_unexpected_tokens(self):
+        upper_layer = self.follow_in_lockstep()
+        segments = [token for token in upper_layer.tokens if isinstance(token, TokenReference)]
+        assert any(len(segment.token_raw) > 1 for segment in segments)
+        assert upper_layer.FindTokenLike(TokenReference([TokenString(word) for word in ['once', 'upon', 'a']])) is not None
+
+    @pytest.mark.parametrize('use_processes', [False, True])
+    def test_pipeline_matches_lockstep(self, use_processes):
+        expected = self.follow_in_lockstep()
+
+        stages = [PipelineStage(partial(trained_layer, self.lines), self.following_cutoff), PipelineStage(MultiGram)]
+        pipeline = MultiGramPipeline(stages, use_processes, queue_size=2)
+        lower_layer, upper_layer = pipeline.Run(partial(TokenSourceLines, self.lines))
+
+        assert lower_layer.input_source_complete and upper_layer.input_source_complete
+        assert [token.GetAsString() for token in upper_layer.tokens] == [token.GetAsString() for token in expected.tokens]
+        assert connection_counts(upper_layer) == connection_counts(expected)
+
+    @pytest.mark.parametrize('use_processes', [False, True])
+    def test_failed_stage_stops_the_pipeline(self, use_processes):
+        stages = [PipelineStage(partial(trained_layer, self.lines), self.following_cutoff), PipelineStage(failing_layer)]
+        with pytest.raises(RuntimeError, match='no such layer'):
+            MultiGramPipeline(stages, use_processes, queue_size=2).Run(partial(TokenSourceLines, self.lines * 10))
+
+    def test_only_the_last_stage_trains(self):
+        with pytest.raises(ValueError):
+            MultiGramPipeline([PipelineStage(MultiGram), PipelineStage(MultiGram)])
+
+
+class TestEvaluator:
+    corpus = benchmark.ZipfCorpus(40, 120, seed=2)
+    held_out = benchmark.ZipfCorpus(45, 30, seed=3)
+
+    def trained(self):
+        return benchmark.IngestAll(MultiGram(TokenSourceMemory(self.corpus)))
+
+    def test_batches_match_one_prediction_at_a_time(self):
+        multigram = self.trained()
+        evaluator = Evaluator(top_k=(1, 3), smoothing=0.05, batch_size=7)
+        summary = evaluator.Evaluate(multigram, TokenSourceMemory(self.held_out))
+
+        scorer = NextTokenScorer(multigram, 'support', cache_size=0)
+        log_likelihood, hits, unknown = 0.0, 0, 0
+        predictions = list(evaluator.Predictions(multigram, TokenSourceMemory(self.held_out)))
+        for history, target in predictions:
+            scores = scorer.Scores(history)
+            finite = np.isfinite(scores)
+            model = scores[target] / scores[finite].sum() if target >= 0 and finite[target] else 0.0
+            log_likelihood += np.log(0.95 * model + 0.05 / (len(scores) + 1))
+            hits += target >= 0 and scorer.BestNextToken(history)[0] == target
+            unknown += target < 0
+
+        assert summary['tokens'] == len(predictions) == sum(len(line) + 1 for line in self.held_out)
+        assert summary['log_likelihood'] == pytest.approx(log_likelihood)
+        assert summary['perplexity'] == pytest.approx(np.exp(-log_likelihood / len(predictions)))
+        assert summary['top_k_accuracy'][1] == hits / len(predictions)
+        assert summary['top_k_accuracy'][1] <= summary['top_k_accuracy'][3]
+        assert summary['unknown_rate'] == unknown / len(predictions) > 0
+
+    def test_evaluation_does_not_train(self):
+        multigram = self.trained()
+        counts, token_count = connection_counts(multigram), multigram.CountUsedTokens()
+        Evaluator().Evaluate(multigram, TokenSourceMemory(self.held_out))
+        assert connection_counts(multigram) == counts and multigram.CountUsedTokens() == token_count
+
+    def test_trained_lines_are_more_likely(self):
+        multigram = self.trained()
+        seen = Evaluator().Evaluate(multigram, TokenSourceMemory(self.corpus))
+        unseen = Evaluator().Evaluate(multigram, TokenSourceMemory(self.held_out))
+        assert seen['perplexity'] < unseen['perplexity']
+
+    def test_snapshot_shards_in_worker_processes(self, tmp_path):
+        filename = str(tmp_path / 'model.mgsnap')
+        multigram = self.trained()
+        MultiGramSnapshot.Save(multigram, filename)
+
+        shards = [partial(TokenSourceMemory, self.held_out[:10]), partial(TokenSourceMemory, self.held_out[10:])]
+        sharded = Evaluator(workers=2).EvaluateSnapshot(filename, shards)
+        expected = Evaluator().Evaluate(multigram, TokenSourceMemory(self.held_out))
+        assert sharded['tokens'] == expected['tokens']
+        assert sharded['log_likelihood'] == pytest.approx(expected['log_likelihood'])
+        assert sharded['top_k_accuracy'] == expected['top_k_accuracy']
+
+
+class TestSnapshot:
+    @pytest.mark.parametrize('memory_map', [True, False])
+    def test_snapshot_round_trip(self, tmp_path, memory_map):
+        expected = train(TestIngestLines.lines)
+        snapshot_filename = str(tmp_path / 'model.mgsnap')
+        MultiGramSnapshot.Save(expected, snapshot_filename)
+
+        multigram = MultiGramSnapshot.Load(snapshot_filename, memory_map=memory_map)
+        assert [token.GetAsString() if token is not None else None for token in multigram.tokens] == \
+            [token.GetAsString() if token is not None else None for token in expected.tokens]
+        assert connection_counts(multigram) == connection_counts(expected)
+
+        once = multigram.FindTokenLike(TokenString('once'))
+        assert multigram.connections.Row(once.TokenId, 1)[2].tolist() == \
+            expected.connections.Row(once.TokenId, 1)[2].tolist()
+
+    def test_loaded_snapshot_keeps_training(self, tmp_path):
+        snapshot_filename = str(tmp_path / 'model.mgsnap')
+        MultiGramSnapshot.Save(train(test_lines), snapshot_filename)
+
+        multigram = MultiGramSnapshot.Load(snapshot_filename, TokenSourceLines(test_lines))
+        multigram.PrimeRecentMemory([], True)
+        multigram.IngestSource()
+
+        expected = train(test_lines + test_lines)
+        assert connection_counts(multigram) == connection_counts(expected)
+        assert multigram.connections.SoftmaxStrength(0, 1, 1) == expected.connections.SoftmaxStrength(0, 1, 1)
+
+    def test_bounded_snapshot_round_trip(self, tmp_path):
+        expected = MultiGram(TokenSourceLines(TestIngestLines.lines), max_connections=2)
+        expected.IngestSource()
+        snapshot_filename = str(tmp_path / 'model.mgsnap')
+        MultiGramSnapshot.Save(expected, snapshot_filename)
+
+        multigram = MultiGramSnapshot.Load(snapshot_filename)
+        assert multigram.connections.top_k == 2
+        assert connection_counts(multigram) == connection_counts(expected)
+        assert multigram.connections.TailErrorBound(1) == expected.connections.TailErrorBound(1)
+        assert multigram.connections.TailEstimate(0, 3, 5) == expected.connections.TailEstimate(0, 3, 5)
+
+    def test_not_a_snapshot(self, tmp_path):
+        not_a_snapshot = tmp_path / 'model.mgsnap'
+        not_a_snapshot.write_bytes(b'hello, world')
+        with pytest.raises(ValueError):
+            MultiGramSnapshot.Load(str(not_a_snapshot))
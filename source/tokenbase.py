@@ -1,15 +1,30 @@
 import sys
+import copy
 from abc import ABC, abstractmethod
 from settings import Settings, MultigramState
-
-from tokensynapse import TokenSynapse
+from tokeninterner import TokenInterner
 
 class TokenBase(ABC):
     """
     Base class for token management.
     This class provides a structure for managing tokens, including their creation,
     validation, and expiration.
+    Tokens are slotted, and per-distance structures are allocated only
+    when a token is inserted into a MultiGram, since sources make many
+    tokens that are dropped right after the vocabulary lookup.
+    Token identity is the interned id of the vocabulary key, so equal
+    tokens compare and hash equal by id.  A token whose key depends on
+    state must forget its id when that state changes.  A token interns
+    again once any key was freed since it was given its id, as its key
+    may have been the one freed.
     """
+    __slots__ = ('token_type', 'start_of_sequence', 'IntrinsicToken', 'IntrinsicOperation', 'OrgnizeSeen',
+                 'TokenId', 'clock', 'TriggerTime', 'TriggerStrength', 'CurrentActivityFromPreviousTokens',
+                 'intern_id', 'intern_generation')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        TokenInterner.RegisterTokenClass(cls)
 
     def __init__(self, token_type: str):
         self.token_type = token_type
@@ -18,20 +33,125 @@ class TokenBase(ABC):
         self.IntrinsicToken = False
         self.IntrinsicOperation = None
         self.OrgnizeSeen = False
-        self.CurrentStrength = 0
 
-        self.Connections = [[] for i in range(Settings.max_token_strength)]
-        self.SoftmaxConnections = [[] for i in range(Settings.max_token_strength)]
-        self.NomalizedConnections = [[] for i in range(Settings.max_token_strength)]
-        self.ConnectionCount = [0 for i in range(Settings.max_token_strength)]
-        self.TotalConnectionStrength = [0 for i in range(Settings.max_token_strength)]
-        self.CurrentActivityFromPreviousTokens = [0.0 for i in range(Settings.max_token_strength)]
+        # Index of this token in the MultiGram it is inserted into, -1 until then.
+        self.TokenId = -1
+
+        # Strength decays lazily against the clock of the owning MultiGram.
+        self.clock = None
+        self.TriggerTime = 0
+        self.TriggerStrength = 0
+
+        # Allocated by AllocateActivity when the token is inserted into a MultiGram.
+        self.CurrentActivityFromPreviousTokens = None
+
+        # Interned on first use, see InternId.
+        self.intern_id = None
+        self.intern_generation = -1
+
+
+    @property
+    def InternId(self) -> int:
+        """
+        The interned id of this token's vocabulary key, the same for
+        exactly those tokens this token IsEqualTo, or -1 if this token
+        has no exact identity.
+        """
+        if self.intern_id is None or self.intern_generation != TokenInterner.generation:
+            self.intern_id = TokenInterner.Intern(self.GetVocabularyKey())
+            self.intern_generation = TokenInterner.generation
+        return self.intern_id
+
+
+    def FindInternId(self):
+        """
+        The InternId of this token if its vocabulary key is interned,
+        without interning it, so looking up unseen tokens does not grow
+        the interning table.
+        returns: The id, -1 if this token has no exact identity, or None if its key is not interned.
+        """
+        if self.intern_id is not None and self.intern_generation == TokenInterner.generation:
+            return self.intern_id
+        return TokenInterner.Find(self.GetVocabularyKey())
+
+
+    def __eq__(self, other):
+        if not isinstance(other, TokenBase):
+            return NotImplemented
+        if self is other:
+            return True
+
+        intern_id = self.InternId
+        return intern_id >= 0 and intern_id == other.InternId
+
+
+    def __hash__(self):
+        intern_id = self.InternId
+        return hash(intern_id) if intern_id >= 0 else object.__hash__(self)
+
+
+    def __getstate__(self):
+        # Interned ids belong to this process, intern again after unpickling.
+        state = dict(getattr(self, '__dict__', {}))
+        for a_class in type(self).__mro__:
+            for name in getattr(a_class, '__slots__', ()):
+                if name != '__weakref__' and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        state['intern_id'] = None
+        state['intern_generation'] = -1
+        return state
+
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+    def Detached(self) -> 'TokenBase':
+        """
+        A copy of this token that belongs to no MultiGram, for inserting
+        a token that is already inserted in another MultiGram.
+        """
+        token = copy.copy(self)
+        token.TokenId = -1
+        token.clock = None
+        token.TriggerTime = 0
+        token.TriggerStrength = 0
+        token.CurrentActivityFromPreviousTokens = None
+        return token
+
+
+    @classmethod
+    def FromVocabularyKey(cls, key) -> 'TokenBase':
+        """
+        Make a token from a vocabulary key interned by this class.
+        Token types that intern keys must override this.
+        """
+        raise NotImplementedError(f'{cls.__name__} tokens cannot be made from a vocabulary key.')
+
+
+    @classmethod
+    def KeyChildIds(cls, key) -> tuple:
+        """
+        The interned ids a vocabulary key of this class is made of, none unless overridden.
+        """
+        return ()
+
+
+    def AllocateActivity(self) -> None:
+        """
+        Allocate the per-distance activity of a token inserted into a MultiGram.
+        """
+        if self.CurrentActivityFromPreviousTokens is None:
+            self.CurrentActivityFromPreviousTokens = [0.0] * Settings.max_token_strength
 
 
     def CaptureNewActivity(self) -> None:
         """
+        Return the activity accumulated from previous tokens to zero.
         """
-        self.CurrentActivityFromPreviousTokens = [0.0 for i in range(Settings.max_token_strength)]
+        if self.CurrentActivityFromPreviousTokens is not None:
+            self.CurrentActivityFromPreviousTokens = [0.0] * Settings.max_token_strength
 
     def create_token(self, user_id: str) -> str:
         """
@@ -83,22 +203,67 @@ class TokenBase(ABC):
                         break
 
         return inserted_token
+
+
+    def GetVocabularyKey(self):
+        """
+        Return a hashable key that is identical for exactly those tokens
+        this token IsEqualTo, so a MultiGram can index its vocabulary in a
+        dictionary.  Token types without an exact identity return None,
+        and are always found by the similarity scan in FindTokenIfSeen.
+        returns: A hashable vocabulary key, or None
+        """
+        return None
+
+
+    def IsSimilarityExact(self, threshold_score: float) -> bool:
+        """
+        True if CheckIfTokenSeen at the given threshold gives the same
+        answer as IsEqualTo, so the vocabulary key may replace the scan.
+        threshold_score: How similar is similar enough
+        returns: True if similarity at this threshold is exact equality
+        """
+        return False
     
     
+    @property
+    def CurrentStrength(self) -> int:
+        """
+        The strength of this token, decayed linearly by one for every
+        tick since it was last triggered, never below zero.
+        """
+        elapsed = self.clock.now - self.TriggerTime if self.clock is not None else 0
+        return max(self.TriggerStrength - elapsed, 0)
+
+
+    def AttachClock(self, clock) -> None:
+        """
+        Decay this token against the clock of the MultiGram it is inserted
+        into, keeping whatever strength it has right now.
+        clock: The TokenClock shared by all tokens of a MultiGram
+        """
+        self.TriggerStrength = self.CurrentStrength
+        self.clock = clock
+        self.TriggerTime = clock.now
+
+
     def TriggerToken(self):
         """
         When a token is seen, its strength is set to the maximum possible.
         """
-        self.CurrentStrength = Settings.max_token_strength
+        if self.clock is not None:
+            self.TriggerTime = self.clock.now
+        self.TriggerStrength = Settings.max_token_strength
 
 
     def Tick(self) -> None:
         """
         After a token has been triggered, its strength decays linearly
-        with every tick.
+        with every tick.  Tokens inserted in a MultiGram decay as its
+        clock advances, so this only ticks a token without a clock.
         """
-        if self.CurrentStrength > 0:
-            self.CurrentStrength -= 1
+        if self.clock is None and self.TriggerStrength > 0:
+            self.TriggerStrength -= 1
 
 
     def IsRelatedTo(self, ref_token: 'TokenBase') -> bool:
@@ -118,61 +283,6 @@ class TokenBase(ABC):
         return related
     
 
-    def BumpRelationship(self, ref_token: 'TokenBase') -> None:
-        """
-        Bump the relationship between this token and the reference token.
-        This is done by increasing the strength of the connection.
-        ref_token: A token to bump the relationship with
-        """
-        if ref_token.CurrentStrength != Settings.max_token_strength or \
-            ref_token.CurrentStrength <= self.CurrentStrength or \
-            self.CurrentStrength == 0:
-                return
-        
-
-        distance = ref_token.CurrentStrength - self.CurrentStrength
-
-
-    def BumpRelationship(self, ref_token: 'TokenBase', distance: int) -> None:
-        """
-        Bump the relationship between this token and the reference token.
-        This is done by increasing the strength of the connection.
-        ref_token: A token to bump the relationship with
-        strength: The strength of the relationship
-        distance: The distance between this token and the reference token
-        """
-        connected_synapse = None
-
-        for synapse in self.Connections[distance - 1]:
-            if synapse.FollowingToken.IsEqualTo(ref_token):
-                connected_synapse = synapse
-                break
-
-        if connected_synapse is None:
-            connected_synapse = TokenSynapse(ref_token, 0)
-            self.Connections[distance - 1].append(connected_synapse)
-
-        if not connected_synapse is None:
-            connected_synapse.Strength += 1
-            #self.Softmax()      # Do this for strict (and expensive) softmax updating.
-
-
-    def Softmax(self) -> None:
-        """
-        Apply the softmax function to the given list of values.
-        values: A list of values to apply the softmax function to
-        returns: A list of values after applying the softmax function
-        """
-        for connectionsAtDistance in self.Connections:
-            exp_values = [pow(2.71828, synapse.Strength) for synapse in connectionsAtDistance]
-            sum_exp_values = sum(exp_values)
-            for i in range(len(connectionsAtDistance)):
-                if sum_exp_values == 0:
-                    connectionsAtDistance[i].SoftmaxStrength = 0
-                else:
-                    connectionsAtDistance[i].SoftmaxStrength = exp_values[i] / sum_exp_values
-    
-
     @abstractmethod
     def CheckIfTokenSimilar(self, ref_token: 'TokenBase') -> int:
         """
@@ -0,0 +1,19 @@
+
+class TokenClock:
+    """
+    The clock shared by all tokens in one MultiGram.
+    A token remembers only the time at which it was last triggered, and
+    derives its current strength from the shared clock when asked, so
+    advancing the clock is one addition however many tokens are decaying.
+    """
+    def __init__(self):
+        self.now = 0
+
+
+    def Tick(self, ticks: int = 1) -> None:
+        """
+        Advance the clock.  Advancing several ticks at once is the same
+        as ticking that many times, because token strength decays linearly.
+        ticks: The number of ticks to advance
+        """
+        self.now += ticks
@@ -0,0 +1,158 @@
+import threading
+
+
+class TokenInterner:
+    """
+    The process-wide interning table of token identities.
+    Every distinct vocabulary key (see TokenBase.GetVocabularyKey) is
+    given a dense integer id the first time it is seen, so tokens can be
+    compared, hashed and composed by id, and sources can emit ids
+    without making token objects.  Ids are only meaningful in the process
+    that interned them; tokens drop their id when pickled, and intern
+    again where they are unpickled.
+    Keys are reference counted.  A MultiGram holds the key of every token
+    in its vocabulary, a key made of other keys (see KeyChildIds) holds
+    them, and a canonical reference holds its own key.  When the last
+    holder releases a key, the key is freed and its id reused, so the
+    table stays as large as the vocabularies using it.  Freeing a key
+    advances the generation, and tokens intern again when the generation
+    has moved on since they were given their id, so a token never keeps
+    the id of a freed key.  Ids emitted by a source must be used before
+    the next eviction.  Keys interned but never held are kept, so lookups
+    of tokens that may be unseen use Find, which does not intern.
+    The table is shared by every thread, so pipeline stages running as
+    threads change it under a lock.  The lock is reentrant, as releasing
+    a key releases its children, and a token collected during a change
+    releases its key from the same thread.
+    """
+    ids = {}
+    keys = []
+    references = []
+    free_ids = []
+    generation = 0
+    token_classes = {}
+    lock = threading.RLock()
+
+
+    @staticmethod
+    def Intern(key) -> int:
+        """
+        Get the id of a vocabulary key, interning it if it is new.
+        key: A hashable vocabulary key, or None for a token without exact identity.
+        returns: The dense id of the key, or -1 for None.
+        """
+        if key is None:
+            return -1
+
+        intern_id = TokenInterner.ids.get(key)
+        if intern_id is not None:
+            return intern_id
+
+        with TokenInterner.lock:
+            # Another thread may have interned the key since it was looked up.
+            intern_id = TokenInterner.ids.get(key)
+            if intern_id is not None:
+                return intern_id
+
+            if len(TokenInterner.free_ids) > 0:
+                intern_id = TokenInterner.free_ids.pop()
+                TokenInterner.keys[intern_id] = key
+                TokenInterner.references[intern_id] = 0
+            else:
+                intern_id = len(TokenInterner.keys)
+                TokenInterner.keys.append(key)
+                TokenInterner.references.append(0)
+            TokenInterner.ids[key] = intern_id
+
+            for child_id in TokenInterner.KeyChildIds(key):
+                TokenInterner.Acquire(child_id)
+
+            return intern_id
+
+
+    @staticmethod
+    def Find(key):
+        """
+        Get the id of a vocabulary key if it is interned, without interning it.
+        key: A hashable vocabulary key, or None for a token without exact identity.
+        returns: The id of the key, -1 for None, or None if the key is not interned.
+        """
+        if key is None:
+            return -1
+
+        return TokenInterner.ids.get(key)
+
+
+    @staticmethod
+    def Acquire(intern_id: int) -> None:
+        """
+        Hold an interned key, so it is not freed until released.
+        """
+        with TokenInterner.lock:
+            TokenInterner.references[intern_id] += 1
+
+
+    @staticmethod
+    def Release(intern_id: int) -> None:
+        """
+        Release an interned key, freeing it, and releasing the keys it is made of, once nothing holds it.
+        """
+        with TokenInterner.lock:
+            TokenInterner.references[intern_id] -= 1
+            if TokenInterner.references[intern_id] > 0:
+                return
+
+            key = TokenInterner.keys[intern_id]
+            del TokenInterner.ids[key]
+            TokenInterner.keys[intern_id] = None
+            TokenInterner.free_ids.append(intern_id)
+            TokenInterner.generation += 1
+
+            for child_id in TokenInterner.KeyChildIds(key):
+                TokenInterner.Release(child_id)
+
+
+    @staticmethod
+    def KeyChildIds(key) -> tuple:
+        """
+        The ids of the keys a key is made of, held as long as the key is interned.
+        """
+        token_class = TokenInterner.token_classes.get(key[0])
+        return token_class.KeyChildIds(key) if token_class is not None else ()
+
+
+    @staticmethod
+    def Key(intern_id: int):
+        """
+        Get the vocabulary key interned with an id.
+        """
+        return TokenInterner.keys[intern_id]
+
+
+    @staticmethod
+    def Count() -> int:
+        """
+        The number of keys interned and not freed.
+        """
+        return len(TokenInterner.ids)
+
+
+    @staticmethod
+    def RegisterTokenClass(token_class) -> None:
+        """
+        Register a token class, so tokens can be made again from the keys it interns.
+        Vocabulary keys start with the name of the class that made them.
+        """
+        TokenInterner.token_classes[token_class.__name__] = token_class
+
+
+    @staticmethod
+    def MakeToken(intern_id: int):
+        """
+        Make a new token with the identity interned as an id, for a
+        consumer that received ids and must now keep a token object.
+        intern_id: An id from Intern.
+        returns: A new, untriggered token equal to every token with this id.
+        """
+        key = TokenInterner.keys[intern_id]
+        return TokenInterner.token_classes[key[0]].FromVocabularyKey(key)
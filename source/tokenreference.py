@@ -1,22 +1,82 @@
 import sys
+import weakref
 from tokenbase import TokenBase
+from tokeninterner import TokenInterner
 
 class TokenReference(TokenBase):
     """
     TokenReference is a concrete implementation of the TokenBase class.
     It represents a token that is a reference to another token and provides
     specific implementations for the abstract methods defined in TokenBase.
+    References made with Canonical are hash-consed on the ids of the
+    referenced tokens: identical references are one object, so equality
+    is an identity check, and the interned id is known without
+    building the key again.  The children of a canonical reference must
+    not be changed.  A canonical reference holds its interned key while
+    it lives, and the key holds the keys of its children, so no id in
+    the canonical table is freed and reused for another key.
     """
+    __slots__ = ('_token_raw', 'token_significant_size', 'unexpected', '__weakref__')
+
+    # Canonical references by the tuple of their children's interned ids, while anything holds them.
+    canonical = weakref.WeakValueDictionary()
 
     def __init__(self, ref_tokens: list[TokenBase]):
         super().__init__('TokenReference')
-        self.token_raw = ref_tokens
+        self._token_raw = ref_tokens
 
         # Tokens with fewer non-null bytes than this are not significant.
         # Token comparisons that are not true for at least this number of bytes are ignored.
         self.token_significant_size = 0
         self.unexpected = False
 
+
+    @property
+    def token_raw(self) -> list[TokenBase]:
+        return self._token_raw
+
+    @token_raw.setter
+    def token_raw(self, ref_tokens: list[TokenBase]) -> None:
+        self._token_raw = ref_tokens
+        self.intern_id = None
+
+
+    @staticmethod
+    def Canonical(ref_tokens: list[TokenBase]) -> 'TokenReference':
+        """
+        The one reference to these tokens, in order, made if there is none.
+        References to tokens without an exact identity cannot be shared,
+        and are always made new.
+        ref_tokens: The tokens to reference.
+        returns: The canonical reference to the tokens.
+        """
+        child_ids = tuple(token.InternId for token in ref_tokens)
+        if -1 in child_ids:
+            return TokenReference(list(ref_tokens))
+
+        reference = TokenReference.canonical.get(child_ids)
+        if reference is None:
+            reference = TokenReference(list(ref_tokens))
+            reference.intern_id = TokenInterner.Intern(('TokenReference', child_ids))
+            reference.intern_generation = TokenInterner.generation
+            TokenInterner.Acquire(reference.intern_id)
+            weakref.finalize(reference, TokenInterner.Release, reference.intern_id)
+            TokenReference.canonical[child_ids] = reference
+
+        return reference
+
+
+    @classmethod
+    def FromVocabularyKey(cls, key) -> 'TokenReference':
+        return TokenReference.Canonical([TokenInterner.MakeToken(child_id) for child_id in key[1]])
+
+    @classmethod
+    def KeyChildIds(cls, key) -> tuple:
+        """
+        A reference's key is made of the keys of the tokens it references.
+        """
+        return key[1]
+
     def CheckIfTokenSimilar(self, ref_token: TokenBase) -> int:
         """
         Return a measure of the similarity between this token and refToken.
@@ -30,7 +90,11 @@ class TokenReference(TokenBase):
         # Tokens are not the same if they are of different types.
         if not isinstance(ref_token, TokenReference):
             return 0
-        
+
+        # Equal references are identical, whatever their size.
+        if self is ref_token or (self.InternId >= 0 and self.InternId == ref_token.InternId):
+            return sys.maxsize
+
         size_difference = abs(len(self.token_raw) - len(ref_token.token_raw))
 
         # Count the number of consecutive identical bytes before the first nonidentical one.
@@ -65,7 +129,14 @@ class TokenReference(TokenBase):
         # Tokens are not the same if they are of different types.
         if not isinstance(ref_token, TokenReference):
             return False
-        
+        if self is ref_token:
+            return True
+
+        # References with an identity are equal exactly when their interned ids are.
+        intern_id = self.InternId
+        if intern_id >= 0 and ref_token.InternId >= 0:
+            return intern_id == ref_token.InternId
+
         equal = len(self.token_raw) == len(ref_token.token_raw)
         if equal:
             # If any byte does not compare, these are not equal.
@@ -76,6 +147,37 @@ class TokenReference(TokenBase):
     
         return equal
     
+
+    def GetVocabularyKey(self):
+        """
+        References are equal when all referenced tokens are equal, in order,
+        so the key is composed from the interned ids of the referenced tokens.
+        Similarity stays fuzzy, so IsSimilarityExact is left False and
+        FindTokenIfSeen continues to scan for similar references.
+        returns: A key built from the ids of the referenced tokens, or None
+        """
+        child_ids = tuple(token.InternId for token in self.token_raw)
+        if -1 in child_ids:
+            return None
+
+        return ('TokenReference', child_ids)
+
+
+    def FindInternId(self):
+        """
+        The key of a reference holds the keys of its children, so a
+        reference is interned only if all its children are, and its
+        children are looked up without interning them either.
+        returns: The id, -1 if this reference has no exact identity, or None if its key is not interned.
+        """
+        child_ids = tuple(token.FindInternId() for token in self.token_raw)
+        if -1 in child_ids:
+            return -1
+        if None in child_ids:
+            return None
+
+        return TokenInterner.Find(('TokenReference', child_ids))
+
         
     def GetAsString(self) -> str:
         """
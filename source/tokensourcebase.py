@@ -1,11 +1,15 @@
 from abc import ABC, abstractmethod
+import numpy as np
 from tokenbase import TokenBase
+from tokenstring import TokenString
 
 class TokenSourceBase(ABC):
     """
     Base class for token sources.
     This abstract class provides the formal definition of a source of tokens.
     """
+    # The methods timed by MultiGram.EnableProfiling, extended by sources with phases of their own.
+    profiled_methods = ['GetNext', 'GetNextLine', 'GetNextLineIds']
     
     def __init__(self):
         pass
@@ -40,4 +44,43 @@ class TokenSourceBase(ABC):
         Must be overridden.
         """
         pass
-    
+
+
+    def GetNextLine(self) -> list[TokenBase]:
+        """
+        Returns the tokens of the next line, up to and including its
+        end-of-line token.  The last line of a source may end without one.
+        If no more tokens are available, returns an empty list.
+        May be overridden by sources that can read whole lines faster.
+        """
+        line = []
+        token = self.GetNext()
+        while token is not None:
+            line.append(token)
+            if isinstance(token, TokenString) and token.end_of_line:
+                break
+            token = self.GetNext()
+
+        return line
+
+
+    def GetNextLineIds(self) -> np.ndarray:
+        """
+        Returns the interned ids (see TokenInterner) of the tokens of the
+        next line, as GetNextLine would return them.  If no more tokens
+        are available, returns an empty array.
+        May be overridden by sources that can emit ids without making tokens.
+        """
+        return np.array([token.InternId for token in self.GetNextLine()], dtype=np.int64)
+
+
+    def GetLeadIn(self) -> tuple[list[TokenBase], bool]:
+        """
+        For a source that reads one shard of a larger input, returns the
+        tokens before the shard that a single reader would still hold in
+        recent memory when the shard starts: the tokens since the last
+        end of line, and whether there was an end of line at all.
+        A source that starts at the beginning of its input has no lead-in.
+        returns: The lead-in tokens, and True if they follow an end of line
+        """
+        return [], False
@@ -1,36 +1,94 @@
+import json
+import os
 import re
+import time
+import numpy as np
+from settings import Settings, TokenSourceFlags
 from tokenbase import TokenBase
 from tokenstring import TokenString
 #from tokenstringembed import TokenStringEmbed
 from tokentimestamp import TokenTimestamp
 from tokensourcebase import TokenSourceBase
+from metrics import Metrics
 
 timestamp_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}.\d{6}[\+|\-]\d{2}:\d{2}')
+timestamp_length = 32
+whitespace_pattern = re.compile(r'\s')
+
+
+def IsTimestamp(token_value: str) -> bool:
+    """
+    True if a field starts with an ISO timestamp.  Fields too short for
+    one, or without its date and time separators, skip the regex.
+    """
+    return (len(token_value) >= timestamp_length and token_value[4] == '-' and token_value[10] == 'T'
+            and timestamp_pattern.match(token_value) is not None)
+
 
 class TokenSourceCSVStream(TokenSourceBase):
     """
     Token source for reading tokens from a CSV stream.
     This class implements the abstract methods defined in TokenSourceBase.
+    The file is read in blocks of block_size bytes.  The complete lines of
+    a block are decoded and split in one pass, the line start offsets
+    found with one array comparison, and the fields of the current line
+    handed out by an index cursor.  No field is remembered by the source:
+    interning a field is one lookup in the interning table, which frees
+    the fields of tokens evicted from every MultiGram, so memory stays
+    bounded however many distinct fields a log has.
+
+    In follow mode, as tail -F, the end of the file does not end the
+    stream: the source waits for lines to be appended, polling less often
+    the longer the file stays idle, up to max_poll_seconds.  A last line
+    without a newline is only read once it is complete.  When the file is
+    rotated, replaced by a new file of the same name, the rest of the old
+    file is read and then the new file from its start; when it is
+    truncated, it is read again from its start.  The stream ends when the
+    stop_event is set, or after idle_seconds without new data.
+    With an offset_filename, the byte offset of the first line not yet
+    read is saved to that file every offset_save_seconds, while waiting,
+    and at the end, so a source made again after a restart resumes there,
+    unless the file was rotated or truncated in the meantime.
     """
+    profiled_methods = TokenSourceBase.profiled_methods + ['ReadNextLine', 'ReadBlock']
+    block_size = 1 << 20
+    poll_seconds = 0.1
+    max_poll_seconds = 2.0
+    offset_save_seconds = 5.0
 
-    def __init__(self, filename, max_lines=0):
+    def __init__(self, filename, max_lines=0, start_offset=0, end_offset=None,
+                 follow=False, offset_filename=None, idle_seconds=None, stop_event=None):
         super().__init__()
+        if follow and end_offset is not None:
+            raise ValueError('A followed file has no end, so cannot be read up to an end offset.')
+
         self.log_filename = filename
         self.max_lines = max_lines
 
+        # Read only the lines that start in this byte range of the file, to read it in shards.
+        self.start_offset = start_offset
+        self.end_offset = end_offset
+
+        # Wait for lines appended at the end of the file, until stopped or idle for too long.
+        self.follow = follow
+        self.idle_seconds = idle_seconds
+        self.stop_event = stop_event
+
+        # Where the offset of the first line not yet read is saved, to resume after a restart.
+        self.offset_filename = offset_filename
+        self.istream = None
+
         self.Reset()
 
 
     def __enter__(self):
-        self.line_count = 0
-        self.current_line = None
-
         self.Reset()
 
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
         if self.istream:
+            self.SaveOffset()
             self.istream.close()
             self.istream = None
 
@@ -52,16 +110,53 @@ class TokenSourceCSVStream(TokenSourceBase):
         """"
         Reset the input stream to its beginning, set
         internal state as if nothing has been read.
+        With an offset file, resume at the saved offset instead.
         """
-        self.istream = open(self.log_filename, 'r')
+        if self.istream is not None:
+            self.istream.close()
+        self.istream = open(self.log_filename, 'rb')
+
+        self.first_offset = self.LoadOffset()
+        if self.first_offset is not None:
+            self.istream.seek(self.first_offset)
+        else:
+            self.first_offset = self.start_offset
+            if self.start_offset > 0:
+                # Skip the rest of the line that started before this range.
+                self.istream.seek(self.start_offset - 1)
+                self.istream.readline()
+
+        # Bytes read after the last complete line, and the decoded lines of the last block, with their start offsets.
+        self.carry = b''
+        self.lines = []
+        self.line_starts = []
+        self.line_index = 0
+        self.end_of_file = False
 
+        # The fields of the current line, where it starts, and the next one to hand out.
         self.last_line_read = None
+        self.line_start = self.first_offset
+        self.field_index = 0
+
         self.end_of_stream = False
         self.line_count_read = 0
-        self.current_line = None
+        self.line_count = 0
+
+        # When follow mode last read new data, how long it waits next, and the offset last saved.
+        self.last_data_time = time.monotonic()
+        self.poll_delay = TokenSourceCSVStream.poll_seconds
+        self.saved_offset = None
+        self.last_save_time = self.last_data_time
 
 
 
+    def GetLeadIn(self) -> tuple[list[TokenBase], bool]:
+        """
+        Overridden method.  Every line of the file ends with an end of
+        line, so a range after the start of the file, or a resumed read, starts settled.
+        """
+        return [], self.first_offset > 0
+
     def GetNext(self, flags: int = 0) -> TokenBase:
         """
         Overridden methos to read a new token from the input stream and return that token.
@@ -70,6 +165,12 @@ class TokenSourceCSVStream(TokenSourceBase):
 
         returns: The next token from the stream, or null if no new token is available.
         """
+        # If requested, return a token indicating the start of a sequence.
+        if flags & TokenSourceFlags.Flag_StartOfSequence:
+            token = TokenString(Settings.StartOfSequenceTokenValue)
+            token.start_of_sequence = True
+            return token
+
         return self.NextToken()
         
     def NextToken(self) -> TokenBase:
@@ -80,10 +181,9 @@ class TokenSourceCSVStream(TokenSourceBase):
         if not self.IsInputAvailable() or self.end_of_stream:
             return None
         
-        
         next_token = self.PopTokenFromInput()
 
-        if next_token is None and (self.last_line_read is None or len(self.last_line_read) == 0):
+        if next_token is None:
             self.ReadNextLine()
             if self.last_line_read is None:
                 self.end_of_stream = True
@@ -94,54 +194,250 @@ class TokenSourceCSVStream(TokenSourceBase):
         return next_token
 
 
+    def ReadBlock(self) -> bool:
+        """
+        Read the next block of the file, and decode and split its complete
+        lines.  At the end of the file, a last line without a newline is
+        complete too.
+        returns: False if there is nothing more to read.
+        """
+        if self.end_of_file:
+            return False
+
+        block_start = self.istream.tell() - len(self.carry)
+        if self.end_offset is not None and block_start >= self.end_offset:
+            # Every line from here on starts outside the range.
+            self.end_of_file = True
+            return False
+
+        if self.offset_filename is not None and time.monotonic() - self.last_save_time >= TokenSourceCSVStream.offset_save_seconds:
+            self.SaveOffset()
+
+        block = self.istream.read(TokenSourceCSVStream.block_size)
+        if not block and self.follow:
+            # More may be appended, including the rest of a last line without a newline.
+            return False
+        if not block:
+            self.end_of_file = True
+            if len(self.carry) == 0:
+                return False
+            block = self.carry + b'\n'
+            self.carry = b''
+        else:
+            if self.follow:
+                self.last_data_time = time.monotonic()
+                self.poll_delay = TokenSourceCSVStream.poll_seconds
+            block = self.carry + block
+            last_newline = block.rfind(b'\n')
+            block, self.carry = block[:last_newline + 1], block[last_newline + 1:]
+
+        self.SplitBlock(block, block_start)
+        return True
+
+
+    def SplitBlock(self, block: bytes, block_start: int) -> None:
+        """
+        Decode and split a block of complete lines, each ending with a newline,
+        and find the offsets where they start.
+        """
+        # A newline byte never occurs inside a multi-byte character, so the decoded block splits at the same lines.
+        newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+        self.line_starts = (block_start + np.concatenate(([0], newlines[:-1] + 1))).tolist() if len(newlines) > 0 else []
+        self.lines = block.decode(errors='replace').split('\n')[:-1]
+        self.line_index = 0
+
+
+    def NextLine(self) -> str:
+        """
+        The next line of the file that starts in the byte range, without its newline, or None if there are no more.
+        """
+        while self.line_index >= len(self.lines):
+            if not self.ReadBlock() and not (self.follow and self.WaitForLines()):
+                return None
+
+        self.line_start = self.line_starts[self.line_index]
+        if self.end_offset is not None and self.line_start >= self.end_offset:
+            return None
+
+        self.line_index += 1
+        return self.lines[self.line_index - 1]
+
+
+    def WaitForLines(self) -> bool:
+        """
+        In follow mode, at the end of the file, switch to the file that
+        replaced it, or to the start of the truncated file, or else wait a
+        while for lines to be appended, twice as long as the last time.
+        returns: False if the stream should end, because it was stopped or idle for too long.
+        """
+        if self.CheckRotation():
+            return True
+
+        if self.stop_event is not None and self.stop_event.is_set():
+            return False
+
+        delay = self.poll_delay
+        if self.idle_seconds is not None:
+            idle_left = self.idle_seconds - (time.monotonic() - self.last_data_time)
+            if idle_left <= 0:
+                return False
+            delay = min(delay, idle_left)
+
+        self.SaveOffset()
+        if self.stop_event is not None:
+            self.stop_event.wait(delay)
+        else:
+            time.sleep(delay)
+        self.poll_delay = min(self.poll_delay * 2, TokenSourceCSVStream.max_poll_seconds)
+        return True
+
+
+    def CheckRotation(self) -> bool:
+        """
+        Reopen the file if it was rotated, after reading the rest of the old
+        one, or go back to its start if it was truncated.
+        returns: True if the file was rotated or truncated.
+        """
+        try:
+            status = os.stat(self.log_filename)
+        except FileNotFoundError:
+            # Moved away, and the new file not made yet.
+            return False
+
+        opened = os.fstat(self.istream.fileno())
+        if (status.st_dev, status.st_ino) != (opened.st_dev, opened.st_ino):
+            Metrics.sink.Message(f'{self.log_filename} was rotated, reading the new file')
+            rest = self.carry + self.istream.read()
+            self.istream.close()
+            self.istream = open(self.log_filename, 'rb')
+            if len(rest) > 0:
+                # The rest of the old file is read first, at offset 0 of the new file as far as resuming goes.
+                self.SplitBlock(rest if rest.endswith(b'\n') else rest + b'\n', 0)
+                self.line_starts = [0] * len(self.lines)
+        elif status.st_size < self.istream.tell():
+            Metrics.sink.Message(f'{self.log_filename} was truncated, reading it from the start')
+            self.istream.seek(0)
+        else:
+            return False
+
+        self.carry = b''
+        self.saved_offset = None
+        self.last_data_time = time.monotonic()
+        self.poll_delay = TokenSourceCSVStream.poll_seconds
+        return True
+
+
+    def Offset(self) -> int:
+        """
+        The byte offset of the first line not completely read, where a restarted source resumes.
+        """
+        if self.last_line_read is not None:
+            return self.line_start
+        if self.line_index < len(self.lines):
+            return self.line_starts[self.line_index]
+        return self.istream.tell() - len(self.carry)
+
+
+    def LoadOffset(self) -> int:
+        """
+        The offset saved in the offset file, if the file read is still the
+        one it was saved for, and is no shorter than the offset.
+        returns: The saved offset, or None if there is none, or it is stale.
+        """
+        if self.offset_filename is None or not os.path.exists(self.offset_filename):
+            return None
+
+        with open(self.offset_filename) as file:
+            saved = json.load(file)
+        status = os.fstat(self.istream.fileno())
+        if (saved['device'], saved['inode']) != (status.st_dev, status.st_ino) or saved['offset'] > status.st_size:
+            Metrics.sink.Message(f'{self.log_filename} was rotated or truncated since its offset was saved, reading it from the start')
+            return None
+        return saved['offset']
+
+
+    def SaveOffset(self) -> None:
+        """
+        Save the offset of the first line not completely read, and which file it is in, to the offset file.
+        The file is replaced in one step, so it is never left half written.
+        """
+        if self.offset_filename is None or self.istream is None or self.istream.closed:
+            return
+
+        self.last_save_time = time.monotonic()
+        offset = self.Offset()
+        if offset == self.saved_offset:
+            return
+
+        status = os.fstat(self.istream.fileno())
+        temporary_filename = self.offset_filename + '.tmp'
+        with open(temporary_filename, 'w') as file:
+            json.dump({'filename': self.log_filename, 'device': status.st_dev, 'inode': status.st_ino, 'offset': offset}, file)
+        os.replace(temporary_filename, self.offset_filename)
+        self.saved_offset = offset
+
+
     def ReadNextLine(self) -> None: 
-        line = self.istream.readline()
+        line = self.NextLine()
         self.line_count_read += 1
-        if self.line_count_read % 100 == 0:
-            print()
-            print('************************************************')
-            print(f"Read {self.line_count_read} lines from {self.log_filename}")
-            print('************************************************')
-
-        if not line or (self.max_lines > 0 and self.line_count_read >= self.max_lines):
-            print()
-            print('************************************************')
-            print(f"Read {self.line_count_read} lines from {self.log_filename}")
-            print('************************************************')
+        Metrics.sink.Count('source_lines')
+
+        if line is None or (self.max_lines > 0 and self.line_count_read >= self.max_lines):
+            Metrics.sink.Message(f"Read {self.line_count_read} lines from {self.log_filename}")
             self.last_line_read = None
+            self.SaveOffset()
             return
 
-        self.last_line_read = re.split("\s", line.strip())
+        self.last_line_read = whitespace_pattern.split(line.strip())
+        self.field_index = 0
+        self.line_count += 1
+
+
+    def GetNextLineIds(self) -> np.ndarray:
+        """
+        Overridden method interns the words of the rest of the current
+        line, or of the next line, without making a token for each.
+        returns: The interned ids of the line's tokens, ending with end of line.
+        """
+        if not self.IsInputAvailable() or self.end_of_stream:
+            return np.zeros(0, dtype=np.int64)
+
+        if self.last_line_read is None:
+            self.ReadNextLine()
+            if self.last_line_read is None:
+                self.end_of_stream = True
+                return np.zeros(0, dtype=np.int64)
+
+        intern_ids = [TokenTimestamp.Intern() if IsTimestamp(token_value) else TokenString.Intern(token_value)
+                      for token_value in self.last_line_read[self.field_index:]]
+        intern_ids.append(TokenString.Intern('', end_of_line=True))
+        self.last_line_read = None
+
+        return np.array(intern_ids, dtype=np.int64)
 
 
     def PopTokenFromInput(self) -> TokenBase:
         """
-        The caller guarantees that the list of strings
-        LastLineRead exists, and contains whatever tokens remain
-        from the last line read.  This includes the cases where
-        the last line read was empty, and where previous calls
-        to this method have exhausted all tokens from LastLineRead.
-        When this method is called with the resulting empty LastLineRead,
-        it generates a TokenString with .EndOfLine set, and nulls LastLineRead.
+        Hand out the next field of the current line as a token, then an
+        end-of-line token once the fields run out, after which there is
+        no current line.
 
-        returns: The next token from LastLineRead, or null if none exist.
+        returns: The next token of the current line, or None if there is no current line.
         """
-        next_token = None
+        if self.last_line_read is None:
+            return None
 
-        if self.last_line_read is not None:
-            if len(self.last_line_read) != 0:
-                token_value = self.last_line_read.pop(0)
-                if re.match(timestamp_pattern, token_value):
-                    # If the token is a timestamp, create a TokenTimestamp object
-                    next_token = TokenTimestamp(token_value)
-                else:
-                    # Otherwise, create a TokenBase object
-                    next_token = TokenString(token_value)
-            else:
-                next_token = TokenString('')
-                next_token.end_of_line = True
-
-                self.last_line_read = None
-            
+        if self.field_index < len(self.last_line_read):
+            token_value = self.last_line_read[self.field_index]
+            self.field_index += 1
+            if IsTimestamp(token_value):
+                # If the token is a timestamp, create a TokenTimestamp object
+                return TokenTimestamp(token_value)
+
+            # Otherwise, create a TokenString object
+            return TokenString(token_value)
+
+        next_token = TokenString('')
+        next_token.end_of_line = True
+        self.last_line_read = None
         return next_token
-    
\ No newline at end of file
@@ -7,6 +7,7 @@ from tokenstring import TokenString
 #from tokenstringembed import TokenStringEmbed
 from tokentimestamp import TokenTimestamp
 from tokensourcebase import TokenSourceBase
+from metrics import Metrics
 
 sentences_pattern = re.compile(r"[\w+\s]+.")
 words_pattern = re.compile(r"([\w]+)(.)")
@@ -16,11 +17,14 @@ class TokenSourceDataset(TokenSourceBase):
     Token source for reading tokens from a hugging face dataset.
     This class implements the abstract methods defined in TokenSourceBase.
     """
+    profiled_methods = TokenSourceBase.profiled_methods + ['GetStoryFromDataset', 'GetLineFromStory']
 
-    def __init__(self, datasetname, max_lines=0):
+    def __init__(self, datasetname, max_lines=0, first_story=0, split='train'):
         super().__init__()
         self.datasetname = datasetname
+        self.split = split
         self.max_lines = max_lines
+        self.first_story = first_story
 
         self.Reset()
 
@@ -76,8 +80,8 @@ class TokenSourceDataset(TokenSourceBase):
         self.current_sentence = []
         self.current_delimiter = ' '
 
-        self.max_story = len(self.dataset['train']) if self.max_lines <= 0 else self.max_lines
-        self.current_story = 0
+        self.max_story = len(self.dataset[self.split]) if self.max_lines <= 0 else self.max_lines
+        self.current_story = self.first_story
         self.line_count = 0
 
 
@@ -108,43 +112,78 @@ class TokenSourceDataset(TokenSourceBase):
         token = self.GetStoryFromDataset()
         return token
 
+    def GetLeadIn(self) -> tuple[list[TokenBase], bool]:
+        """
+        Overridden method returns the tokens of the stories before the
+        first story of this source that follow their last end of line.
+        Stories are read backwards only until an end of line is found,
+        or until there are enough tokens to fill recent memory.
+        """
+        lead_in = []
+        for story_index in range(self.first_story - 1, -1, -1):
+            story_tokens = self.StoryTokens(self.dataset[self.split][story_index]['text'])
+            end_of_lines = [i for i, token in enumerate(story_tokens) if token.end_of_line]
+            if len(end_of_lines) > 0:
+                return story_tokens[end_of_lines[-1] + 1:] + lead_in, True
+
+            lead_in = story_tokens + lead_in
+            if len(lead_in) >= Settings.max_token_strength:
+                break
+
+        return lead_in, False
+
+    def StoryTokens(self, tiny_story: str) -> list[TokenBase]:
+        """
+        Returns all tokens of one story, exactly as GetNext returns them.
+        """
+        tokens = []
+        for sentence in sentences_pattern.findall(tiny_story):
+            for word, delimiter in words_pattern.findall(sentence):
+                tokens.append(TokenString(word))
+                if delimiter != ' ':
+                    token = TokenString(delimiter)
+                    token.end_of_line = delimiter == '.'
+                    tokens.append(token)
+
+        return tokens
+
     def GetStoryFromDataset(self) -> TokenBase:
         """
         Returns the next story from the dataset being read.
+        Stories without any words are skipped.
         If the end of the dataset is reached, returns None.
         """
-        if self.current_story < self.max_story:
-            tiny_story = self.dataset['train'][self.current_story]['text']
+        while self.current_story < self.max_story:
+            tiny_story = self.dataset[self.split][self.current_story]['text']
             self.current_story += 1
-            print()
-            print('************************************************')
-            print(f"Read {self.current_story} stories of {self.max_story} from {self.datasetname}")
-            print('************************************************')
+            Metrics.sink.Count('stories')
+            Metrics.sink.Gauge('story_progress', self.current_story / self.max_story)
 
             # Split the current line into sentences, and then split each sentence into words and delimiters
             self.story = sentences_pattern.findall(tiny_story)
-            return self.GetLineFromStory()
-        else:
-            return None
+            token = self.GetLineFromStory()
+            if token is not None:
+                return token
+
+        return None
         
     def GetLineFromStory(self) -> TokenBase:
         """
         Returns the next line from the current story being read.
+        Sentences without any words are skipped.
         If the end of the story is reached, returns None.
         """
-        if len(self.story) > 0:
+        while len(self.story) > 0:
             sentence = self.story.pop(0)
             self.current_sentence = words_pattern.findall(sentence)
             self.line_count += 1
-            if self.line_count % 100 == 0:
-                print()
-                print('************************************************')
-                print(f"Read {self.line_count} lines from {self.datasetname}")
-                print('************************************************')
+            Metrics.sink.Count('source_lines')
 
-            return self.GetTokenFromLine()
-        else:
-            return None
+            token = self.GetTokenFromLine()
+            if token is not None:
+                return token
+
+        return None
         
     def GetTokenFromLine(self) -> TokenBase:
         """
@@ -0,0 +1,80 @@
+import numpy as np
+from settings import Settings, TokenSourceFlags
+from tokenbase import TokenBase
+from tokenstring import TokenString
+from tokensourcebase import TokenSourceBase
+
+
+class TokenSourceMemory(TokenSourceBase):
+    """
+    Token source for reading tokens from lines held in memory, each a
+    list of words, every line followed by an end-of-line token.  Needs
+    no files, datasets or servers, so it suits benchmarks and tests.
+    """
+
+    def __init__(self, lines: list[list[str]]):
+        super().__init__()
+        self.lines = lines
+        self.Reset()
+
+
+    def __enter__(self):
+        self.Reset()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+    # Concrete implementation of abstract methods from TokenSourceBase
+    def IsInputAvailable(self) -> bool:
+        return self.line_index < len(self.lines) or self.word_index > 0
+
+    def GetLineCount(self) -> int:
+        return self.line_index
+
+    def Reset(self) -> None:
+        self.line_index = 0
+        self.word_index = 0
+
+
+    def GetNext(self, flags: int = 0) -> TokenBase:
+        """
+        Returns the next token of the lines, or None after the last line.
+        """
+        if flags & TokenSourceFlags.Flag_StartOfSequence:
+            token = TokenString(Settings.StartOfSequenceTokenValue)
+            token.start_of_sequence = True
+            return token
+
+        if self.line_index >= len(self.lines):
+            return None
+
+        line = self.lines[self.line_index]
+        if self.word_index < len(line):
+            self.word_index += 1
+            return TokenString(line[self.word_index - 1])
+
+        self.line_index += 1
+        self.word_index = 0
+        token = TokenString()
+        token.SetEndOfLine()
+        return token
+
+
+    def GetNextLineIds(self) -> np.ndarray:
+        """
+        Overridden method interns the words of the rest of the current
+        line, or of the next line, without making a token for each.
+        returns: The interned ids of the line's tokens, ending with end of line.
+        """
+        if self.line_index >= len(self.lines):
+            return np.zeros(0, dtype=np.int64)
+
+        words = self.lines[self.line_index][self.word_index:]
+        self.line_index += 1
+        self.word_index = 0
+
+        intern_ids = [TokenString.Intern(word) for word in words]
+        intern_ids.append(TokenString.Intern('', end_of_line=True))
+        return np.array(intern_ids, dtype=np.int64)
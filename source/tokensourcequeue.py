@@ -0,0 +1,111 @@
+import queue
+from settings import Settings, TokenSourceFlags
+from tokenbase import TokenBase
+from tokenstring import TokenString
+from tokensourcebase import TokenSourceBase
+
+
+class PipelineAborted(Exception):
+    """
+    Raised in a pipeline stage blocked on a queue when another stage has failed.
+    """
+    pass
+
+
+class TokenSourceQueue(TokenSourceBase):
+    """
+    Token source for reading tokens inserted by another MultiGram layer.
+    One layer inserts tokens at one end of a bounded queue, as the
+    next_layer of FollowTokenBehavior, and the next layer reads them
+    from the other.  A full queue blocks the inserting layer, so a slow
+    layer holds back the layers before it.  MarkAsDone ends the stream.
+    The queue may be a queue.Queue, for layers on threads, or a
+    multiprocessing queue, for layers in separate processes.
+    """
+    # How long to block on the queue before checking whether the pipeline was aborted.
+    poll_seconds = 0.1
+
+    def __init__(self, token_queue, abort_event=None):
+        super().__init__()
+        self.token_queue = token_queue
+        self.abort_event = abort_event
+        self.Reset()
+
+
+    def IsInputAvailable(self) -> bool:
+        """
+        Overridden method, True until the end of the stream is read.
+        """
+        return not self.end_of_stream
+
+    def GetLineCount(self) -> int:
+        """
+        Overridden method counts the end-of-line tokens read so far.
+        """
+        return self.line_count
+
+    def Reset(self) -> None:
+        """
+        Overridden method.  A queue cannot be read again, only the counts are reset.
+        """
+        self.end_of_stream = False
+        self.marked_done = False
+        self.line_count = 0
+
+
+    def GetNext(self, flags: int = 0) -> TokenBase:
+        """
+        Overridden method returns the next token inserted by the layer
+        before, waiting for one if necessary, or None at the end of the stream.
+        """
+        # If requested, return a token indicating the start of a sequence.
+        if flags & TokenSourceFlags.Flag_StartOfSequence:
+            token = TokenString(Settings.StartOfSequenceTokenValue)
+            token.start_of_sequence = True
+            return token
+
+        if self.end_of_stream:
+            return None
+
+        while True:
+            try:
+                token = self.token_queue.get(timeout=TokenSourceQueue.poll_seconds)
+                break
+            except queue.Empty:
+                self.CheckAborted()
+
+        if token is None:
+            self.end_of_stream = True
+        elif isinstance(token, TokenString) and token.end_of_line:
+            self.line_count += 1
+
+        return token
+
+
+    def Insert(self, token: TokenBase) -> None:
+        """
+        Insert a token for the next layer, waiting while the queue is full.
+        """
+        while True:
+            try:
+                self.token_queue.put(token, timeout=TokenSourceQueue.poll_seconds)
+                return
+            except queue.Full:
+                self.CheckAborted()
+
+
+    def MarkAsDone(self) -> None:
+        """
+        End the stream.  Only the first call has any effect.
+        """
+        if not self.marked_done:
+            self.marked_done = True
+            self.Insert(None)
+
+
+    def CheckAborted(self) -> None:
+        """
+        Raise PipelineAborted if another stage of the pipeline has failed.
+        """
+        if self.abort_event is not None and self.abort_event.is_set():
+            raise PipelineAborted('Another stage of the pipeline failed.')
@@ -1,5 +1,6 @@
 import sys
 from tokenbase import TokenBase
+from tokeninterner import TokenInterner
 
 class TokenString(TokenBase):
     """
@@ -7,11 +8,63 @@ class TokenString(TokenBase):
     It represents a token that is a string and provides specific implementations
     for the abstract methods defined in TokenBase.
     """
+    __slots__ = ('_token_raw', '_end_of_line')
 
-    def __init__(self, value: str):
+    def __init__(self, value: str = ''):
         super().__init__('TokenString')
-        self.token_raw = value
-        self.end_of_line = False
+        self._token_raw = value
+        self._end_of_line = False
+
+
+    @property
+    def token_raw(self) -> str:
+        return self._token_raw
+
+    @token_raw.setter
+    def token_raw(self, value: str) -> None:
+        self._token_raw = value
+        self.intern_id = None
+
+    @property
+    def end_of_line(self) -> bool:
+        return self._end_of_line
+
+    @end_of_line.setter
+    def end_of_line(self, value: bool) -> None:
+        self._end_of_line = value
+        self.intern_id = None
+
+
+    def SetEndOfLine(self) -> None:
+        """
+        Make this token an end-of-line token.
+        """
+        self.end_of_line = True
+
+
+    @staticmethod
+    def VocabularyKey(value: str, end_of_line: bool = False):
+        """
+        The vocabulary key of a string token.  All end-of-line tokens are
+        equal, whatever string they were read from.
+        """
+        return ('TokenString', None if end_of_line else value)
+
+
+    @staticmethod
+    def Intern(value: str, end_of_line: bool = False) -> int:
+        """
+        The interned id a string token would have, without making one.
+        Lets sources emit token ids directly.
+        """
+        return TokenInterner.Intern(TokenString.VocabularyKey(value, end_of_line))
+
+
+    @classmethod
+    def FromVocabularyKey(cls, key) -> 'TokenString':
+        token = TokenString('' if key[1] is None else key[1])
+        token.end_of_line = key[1] is None
+        return token
 
     
     # Concrete implementation of abstract methods from TokenBase
@@ -26,8 +79,7 @@ class TokenString(TokenBase):
         if not isinstance(ref_token,  TokenString):
             return 0
 
-
-        return sys.maxsize if self.GetAsString() == ref_token.GetAsString() else 0
+        return sys.maxsize if self.InternId == ref_token.InternId else 0
     
     def IsEqualTo(self, ref_token):
         """
@@ -41,8 +93,22 @@ class TokenString(TokenBase):
         if not isinstance(ref_token,  TokenString):
             return False
 
-        return self.GetAsString() == ref_token.GetAsString()
+        return self.InternId == ref_token.InternId
     
+    def GetVocabularyKey(self):
+        """
+        Strings are equal when their string values are equal.
+        returns: A key built from the string value of this token
+        """
+        return TokenString.VocabularyKey(self.token_raw, self.end_of_line)
+
+    def IsSimilarityExact(self, threshold_score: float) -> bool:
+        """
+        String similarity is either 0 or sys.maxsize, so any positive
+        threshold recognizes exactly the equal strings.
+        """
+        return threshold_score > 0
+
     def GetAsString(self) -> str:
         """
         For logging and analysis, get this token as a string.
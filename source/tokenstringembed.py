@@ -5,6 +5,7 @@ import tensorflow as tf
 from settings import Settings
 from tokenbase import TokenBase
 from tfnodehelper import EmbeddingModule
+from metrics import Metrics
 
 OLLAMA_HOST = '192.168.1.142'
 OLLAMA_PORT = 11434
@@ -59,7 +60,7 @@ class TokenStringEmbed(TokenBase):
         if similarity > TokenStringEmbed.threshold_score:
             return TokenStringEmbed.string_register[index]
         
-        print(f"E[{index}]='{self.token_raw}'", end='  ')
+        Metrics.sink.Count('embeddings')
         TokenStringEmbed.string_register[index] = self
         
         return None
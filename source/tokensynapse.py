@@ -5,9 +5,13 @@ class TokenSynapse:
     tokens that follow it in sequence.
     For simplicity, refer to 'this token' as the token that
     owns this synapse.
+    Connections are stored in the ConnectionStore of a MultiGram;
+    a synapse is a view of one of them, made when a caller asks.
     NOTE: after must be a TokenBase object.
     """
-    def __init__(self, after, strength:int=0):
+    __slots__ = ('FollowingToken', 'Strength', 'SoftmaxStrength')
+
+    def __init__(self, after, strength:int=0, softmax_strength:float=0):
         """
          A synapse must be provided with the following
         token, the initial strength, and the distance between this token
@@ -15,11 +19,11 @@ class TokenSynapse:
 
         after: A token that follows this token in the sequence
         strength: Initial strength of the relationship
-        distance: How far the following token follows this token
+        softmax_strength: Strength relative to the other connections at the same distance
         """
         self.FollowingToken = after
         self.Strength = strength
-        self.SoftmaxStrength = 0
+        self.SoftmaxStrength = softmax_strength
 
 
     def Dump(self) -> None:
@@ -1,47 +1,49 @@
-import random
+import weakref
+import numpy as np
 
 from multigram import MultiGram
+from nexttokenscorer import NextTokenScorer
+from sentencegenerator import SentenceGenerator
+from metrics import Metrics
 from tokenbase import TokenBase
 from tokenstringembed import TokenStringEmbed
 from tokenstring import TokenString
-from settings import Settings
+
+# The scorers of each multigram, so their caches are kept between calls.
+scorers = weakref.WeakKeyDictionary()
+
+def GetScorer(multigram: MultiGram, mode: str) -> NextTokenScorer:
+    """
+    The scorer of a multigram for a mode, made on first use.
+    """
+    multigram_scorers = scorers.setdefault(multigram, {})
+    if mode not in multigram_scorers:
+        multigram_scorers[mode] = NextTokenScorer(multigram, mode)
+    return multigram_scorers[mode]
+
 
 def FindMostLikelyNextToken(multigram: MultiGram, token_history: list[TokenString], threshold: int = 1) -> TokenString:
     """
     Find the most likely next token based on the current token's relationships.
     This function uses the token's connections to determine the next likely token.
     """
-    likely_tokens = {}
-
-    history_length = len(token_history) if len(token_history) < Settings.max_token_strength else Settings.max_token_strength
-    for distance in range(1, history_length + 1):
-        token = token_history[-distance]
-        distance_multiplier = len(token_history) - distance + 1
+    scores = GetScorer(multigram, 'support').Scores([token.TokenId for token in token_history])
+    return ReportBestNextToken(multigram, scores, threshold)
 
-        for connection in token.Connections[distance - 1]:  # Assuming distance 1 connections are at index 0
-            #print(f'Examining connection from {token.token_raw} to {connection.FollowingToken.token_raw if connection.FollowingToken is not None else "<None>"} with strength {connection.Strength} at distance {connection.Distance}')
-            if distance > 1 and connection.FollowingToken in likely_tokens:
-                likely_tokens[connection.FollowingToken] += connection.SoftmaxStrength * distance_multiplier
-            elif distance == 1 and connection.FollowingToken not in likely_tokens:
-                likely_tokens[connection.FollowingToken] = connection.SoftmaxStrength * distance_multiplier
 
-    print()
-    print('*************************************************')
-    print(f'Finding next likely token out of {len(likely_tokens)} possibilities after ' + ' -> '.join(token_history[i].token_raw for i in range(0, len(token_history))))
-    for token, strength in likely_tokens.items():
-        print(f"  Possible next token: '{token.token_raw}' with strength {strength}")
-    print('*************************************************')
-    print()
-
-    likely_token = max(likely_tokens, key=likely_tokens.get, default=None)
-    if likely_token is not None and likely_tokens[likely_token] < threshold:
-        likely_token = None
-    
-    if likely_token is not None:
-        max_strength = likely_tokens[likely_token] if likely_token is not None else 0
-        print(f'Most likely next token for "{token_history[-1].token_raw}" is {likely_token.token_raw if likely_token is not None else "<None>"} with strength {max_strength}')
+def ReportBestNextToken(multigram: MultiGram, scores: np.ndarray, threshold: float = -np.inf) -> TokenString:
+    """
+    The token of the best score, lowest id first among equals, or None if no score reaches the threshold.
+    The number of candidates is reported to the metrics sink.
+    """
+    candidates = np.isfinite(scores)
+    Metrics.sink.Count('next_token_queries')
+    Metrics.sink.Gauge('next_token_candidates', int(candidates.sum()))
+    if not candidates.any():
+        return None
 
-    return likely_token
+    best = int(np.argmax(scores))
+    return multigram.tokens[best] if scores[best] >= threshold else None
 
 
 def GenerateLikelyString(multigram: MultiGram, token: TokenString) -> str:
@@ -94,15 +96,23 @@ def GenerateBestFitString(multigram: MultiGram, tokens: list['str']) -> list['st
     result = []
 
     root_token = TokenString(tokens[0])
-    print(f'GenerateBestFitString Finding best fit for root token "{root_token.token_raw}"')
-    token = root_token.FindTokenIfSeen(tokens = multigram.tokens, threshold_score = 1.0)
-    print(f'Best fit for root token "{root_token.token_raw}" is "{token.token_raw if token is not None else "<None>"}"')
+    token = multigram.FindToken(root_token, threshold_score = 1.0)
+    Metrics.sink.Message(f'Best fit for root token "{root_token.token_raw}" is "{token.token_raw if token is not None else "<None>"}"')
     result.append(token)
 
     for next_prompt in tokens[1:]:
         token_prompt = TokenString(next_prompt)
-        prompt_possible = [c.FollowingToken for c in token.Connections[0] if c.FollowingToken is not None]
-        print(f'Finding possible next prompts for {token.token_raw}: {[p.token_raw for p in prompt_possible]}')
+
+        # A prompt token that follows the last one is taken as it is.
+        prompt_token = multigram.FindTokenLike(token_prompt)
+        if prompt_token is not None and multigram.connections.IsSuccessor(token.TokenId, 1, prompt_token.TokenId):
+            token = prompt_token
+            result.append(token)
+            continue
+
+        # Otherwise the possible next prompts are the successors of the last one, strongest first.
+        prompt_possible = [multigram.tokens[target] for target in multigram.connections.TopSuccessors(token.TokenId, 1)[0].tolist()]
+        Metrics.sink.Gauge('prompt_candidates', len(prompt_possible))
         if isinstance(token_prompt, TokenStringEmbed):
             prompt_similarities = [dot(token_prompt.embedding, p.embedding) for p in prompt_possible]
             max_similarity = max(prompt_similarities) if len(prompt_similarities) > 0 else 0.0
@@ -120,7 +130,7 @@ def GenerateBestFitString(multigram: MultiGram, tokens: list['str']) -> list['st
 
 
     while token is not None:
-        print(f'Extending best fit with {token.token_raw}')
+        Metrics.sink.Count('generated_tokens')
         token = FindMostLikelyNextToken(multigram, result, threshold=0)
         result.append(token)
 
@@ -129,9 +139,10 @@ def GenerateBestFitString(multigram: MultiGram, tokens: list['str']) -> list['st
 
 
 def GenerateRandomSentence(multigram: MultiGram) -> str:
-    strting_token = TokenString(Settings.StartOfSequenceTokenValue)
-    root_token = strting_token.FindTokenIfSeen(tokens = multigram.tokens, threshold_score = 1.0)
-    random_root = random.choice(root_token.Connections[0]).FollowingToken if root_token is not None and len(root_token.Connections[0]) > 0 else None
+    generator = SentenceGenerator(multigram)
+    root_token = generator.StartToken()
+    root_id = generator.SampleNext([root_token.TokenId])[0] if root_token is not None else -1
+    random_root = multigram.tokens[root_id] if root_id >= 0 else None
 
     if random_root is None:
         return "No starting token found."
@@ -143,37 +154,7 @@ def FindBestNextToken(multigram: MultiGram, token_history: list[TokenString]) ->
     Find the best next token based on the current token's relationships.
     This function uses the token's connections to determine the next likely token.
     """
-    likely_tokens = {}
-
-    history_length = len(token_history) if len(token_history) < Settings.max_token_strength else Settings.max_token_strength
-    for distance in range(1, history_length + 1):
-        token = token_history[-distance]
-        distance_multiplier = (history_length - distance + 1) / history_length
-
-        pruned_tokens = {}
-        for connection in token.Connections[distance - 1]:  # Assuming distance 1 connections are at index 0
-            #print(f'Examining connection from {token.token_raw} to {connection.FollowingToken.token_raw if connection.FollowingToken is not None else "<None>"} with strength {connection.Strength} at distance {connection.Distance}')
-            if distance > 1 and connection.FollowingToken in likely_tokens:
-                pruned_tokens[connection.FollowingToken] = likely_tokens[connection.FollowingToken] + connection.SoftmaxStrength * distance_multiplier
-            elif distance == 1 and connection.FollowingToken not in likely_tokens:
-                likely_tokens[connection.FollowingToken] = connection.SoftmaxStrength * distance_multiplier
-
-        if distance > 1:
-            likely_tokens = dict(pruned_tokens)     # copy contents, not reference.
-
-    print()
-    print('*************************************************')
-    print(f'Finding next likely token out of {len(likely_tokens)} possibilities after ' + ' -> '.join(token_history[i].token_raw for i in range(0, len(token_history))))
-    for token, strength in likely_tokens.items():
-        print(f"  Possible next token: '{token.token_raw}' with strength {strength}")
-    print('*************************************************')
-    print()
-
-    likely_token = max(likely_tokens, key=likely_tokens.get, default=None)
-    if likely_token is not None:
-        max_strength = likely_tokens[likely_token] if likely_token is not None else 0
-        print(f'Most likely next token for "{token_history[-1].token_raw}" is {likely_token.token_raw if likely_token is not None else "<None>"} with strength {max_strength}')
-
-    return likely_token
+    scores = GetScorer(multigram, 'intersect').Scores([token.TokenId for token in token_history])
+    return ReportBestNextToken(multigram, scores)
 
 
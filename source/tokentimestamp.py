@@ -1,11 +1,14 @@
 import sys
 import datetime
 from tokenbase import TokenBase
+from tokeninterner import TokenInterner
 
 class TokenTimestamp(TokenBase):
     """
     Class to handle token timestamps.
     """
+    __slots__ = ('token_raw',)
+
     def __init__(self, timestamp: datetime.datetime = None):
         super().__init__('TokenTimestamp')
         if timestamp is None:
@@ -13,6 +16,18 @@ class TokenTimestamp(TokenBase):
         else:
             self.token_raw = timestamp
 
+    @classmethod
+    def FromVocabularyKey(cls, key) -> 'TokenTimestamp':
+        # All timestamps are equal, the value of the first one seen is not kept.
+        return TokenTimestamp(datetime.datetime.min)
+
+    @staticmethod
+    def Intern() -> int:
+        """
+        The interned id every timestamp token has, without making one.
+        """
+        return TokenInterner.Intern(('TokenTimestamp',))
+
     def SetTime(self, timestamp: str) -> None:
         """
         Set the timestamp for this token from a string in ISO format.
@@ -41,6 +56,20 @@ class TokenTimestamp(TokenBase):
 
         return True
 
+    def GetVocabularyKey(self):
+        """
+        All timestamps are equal to each other.
+        returns: A key shared by all timestamp tokens
+        """
+        return ('TokenTimestamp',)
+
+    def IsSimilarityExact(self, threshold_score: float) -> bool:
+        """
+        Timestamp similarity is either 0 or sys.maxsize, so any positive
+        threshold recognizes exactly the equal timestamps.
+        """
+        return threshold_score > 0
+
     def GetAsString(self) -> str:
         """
         Return the string representation of this token.